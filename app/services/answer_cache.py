@@ -0,0 +1,111 @@
+import math
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Dict, Iterable, List, Optional, Union
+
+@dataclass
+class CachedAnswer:
+    query: str
+    # Normalised query embedding, so that the cosine similarity is a dot product.
+    embedding: List[float]
+    answer: str
+    citations: List[str] = field(default_factory=list)
+    # How long the Rag call that produced the answer took, ie. what a hit saves.
+    latency_seconds: float = 0.0
+    created_at: float = field(default_factory=time.time)
+
+def _normalise(vector: List[float]) -> List[float]:
+    norm = math.sqrt(sum(v * v for v in vector)) or 1.0
+    return [v / norm for v in vector]
+
+class SemanticAnswerCache:
+    """
+        Answers of the Rag tool per user (group_id). A question whose embedding is at least `threshold` cosine
+        similar to an earlier question of the same user gets the earlier answer and citations back, without
+        retrieval, reranking or synthesis. Each user keeps at most `max_entries` answers (least recently used
+        first out), at most `max_groups` users are kept, and answers expire after `ttl_seconds`.
+        Anything ingested for a user invalidates all of that user's answers.
+    """
+    def __init__(self, threshold: float = 0.95, max_entries: int = 32, max_groups: int = 1000, ttl_seconds: float = 3600, enabled: bool = True):
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.max_groups = max_groups
+        self.ttl_seconds = ttl_seconds
+        self.enabled = enabled
+        self._lock = threading.Lock()
+        self._groups: "OrderedDict[str, OrderedDict[int, CachedAnswer]]" = OrderedDict()
+        self._next_key = 0
+        self._counters = {"lookups": 0, "hits": 0, "invalidations": 0, "saved_seconds": 0.0}
+
+    def configure(self, **kwargs) -> None:
+        for key, value in kwargs.items():
+            if not hasattr(self, key):
+                raise ValueError(f"Unknown answer cache setting: {key}")
+            setattr(self, key, value)
+
+    def lookup(self, group_id: str, embedding: List[float]) -> Optional[CachedAnswer]:
+        if not self.enabled:
+            return None
+        embedding = _normalise(embedding)
+        now = time.time()
+        with self._lock:
+            self._counters["lookups"] += 1
+            entries = self._groups.get(group_id)
+            if not entries:
+                return None
+            self._groups.move_to_end(group_id)
+            best_key, best_similarity = None, self.threshold
+            for key, entry in list(entries.items()):
+                if now - entry.created_at > self.ttl_seconds:
+                    del entries[key]
+                    continue
+                similarity = sum(a * b for a, b in zip(embedding, entry.embedding))
+                if similarity >= best_similarity:
+                    best_key, best_similarity = key, similarity
+            if best_key is None:
+                return None
+            entries.move_to_end(best_key)
+            self._counters["hits"] += 1
+            self._counters["saved_seconds"] += entries[best_key].latency_seconds
+            return entries[best_key]
+
+    def store(self, group_id: str, query: str, embedding: List[float], answer: str, citations: List[str], latency_seconds: float) -> None:
+        if not self.enabled:
+            return
+        entry = CachedAnswer(query, _normalise(embedding), answer, list(citations), latency_seconds)
+        with self._lock:
+            entries = self._groups.setdefault(group_id, OrderedDict())
+            self._groups.move_to_end(group_id)
+            entries[self._next_key] = entry
+            self._next_key += 1
+            while len(entries) > self.max_entries:
+                entries.popitem(last=False)
+            while len(self._groups) > self.max_groups:
+                self._groups.popitem(last=False)
+
+    def invalidate(self, group_ids: Union[str, Iterable[str]]) -> None:
+        """Drop the answers of the given users, eg. because new documents were indexed for them."""
+        if isinstance(group_ids, str):
+            group_ids = [group_ids]
+        with self._lock:
+            for group_id in group_ids:
+                if self._groups.pop(group_id, None):
+                    self._counters["invalidations"] += 1
+
+    def stats(self) -> Dict[str, float]:
+        with self._lock:
+            lookups = self._counters["lookups"]
+            return {
+                "groups": len(self._groups),
+                "entries": sum(len(entries) for entries in self._groups.values()),
+                "lookups": lookups,
+                "hits": self._counters["hits"],
+                "hit_rate": round(self._counters["hits"] / lookups, 3) if lookups else 0.0,
+                "invalidations": self._counters["invalidations"],
+                "saved_seconds": round(self._counters["saved_seconds"], 2)
+            }
+
+# Process-wide cache, configured at startup. Ingestion and the user's turns run on the same shard, so they share it.
+answer_cache = SemanticAnswerCache()
@@ -1,4 +1,7 @@
-from typing import List
+from typing import Any, List, Optional
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from contextvars import ContextVar, copy_context
+from dataclasses import dataclass, field
 from langchain.tools.base import BaseTool, Tool
 from langchain_core.messages import (
         SystemMessage, 
@@ -14,17 +17,31 @@ from langchain_core.prompts.chat import (
 from langchain_openai import ChatOpenAI
 from langchain.agents import AgentExecutor, create_openai_functions_agent
 import logging
+import threading
+import time
 from langchain.globals import set_debug
 set_debug(False)
 from app.services.web_search_service.ddg_search_service import DDGWrappper
 from app.services.databases.qdrant_setup import (
     build_sentence_window_query_engine,
     build_index_retriever,
+    get_embed_model
 )
-from app.services.databases.dynamodb_setup import DynamoDBSessionManagement
+from app.services.answer_cache import answer_cache
+from app.services.databases.document_catalog import get_document_catalog
+from app.services.databases.dynamodb_setup import DynamoDBSessionManagement, get_session_history
+from app.services.databases.session_cache import SessionHistoryCache
+from app.services.databases.artifact_store import (
+        DynamoDBArtifactStore,
+        artifact_message,
+        expand_artifact_messages
+    )
 from app.services.service_utilities import (
+        cosine_similarity,
         merge_nodes_to_source, 
-        detect_and_extract_urls
+        detect_and_extract_urls,
+        prune_messages_to_token_limit,
+        with_token_count
     )
 from app.services.general_utilities import (
         send_message,
@@ -32,11 +49,34 @@ from app.services.general_utilities import (
         get_media_message_input
     )
 
+@dataclass
+class TurnState:
+    """State that belongs to a single turn of a single user."""
+    senders_wa_id: str
+    dynamodb: DynamoDBSessionManagement
+    citations: List[str] = field(default_factory=list)
+    # Speculative retrieval of the raw message, started while the agent picks a tool. Taken by the first tool using it.
+    prefetch: Optional[Future] = None
+
+@dataclass
+class PrefetchedRetrieval:
+    query: str
+    query_embedding: List[float]
+    # Retrieved and post processed (windows, rerank) nodes.
+    nodes: List[Any]
+
+# The state of the turn being handled. Every worker thread sees only its own turn, which makes
+# one RealtyaiBot instance safe to share between concurrent turns of different users.
+_current_turn: ContextVar[TurnState] = ContextVar("current_turn")
+
 class RealtyaiBot:
+    """
+        Conversation agent. The prompt, tools, LLM client and agent executor are built once and shared,
+        everything that belongs to a user (whatsapp ID, chat history, citations) is passed per call.
+    """
     def __init__(
         self,
         max_token_length: int = 1000, # Max length of token to be stored as chat history
-        senders_wa_id: str = None,
         openai_api_key: str = None,
         cohere_api_key:str = None,
         aws_access_key_id: str = None,
@@ -48,6 +88,12 @@ class RealtyaiBot:
         whatsapp_access_token: str = None,
         whatsapp_phone_number_id: str = None,
         dynamo_db_table_name: str = None,
+        history_storage_mode: str = "single_item", # "single_item" or "item_per_message", see get_session_history()
+        session_cache: SessionHistoryCache = None, # Optional in-memory, write-behind cache in front of DynamoDB
+        artifact_store: DynamoDBArtifactStore = None, # Optional side store for search results, kept out of the chat history
+        speculative_retrieval: bool = False, # Retrieve for the raw message while the agent picks a tool, for users with documents
+        speculative_min_similarity: float = 0.85, # Minimum similarity of the tool's query to the raw message to reuse the prefetch
+        speculative_timeout: float = 10, # Seconds a tool waits for a running prefetch before retrieving on its own
         system_message: str = ("You are an AI personal assistant, specialised in all things retrieval and search."
             "Do your best to answer the questions at the end. Feel free to use any tools available to look up relevant information," 
             "only if necessary. Ask follow-up questions in case of vague or unclear questions, to get more information about what is being asked."
@@ -63,9 +109,19 @@ class RealtyaiBot:
         self.whatsapp_access_token = whatsapp_access_token
         self.whatsapp_phone_number_id = whatsapp_phone_number_id
         self.max_token_length = max_token_length
-        # Define 2 important state variables
-        self.senders_wa_id = senders_wa_id
-        self.citations = []
+        self.aws_access_key_id = aws_access_key_id
+        self.aws_secret_access_key = aws_secret_access_key
+        self.dynamo_db_table_name = dynamo_db_table_name
+        self.history_storage_mode = history_storage_mode
+        self.session_cache = session_cache
+        self.artifact_store = artifact_store
+        self.speculative_retrieval = speculative_retrieval
+        self.speculative_min_similarity = speculative_min_similarity
+        self.speculative_timeout = speculative_timeout
+        # Prefetches run here, so that turns never wait on each other's speculation. A prefetch is only started
+        # when one of the threads is free, it is skipped rather than queued behind the others.
+        self._prefetch_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix="speculative-retrieval") if speculative_retrieval else None
+        self._prefetch_slots = threading.BoundedSemaphore(4)
         # Define prompt for the conversation agent
         self.prompt = ChatPromptTemplate(
             messages = [
@@ -97,13 +153,6 @@ class RealtyaiBot:
             ),
         ]
         self.llm = ChatOpenAI(model_name="gpt-3.5-turbo", openai_api_key=openai_api_key,max_tokens=128, temperature=0.1)
-        # Create an instance of the DynamoDBSessionManagement to handle chat history, number of interaction etc.
-        self.dynamodb = DynamoDBSessionManagement(
-                table_name=dynamo_db_table_name,
-                session_id=senders_wa_id,
-                aws_access_key_id = aws_access_key_id,
-                aws_secret_access_key= aws_secret_access_key
-            )
         # Create an instance of the agent executor
         self.agent_executor = self._create_agent_executor(self.llm, self.prompt, self.tools, verbose=verbose)
     
@@ -113,21 +162,116 @@ class RealtyaiBot:
         # Create an instance of the runtime of the agent
         return AgentExecutor(agent=agent, tools=tools, verbose=verbose, remember_intermediate_steps=False, max_iterations=3)
 
+    # Per-turn state, read by the tools while a turn is running.
+    @property
+    def senders_wa_id(self) -> str:
+        return _current_turn.get().senders_wa_id
+
+    @property
+    def citations(self) -> List[str]:
+        return _current_turn.get().citations
+
+    @property
+    def dynamodb(self) -> DynamoDBSessionManagement:
+        return _current_turn.get().dynamodb
+
     # This is the main function that will generate the response of the conversation agent
-    def __call__(self, user_input:str)-> str:
+    def __call__(self, user_input:str, senders_wa_id:str)-> str:
+        # Chat history of the user. The cached one buffers writes until the caller flushes it at the end of the turn.
+        if self.session_cache is not None:
+            dynamodb = self.session_cache.session(senders_wa_id)
+        else:
+            # Create an instance of the DynamoDBSessionManagement to handle chat history, number of interaction etc.
+            dynamodb = get_session_history(
+                table_name=self.dynamo_db_table_name,
+                session_id=senders_wa_id,
+                aws_access_key_id = self.aws_access_key_id,
+                aws_secret_access_key= self.aws_secret_access_key,
+                storage_mode=self.history_storage_mode
+            )
+        turn_state = TurnState(senders_wa_id=senders_wa_id, dynamodb=dynamodb)
+        token = _current_turn.set(turn_state)
+        try:
+            turn_state.prefetch = self._start_prefetch(user_input)
+            return self._respond(user_input)
+        finally:
+            # A prefetch no tool asked for is dropped.
+            if turn_state.prefetch is not None:
+                turn_state.prefetch.cancel()
+            _current_turn.reset(token)
+
+    def _start_prefetch(self, user_input: str) -> Optional[Future]:
+        # Only users with indexed documents can get an answer from Rag.
+        catalog = get_document_catalog()
+        if self._prefetch_executor is None or catalog is None or not catalog.entries(self.senders_wa_id):
+            return None
+        if not self._prefetch_slots.acquire(blocking=False):
+            logging.info("Skipped the speculative retrieval, all its threads are busy.")
+            return None
+        # The prefetch runs in a copy of the turn's context, so it reads this turn's state.
+        prefetch = self._prefetch_executor.submit(copy_context().run, self._prefetch, user_input)
+        # Also called when the prefetch is cancelled before it started.
+        prefetch.add_done_callback(lambda _: self._prefetch_slots.release())
+        return prefetch
+
+    def _prefetch(self, user_input: str) -> PrefetchedRetrieval:
+        from llama_index.schema import QueryBundle
+        query_embedding = get_embed_model(self.openai_api_key).get_query_embedding(user_input)
+        sentence_query_engine = build_sentence_window_query_engine(
+            self.senders_wa_id, 
+            self.cohere_api_key, 
+            self.openai_api_key, 
+            self.qdrant_url, 
+            self.qdrant_api_key, 
+            self.qdrant_collection_name
+        )
+        nodes = sentence_query_engine.retrieve(QueryBundle(query_str=user_input, embedding=query_embedding))
+        return PrefetchedRetrieval(user_input, query_embedding, nodes)
+
+    def _take_prefetch(self, query_embedding: List[float]) -> Optional[PrefetchedRetrieval]:
+        # The nodes retrieved for the raw message, if the tool's query means the same thing. The agent usually
+        # passes the message on as is, or rephrased. Waiting for a running prefetch is still quicker than starting over.
+        # The nodes come from the Rag query engine's retrieval (and rerank settings), only Rag can use them.
+        turn_state = _current_turn.get()
+        prefetch, turn_state.prefetch = turn_state.prefetch, None
+        if prefetch is None:
+            return None
+        try:
+            prefetched = prefetch.result(timeout=self.speculative_timeout)
+        except FutureTimeoutError:
+            logging.error("Speculative retrieval timed out, retrieving again.")
+            return None
+        except Exception as e:
+            logging.error(f"An error occurred in the speculative retrieval: {e}")
+            return None
+        similarity = cosine_similarity(prefetched.query_embedding, query_embedding)
+        if similarity < self.speculative_min_similarity:
+            logging.info(f"Dropped the speculative retrieval of '{prefetched.query}', similarity {similarity:.2f}.")
+            return None
+        return prefetched
+
+    def _respond(self, user_input:str)-> str:
         final_answer = ""
         try:
             citations_to_append = ""
             unique_citations = set()
-            # Retreive the chat interactions of the user from DynamoDB
-            chat_history = self.dynamodb.messages()
+            # Retreive the recent chat interactions of the user from DynamoDB. Older turns are compacted into a rolling
+            # summary message (see history_compaction), which is kept in front of the last few interactions.
+            chat_history = self.dynamodb.messages(limit=20)
             last_few_chat_interactions = chat_history[-6:]
+            summaries = [m for m in chat_history[:-6] if m.additional_kwargs.get("summary")]
+            if summaries:
+                last_few_chat_interactions = summaries[-1:] + last_few_chat_interactions
+            # Search results and document summaries are stored aside, bring back the ones in the recent window.
+            last_few_chat_interactions = expand_artifact_messages(self.artifact_store, last_few_chat_interactions)
             pruned_messages = self._prune_long_messages(last_few_chat_interactions)
             response = self.agent_executor.invoke({"input": user_input, "history": pruned_messages})
 
             # Append the new interaction to DynamoDB
-            self.dynamodb.add_message(HumanMessage(content=user_input))
-            self.dynamodb.add_message(AIMessage(content=response["output"]))
+            self.dynamodb.add_messages([
+                with_token_count(HumanMessage(content=user_input)),
+                with_token_count(AIMessage(content=response["output"]))
+            ])
 
             for item in self.citations:
                 unique_citations.add(item)
@@ -151,6 +295,16 @@ class RealtyaiBot:
             logging.error(f"An error occurred while sending status update message of rag tool: {e}")
 
         try:
+            from llama_index.schema import QueryBundle
+            started_at = time.perf_counter()
+            # The query is embedded once, for the answer cache lookup and for the retrieval.
+            query_embedding = get_embed_model(self.openai_api_key).get_query_embedding(query)
+            cached = answer_cache.lookup(self.senders_wa_id, query_embedding)
+            if cached is not None:
+                logging.info(f"Answering '{query}' from the answer cache of '{cached.query}'.")
+                self.citations.extend(cached.citations[:max(2 - len(self.citations), 0)])
+                return cached.answer
+
             sentence_query_engine = build_sentence_window_query_engine(
                 self.senders_wa_id, 
                 self.cohere_api_key, 
@@ -159,11 +313,19 @@ class RealtyaiBot:
                 self.qdrant_api_key, 
                 self.qdrant_collection_name
             )
-            window_response = sentence_query_engine.query(query)
+            query_bundle = QueryBundle(query_str=query, embedding=query_embedding)
+            prefetched = self._take_prefetch(query_embedding)
+            if prefetched is not None:
+                # Only the answer is left to synthesize.
+                window_response = sentence_query_engine.synthesize(query_bundle, prefetched.nodes)
+            else:
+                window_response = sentence_query_engine.query(query_bundle)
 
-            for node in window_response.source_nodes:
+            sources = [node.metadata.get("source", "_blank") for node in window_response.source_nodes]
+            for source in sources:
                 if len(self.citations) < 2:
-                    self.citations.append(node.metadata.get("source", "_blank"))
+                    self.citations.append(source)
+            answer_cache.store(self.senders_wa_id, query, query_embedding, str(window_response.response), sources, time.perf_counter() - started_at)
             return str(window_response.response)
         except Exception as e:
             logging.error(f"An error occurred in the rag tool: {e}")
@@ -187,7 +349,7 @@ class RealtyaiBot:
                 result_str += "\n"+doc.page_content+"\n"
                 # if len(self.citations) < 2:
                 #     self.citations.append(shorten_url(doc.metadata.get("source", "")))
-            self.dynamodb.add_message(SystemMessage(content=f"These contexts might help you:\n\n{result_str}"))
+            self.dynamodb.add_message(artifact_message(self.artifact_store, f"These contexts might help you:\n\n{result_str}"))
             return result_str
         except Exception as e:
             logging.error(f"An error occurred in the Search tool: {e}")
@@ -205,16 +367,19 @@ class RealtyaiBot:
         except Exception as e:
             logging.error(f"An error occurred whike sending status update message of retrieve tool: {e}")
         try:
-            node_retriever = build_index_retriever(
-                self.senders_wa_id,
-                self.cohere_api_key, 
-                self.openai_api_key, 
-                self.qdrant_url, 
-                self.qdrant_api_key, 
-                self.qdrant_collection_name
-            )
-            nodes = node_retriever.retrieve(str_or_query_bundle=query)
-            final_media_ids = merge_nodes_to_source(nodes)
+            final_media_ids = self._match_catalog(query)
+            if not final_media_ids:
+                # Documents indexed before the catalog existed are only found by a search over their sentences.
+                node_retriever = build_index_retriever(
+                    self.senders_wa_id,
+                    self.cohere_api_key, 
+                    self.openai_api_key, 
+                    self.qdrant_url, 
+                    self.qdrant_api_key, 
+                    self.qdrant_collection_name
+                )
+                nodes = node_retriever.retrieve(str_or_query_bundle=query)
+                final_media_ids = merge_nodes_to_source(nodes)
             if len(final_media_ids)>0:
                 for each_id in final_media_ids:
                     if each_id != "_blank":
@@ -245,26 +410,40 @@ class RealtyaiBot:
         except Exception as e:
             logging.error(f"An error occurred in the retrieve tool: {e}")
             return "_Failed the retrieval_"
+    def _match_catalog(self, query: str) -> List[str]:
+        # Media IDs/URLs of the user's documents matching the query in the document catalog, a lookup over the
+        # user's few documents instead of a vector search and rerank over all their sentences.
+        catalog = get_document_catalog()
+        if catalog is None or not catalog.entries(self.senders_wa_id):
+            return []
+        try:
+            # Served by the query embedding cache when a speculative retrieval embedded the same message.
+            query_embedding = get_embed_model(self.openai_api_key).get_query_embedding(query)
+        except Exception as e:
+            logging.error(f"An error occurred while embedding the query of the retrieve tool, matching keywords only: {e}")
+            query_embedding = None
+        return [entry.media_id for entry in catalog.search(self.senders_wa_id, query, query_embedding)]
+
     def _prune_long_messages(self, messages):
-        curr_buffer_length = self.llm.get_num_tokens_from_messages(messages)
-        if curr_buffer_length > self.max_token_length:
-            while curr_buffer_length > self.max_token_length:
-                messages.pop(0)
-                curr_buffer_length = self.llm.get_num_tokens_from_messages(messages)
-        return messages
+        # Drops the oldest messages until the rest fit in max_token_length, using the token counts stored with each message.
+        return prune_messages_to_token_limit(messages, self.max_token_length)
 
             
 if __name__ == "__main__":
     from dotenv import load_dotenv
     import os
+    load_dotenv()
     bot = RealtyaiBot(
-            "91xxxxxxxxxx", 
-            os.getenv("OPENAI_API_KEY"), 
-            os.getenv("AWS_ACCESS_KEY_ID"), 
-            os.getenv("AWS_SECRET_ACCESS_KEY"),
-            os.getenv("QDRANT_API_KEY"),
-            os.getenv("QDRANT_URL"),
-            os.getenv("QDRANT_COLLECTION_NAME"),
-            os.getenv("WHATSAPP_VERSION"),
-            os.getenv("WHATSAPP_ACCESS_TOKEN")
+            openai_api_key=os.getenv("OPENAI_API_KEY"), 
+            cohere_api_key=os.getenv("COHERE_API_KEY"),
+            aws_access_key_id=os.getenv("AWS_ACCESS_KEY_ID"), 
+            aws_secret_access_key=os.getenv("AWS_SECRET_ACCESS_KEY"),
+            qdrant_api_key=os.getenv("QDRANT_API_KEY"),
+            qdrant_url=os.getenv("QDRANT_URL"),
+            qdrant_collection_name=os.getenv("COLLECTION_NAME"),
+            whatsapp_version=os.getenv("WHATSAPP_VERSION"),
+            whatsapp_access_token=os.getenv("WHATSAPP_ACCESS_TOKEN"),
+            whatsapp_phone_number_id=os.getenv("WHATSAPP_PHONE_NUMBER_ID"),
+            dynamo_db_table_name=os.getenv("DYNAMODB_TABLE_NAME")
         )
+    print(bot("Hello!", "91xxxxxxxxxx"))
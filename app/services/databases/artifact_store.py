@@ -0,0 +1,113 @@
+import hashlib
+import logging
+import threading
+from typing import Dict, Iterable, List, Optional
+from cachetools import LRUCache
+from langchain_core.messages import BaseMessage, SystemMessage
+from app.services.databases.dynamodb_setup import get_dynamodb_table
+from app.services.service_utilities import tiktoken_len, TOKENS_PER_MESSAGE
+
+def artifact_id(text: str) -> str:
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+class DynamoDBArtifactStore:
+    """
+        Content-addressed store for large texts that used to be inlined into the chat history: search tool
+        results and the summaries of ingested PDFs and URLs. Each text is stored once under the sha256 of its
+        content (partition key "ArtifactId"), and the history only keeps a short reference message to it.
+        Recently used texts are kept in an in-process LRU cache.
+    """
+    def __init__(
+        self,
+        table_name: str,
+        aws_access_key_id: str,
+        aws_secret_access_key: str,
+        region_name: Optional[str] = None,
+        cache_size: int = 256
+    ):
+        self.table_name = table_name
+        self.aws_access_key_id = aws_access_key_id
+        self.aws_secret_access_key = aws_secret_access_key
+        self.region_name = region_name
+        self._cache = LRUCache(maxsize=cache_size)
+        self._lock = threading.Lock()
+
+    @property
+    def table(self):
+        return get_dynamodb_table(self.table_name, self.aws_access_key_id, self.aws_secret_access_key, self.region_name)
+
+    def put(self, text: str) -> str:
+        """Store the text and return its ID. Storing the same content again is a no-op."""
+        _artifact_id = artifact_id(text)
+        with self._lock:
+            if _artifact_id in self._cache:
+                return _artifact_id
+        self.table.put_item(Item={"ArtifactId": _artifact_id, "Content": text})
+        with self._lock:
+            self._cache[_artifact_id] = text
+        return _artifact_id
+
+    def get_many(self, artifact_ids: Iterable[str]) -> Dict[str, str]:
+        """Texts of the given IDs. IDs that could not be found are left out."""
+        found = {}
+        missing = []
+        with self._lock:
+            for _artifact_id in set(artifact_ids):
+                if _artifact_id in self._cache:
+                    found[_artifact_id] = self._cache[_artifact_id]
+                else:
+                    missing.append(_artifact_id)
+        for _artifact_id in missing:
+            try:
+                response = self.table.get_item(Key={"ArtifactId": _artifact_id})
+            except Exception as e:
+                logging.error(f"Error retrieving artifact from dynamoDB: {e}")
+                continue
+            if "Item" in response:
+                found[_artifact_id] = response["Item"]["Content"]
+                with self._lock:
+                    self._cache[_artifact_id] = found[_artifact_id]
+        return found
+
+def artifact_message(store: Optional[DynamoDBArtifactStore], content: str, preview_chars: int = 160) -> SystemMessage:
+    """
+        Chat history message for a large text. With a store, the text goes to the store and the message only
+        carries a short preview and the artifact ID. Without one, the text is inlined as before.
+    """
+    content_token_count = tiktoken_len(content) + TOKENS_PER_MESSAGE
+    if store is None:
+        return SystemMessage(content=content, additional_kwargs={"token_count": content_token_count})
+    try:
+        _artifact_id = store.put(content)
+    except Exception as e:
+        logging.error(f"Error storing artifact, keeping it inline in the chat history: {e}")
+        return SystemMessage(content=content, additional_kwargs={"token_count": content_token_count})
+    preview = content[:preview_chars] + ("..." if len(content) > preview_chars else "")
+    message = SystemMessage(
+        content=f"[Stored context {_artifact_id[:12]}] {preview}",
+        additional_kwargs={"artifact_id": _artifact_id, "artifact_token_count": content_token_count}
+    )
+    message.additional_kwargs["token_count"] = tiktoken_len(message.content) + TOKENS_PER_MESSAGE
+    return message
+
+def expand_artifact_messages(store: Optional[DynamoDBArtifactStore], messages: List[BaseMessage]) -> List[BaseMessage]:
+    """
+        Replace the reference messages in `messages` with the full texts they point to. Meant to be called on
+        the recent window only, right before the prompt is built. Unresolvable references are left as they are.
+    """
+    artifact_ids = [m.additional_kwargs["artifact_id"] for m in messages if m.additional_kwargs.get("artifact_id")]
+    if store is None or not artifact_ids:
+        return messages
+    contents = store.get_many(artifact_ids)
+    expanded = []
+    for message in messages:
+        _artifact_id = message.additional_kwargs.get("artifact_id")
+        if _artifact_id in contents:
+            message = SystemMessage(
+                content=contents[_artifact_id],
+                additional_kwargs={"token_count": message.additional_kwargs.get("artifact_token_count")}
+            )
+            if message.additional_kwargs["token_count"] is None:
+                del message.additional_kwargs["token_count"]
+        expanded.append(message)
+    return expanded
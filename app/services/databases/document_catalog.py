@@ -0,0 +1,170 @@
+import logging
+import math
+import os
+import re
+import sqlite3
+import threading
+from array import array
+from dataclasses import dataclass, field, replace
+from typing import Callable, Dict, List, Optional
+
+# Words of "send me the pdf about X" requests that say nothing about which document is meant.
+_STOP_WORDS = {
+    "a", "an", "and", "about", "can", "could", "doc", "document", "file", "for", "give", "i", "it", "link", "me", "my",
+    "of", "on", "pdf", "please", "send", "share", "that", "the", "this", "to", "url", "was", "what", "which", "with", "you"
+}
+
+@dataclass
+class CatalogEntry:
+    """One document a user can retrieve: what the Retrieve tool sends back, and what it is matched on."""
+    group_id: str
+    # Media ID of a PDF or address of a URL, what is sent back to the user.
+    media_id: str
+    source_type: str
+    filename: str
+    caption: str
+    url: str
+    date: str
+    summary: str
+    # Normalised embedding of the file name, caption and summary.
+    embedding: List[float] = field(default_factory=list)
+
+    def keywords(self) -> set:
+        return _keywords(f"{self.filename} {self.caption} {self.url}")
+
+def _keywords(text: str) -> set:
+    return {word for word in re.findall(r"\w+", text.lower()) if len(word) > 1 and word not in _STOP_WORDS}
+
+def _normalise(vector: List[float]) -> List[float]:
+    norm = math.sqrt(sum(v * v for v in vector)) or 1.0
+    return [v / norm for v in vector]
+
+class DocumentCatalog:
+    """
+        Compact catalog of the documents indexed for each user, one entry per PDF or URL, persisted in SQLite and
+        kept in memory per user once looked up. The Retrieve tool resolves "send me the PDF about X" against the
+        few entries of the user (summary embedding similarity plus keyword matches on the file name, caption and
+        URL) instead of a sentence level vector search.
+        `embed_text` embeds the text an entry is matched on, a failing embedding leaves the entry keyword-only.
+        Several processes may share the file: the cached entries are dropped whenever another connection wrote to it.
+    """
+    def __init__(self, path: str, embed_text: Optional[Callable[[str], List[float]]] = None, min_score: float = 0.45, keyword_weight: float = 0.3, tie_margin: float = 0.02):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS catalog (group_id TEXT NOT NULL, media_id TEXT NOT NULL, source_type TEXT NOT NULL, "
+            "filename TEXT NOT NULL, caption TEXT NOT NULL, url TEXT NOT NULL, date TEXT NOT NULL, summary TEXT NOT NULL, "
+            "embedding BLOB, PRIMARY KEY (group_id, media_id))"
+        )
+        self._connection.commit()
+        self._lock = threading.Lock()
+        # group_id -> media_id -> entry, for the users looked up or written since startup.
+        self._entries: Dict[str, Dict[str, CatalogEntry]] = {}
+        # Changes whenever another connection commits to the database, see _load.
+        self._data_version = self._connection.execute("PRAGMA data_version").fetchone()[0]
+        self.embed_text = embed_text
+        self.min_score = min_score
+        self.keyword_weight = keyword_weight
+        self.tie_margin = tie_margin
+
+    def _load(self, group_id: str) -> Dict[str, CatalogEntry]:
+        # Called with the lock held.
+        data_version = self._connection.execute("PRAGMA data_version").fetchone()[0]
+        if data_version != self._data_version:
+            # Another process (eg. a worker that just indexed a document) wrote to the catalog.
+            self._entries.clear()
+            self._data_version = data_version
+        entries = self._entries.get(group_id)
+        if entries is None:
+            rows = self._connection.execute(
+                "SELECT group_id, media_id, source_type, filename, caption, url, date, summary, embedding FROM catalog WHERE group_id = ?",
+                (group_id,)
+            ).fetchall()
+            entries = {row[1]: CatalogEntry(*row[:8], list(array("f", row[8])) if row[8] else []) for row in rows}
+            self._entries[group_id] = entries
+        return entries
+
+    def _write(self, entry: CatalogEntry) -> None:
+        # Called with the lock held.
+        self._connection.execute(
+            "INSERT OR REPLACE INTO catalog (group_id, media_id, source_type, filename, caption, url, date, summary, embedding) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (entry.group_id, entry.media_id, entry.source_type, entry.filename, entry.caption, entry.url, entry.date,
+             entry.summary, array("f", entry.embedding).tobytes() if entry.embedding else None)
+        )
+        self._connection.commit()
+        self._load(entry.group_id)[entry.media_id] = entry
+
+    def entries(self, group_id: str) -> List[CatalogEntry]:
+        with self._lock:
+            return list(self._load(group_id).values())
+
+    def add(self, metadata: dict, summary: str) -> None:
+        """
+            Catalog a fully indexed document from the metadata stored with its nodes (see pdf_document_metadata and
+            url_document_metadata). A shared document (list of group_ids) is cataloged for each of its users.
+        """
+        is_url = metadata.get("source_type") == "url"
+        entry = CatalogEntry(
+            group_id="",
+            media_id=metadata["media_id"],
+            source_type=metadata.get("source_type", "document"),
+            filename="" if is_url else metadata.get("source", ""),
+            caption=metadata.get("caption") or "",
+            url=metadata["media_id"] if is_url else "",
+            date=metadata.get("date", ""),
+            summary=summary or ""
+        )
+        if self.embed_text is not None:
+            try:
+                entry.embedding = _normalise(self.embed_text(f"{entry.filename or entry.url}\n{entry.caption}\n{entry.summary}"))
+            except Exception as e:
+                logging.error(f"An error occurred while embedding the catalog entry of {entry.media_id}: {e}")
+        group_ids = metadata["group_id"] if isinstance(metadata["group_id"], list) else [metadata["group_id"]]
+        with self._lock:
+            for group_id in group_ids:
+                self._write(replace(entry, group_id=group_id))
+
+    def share(self, media_id: str, group_id: str) -> None:
+        """Catalog for another user a document already cataloged for someone else (shared URL corpus)."""
+        with self._lock:
+            row = self._connection.execute("SELECT group_id FROM catalog WHERE media_id = ? LIMIT 1", (media_id,)).fetchone()
+            if row is None or media_id in self._load(group_id):
+                return
+            self._write(replace(self._load(row[0])[media_id], group_id=group_id))
+
+    def search(self, group_id: str, query: str, query_embedding: Optional[List[float]] = None) -> List[CatalogEntry]:
+        """
+            Best matching documents of the user: the best one, and any other scoring within tie_margin of it.
+            Empty unless the best one shares a keyword with the query or its embedding similarity is at least
+            min_score, so that the caller falls back to a sentence search rather than send an unrelated document.
+        """
+        query_keywords = _keywords(query)
+        query_embedding = _normalise(query_embedding) if query_embedding else None
+        scored = []
+        for entry in self.entries(group_id):
+            similarity = 0.0
+            if query_embedding is not None and entry.embedding:
+                similarity = sum(a * b for a, b in zip(query_embedding, entry.embedding))
+            matched_keywords = len(query_keywords & entry.keywords())
+            score = similarity + (self.keyword_weight * matched_keywords / len(query_keywords) if query_keywords else 0.0)
+            scored.append((score, matched_keywords > 0 or similarity >= self.min_score, entry))
+        if not scored:
+            return []
+        scored.sort(key=lambda item: item[0], reverse=True)
+        best, confident, _ = scored[0]
+        if not confident:
+            return []
+        return [entry for score, _, entry in scored if score >= best - self.tie_margin]
+
+_document_catalog: Optional[DocumentCatalog] = None
+
+def configure_document_catalog(path: Optional[str], embed_text: Optional[Callable[[str], List[float]]] = None, **kwargs) -> None:
+    global _document_catalog
+    _document_catalog = DocumentCatalog(path, embed_text, **kwargs) if path else None
+
+def get_document_catalog() -> Optional[DocumentCatalog]:
+    return _document_catalog
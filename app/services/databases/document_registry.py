@@ -0,0 +1,253 @@
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from dataclasses import dataclass
+from typing import Dict, IO, List, Optional, Tuple, Union
+
+# group_id under which the documents of the shared URL corpus are recorded.
+SHARED_CORPUS_GROUP = "*"
+
+@dataclass
+class DocumentRecord:
+    group_id: str
+    # Media ID of a PDF or address of a URL.
+    source_key: str
+    content_hash: str
+    # ref_doc_id of the document's points in the vector store.
+    doc_id: str
+    summary: str
+    indexed_at: float
+
+@dataclass
+class UrlState:
+    """What was fetched and indexed the last time a tracked URL was refreshed."""
+    group_id: str
+    source_key: str
+    caption: str
+    etag: Optional[str]
+    last_modified: Optional[str]
+    content_hash: str
+    # Hash of the first characters of the page, the part the summary is generated from.
+    head_hash: str
+    # Point ID -> hash of the sentence and window stored in that point.
+    points: Dict[str, str]
+    fetched_at: float
+
+def content_fingerprint(content: Union[str, bytes]) -> str:
+    if isinstance(content, str):
+        content = content.encode("utf-8")
+    return hashlib.sha256(content).hexdigest()
+
+def file_fingerprint(file: Union[str, IO[bytes]], chunk_size: int = 1024 * 1024) -> str:
+    """sha256 of a file (path or binary file object). A file object is rewound to where it was."""
+    hasher = hashlib.sha256()
+    if isinstance(file, str):
+        with open(file, "rb") as f:
+            for chunk in iter(lambda: f.read(chunk_size), b""):
+                hasher.update(chunk)
+        return hasher.hexdigest()
+    position = file.tell()
+    for chunk in iter(lambda: file.read(chunk_size), b""):
+        hasher.update(chunk)
+    file.seek(position)
+    return hasher.hexdigest()
+
+class DocumentRegistry:
+    """
+        Fingerprints of the documents indexed for each user, keyed by (group_id, source key) and searchable by
+        content hash, so that a document already in a user's index is not fetched, summarised and embedded again.
+        Records are only written once a document is fully indexed.
+    """
+    def __init__(self, path: str):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS documents ("
+            "group_id TEXT NOT NULL, source_key TEXT NOT NULL, content_hash TEXT NOT NULL, doc_id TEXT NOT NULL, "
+            "summary TEXT NOT NULL, indexed_at REAL NOT NULL, PRIMARY KEY (group_id, source_key))"
+        )
+        self._connection.execute("CREATE INDEX IF NOT EXISTS documents_by_hash ON documents (group_id, content_hash)")
+        # Users who can see a document of the shared corpus.
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS members (source_key TEXT NOT NULL, group_id TEXT NOT NULL, PRIMARY KEY (source_key, group_id))"
+        )
+        # Validators and indexed sentences of the URLs kept up to date by url_refresh.
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS url_state (group_id TEXT NOT NULL, source_key TEXT NOT NULL, caption TEXT NOT NULL, etag TEXT, "
+            "last_modified TEXT, content_hash TEXT NOT NULL, head_hash TEXT NOT NULL, points TEXT NOT NULL, "
+            "fetched_at REAL NOT NULL, PRIMARY KEY (group_id, source_key))"
+        )
+        # Sources being ingested right now, by whichever process or thread claimed them, see claimed().
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS claims (source_key TEXT PRIMARY KEY, owner TEXT NOT NULL, expires_at REAL NOT NULL)"
+        )
+        self._connection.commit()
+        self._lock = threading.Lock()
+
+    def _fetch_one(self, where: str, params: tuple) -> Optional[DocumentRecord]:
+        with self._lock:
+            row = self._connection.execute(
+                f"SELECT group_id, source_key, content_hash, doc_id, summary, indexed_at FROM documents WHERE {where} "
+                "ORDER BY indexed_at DESC LIMIT 1",
+                params
+            ).fetchone()
+        return DocumentRecord(*row) if row else None
+
+    def get(self, group_id: str, source_key: str) -> Optional[DocumentRecord]:
+        return self._fetch_one("group_id = ? AND source_key = ?", (group_id, source_key))
+
+    def find_by_content(self, group_id: str, content_hash: str) -> Optional[DocumentRecord]:
+        """The user's document with this exact content, whatever media ID or URL it came from."""
+        return self._fetch_one("group_id = ? AND content_hash = ?", (group_id, content_hash))
+
+    def record(self, group_id: str, source_key: str, content_hash: str, doc_id: str, summary: str) -> None:
+        with self._lock:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO documents (group_id, source_key, content_hash, doc_id, summary, indexed_at) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (group_id, source_key, content_hash, doc_id, summary or "", time.time())
+            )
+            self._connection.commit()
+
+    def forget(self, group_id: str, source_key: str) -> None:
+        with self._lock:
+            self._connection.execute("DELETE FROM documents WHERE group_id = ? AND source_key = ?", (group_id, source_key))
+            self._connection.commit()
+
+    def members(self, source_key: str) -> List[str]:
+        with self._lock:
+            rows = self._connection.execute("SELECT group_id FROM members WHERE source_key = ? ORDER BY group_id", (source_key,)).fetchall()
+        return [row[0] for row in rows]
+
+    def add_member(self, source_key: str, group_id: str) -> None:
+        with self._lock:
+            self._connection.execute("INSERT OR IGNORE INTO members (source_key, group_id) VALUES (?, ?)", (source_key, group_id))
+            self._connection.commit()
+
+    def get_url_state(self, group_id: str, source_key: str) -> Optional[UrlState]:
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT group_id, source_key, caption, etag, last_modified, content_hash, head_hash, points, fetched_at "
+                "FROM url_state WHERE group_id = ? AND source_key = ?",
+                (group_id, source_key)
+            ).fetchone()
+        if row is None:
+            return None
+        return UrlState(*row[:7], json.loads(row[7]), row[8])
+
+    def save_url_state(self, state: UrlState) -> None:
+        with self._lock:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO url_state "
+                "(group_id, source_key, caption, etag, last_modified, content_hash, head_hash, points, fetched_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (state.group_id, state.source_key, state.caption or "", state.etag, state.last_modified, state.content_hash,
+                 state.head_hash, json.dumps(state.points), state.fetched_at)
+            )
+            self._connection.commit()
+
+    def try_claim(self, source_key: str, owner: str, ttl_seconds: float) -> bool:
+        """
+            Claim a source for `ttl_seconds`, unless someone else holds an unexpired claim on it. The check and the
+            write are one statement, so two processes sharing the database can not both get the claim.
+        """
+        now = time.time()
+        with self._lock:
+            cursor = self._connection.execute(
+                "INSERT INTO claims (source_key, owner, expires_at) VALUES (?, ?, ?) "
+                "ON CONFLICT (source_key) DO UPDATE SET owner = excluded.owner, expires_at = excluded.expires_at "
+                "WHERE claims.expires_at < ? OR claims.owner = excluded.owner",
+                (source_key, owner, now + ttl_seconds, now)
+            )
+            self._connection.commit()
+        return cursor.rowcount == 1
+
+    def release_claim(self, source_key: str, owner: str) -> None:
+        with self._lock:
+            self._connection.execute("DELETE FROM claims WHERE source_key = ? AND owner = ?", (source_key, owner))
+            self._connection.commit()
+
+    def tracked_urls(self, fetched_before: Optional[float] = None) -> List[Tuple[str, str]]:
+        """(group_id, URL) of the tracked URLs, optionally only those last fetched before a time."""
+        with self._lock:
+            rows = self._connection.execute(
+                "SELECT group_id, source_key FROM url_state WHERE fetched_at < ? ORDER BY fetched_at",
+                (fetched_before if fetched_before is not None else float("inf"),)
+            ).fetchall()
+        return [tuple(row) for row in rows]
+
+@contextmanager
+def claimed(registry: DocumentRegistry, source_key: str, ttl_seconds: float = 900, poll_seconds: float = 0.5):
+    """
+        Hold the registry claim on a source for the duration of the block, waiting while another process or thread
+        holds it. A claim left behind by a crashed process expires after `ttl_seconds`.
+    """
+    owner = f"{os.getpid()}-{uuid.uuid4().hex}"
+    while not registry.try_claim(source_key, owner, ttl_seconds):
+        time.sleep(poll_seconds)
+    try:
+        yield
+    finally:
+        registry.release_claim(source_key, owner)
+
+def delete_document_points(vector_store, doc_id: str) -> None:
+    """Delete every point of a document (ref_doc_id) from the vector store, and its sentences from the sentence store."""
+    from app.services.databases.sentence_store import get_sentence_store
+    try:
+        vector_store.delete(doc_id)
+        if get_sentence_store() is not None:
+            get_sentence_store().delete_document(doc_id)
+    except Exception as e:
+        logging.error(f"An error occurred while deleting the points of document {doc_id}: {e}")
+
+def commit_document(
+    registry: DocumentRegistry,
+    vector_store,
+    group_id: str,
+    source_key: str,
+    content_hash: str,
+    doc_id: str,
+    summary: str,
+    metadata: Optional[dict] = None,
+    replaces: bool = True
+) -> None:
+    """
+        Record a fully indexed document. If it replaces an earlier version of the same source, the old points are
+        deleted only now, after the new ones are stored, so searches never see the document missing.
+        Sources that never come back with new content (replaces=False, eg. PDFs, see record_pdf_ingestion) are
+        recorded without looking for an earlier version.
+        With the metadata of its nodes, the document is also added to the users' document catalog.
+    """
+    from app.services.databases.document_catalog import get_document_catalog
+    previous = registry.get(group_id, source_key) if replaces else None
+    registry.record(group_id, source_key, content_hash, doc_id, summary)
+    if metadata is not None and get_document_catalog() is not None:
+        try:
+            get_document_catalog().add(metadata, summary)
+        except Exception as e:
+            logging.error(f"An error occurred while adding {source_key} to the document catalog: {e}")
+    if previous is not None and previous.doc_id != doc_id:
+        delete_document_points(vector_store, previous.doc_id)
+        logging.info(f"Replaced document {previous.doc_id} of {source_key} with {doc_id}.")
+
+def excerpt_summary(text: str, max_chars: int = 500) -> str:
+    """Stand-in summary of a document whose summary could not be generated: its first words, cut at a word boundary."""
+    text = " ".join(text.split())
+    if len(text) <= max_chars:
+        return text
+    return text[:max_chars].rsplit(" ", 1)[0] + "..."
+
+def discard_document(registry: DocumentRegistry, vector_store, group_id: str, source_key: str, doc_id: str) -> None:
+    """Delete the points of a failed ingestion, unless they belong to the version of the document on record."""
+    previous = registry.get(group_id, source_key)
+    if previous is None or previous.doc_id != doc_id:
+        delete_document_points(vector_store, doc_id)
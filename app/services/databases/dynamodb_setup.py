@@ -1,4 +1,4 @@
-from typing import List
+from typing import List, Optional, Tuple
 from langchain_core.messages import (
     BaseMessage,
     message_to_dict,
@@ -8,8 +8,43 @@ from langchain_core.messages import (
     HumanMessage
 )
 import logging
+import os
+import threading
+import time
 from langchain_core.chat_history import BaseChatMessageHistory
 
+# boto3 resources are not thread safe, so every worker thread keeps its own resource per table.
+_thread_local = threading.local()
+
+def get_dynamodb_resource(aws_access_key_id: str, aws_secret_access_key: str, region_name: Optional[str] = None):
+  """
+    boto3 DynamoDB resource. The region defaults to DYNAMODB_REGION, and DYNAMODB_ENDPOINT_URL points it at
+    another endpoint than AWS, eg. DynamoDB Local.
+  """
+  try:
+    import boto3
+  except ImportError as e:
+    raise ImportError(
+        "Unable to import boto3, please install with `pip install boto3`"
+    ) from e
+  return boto3.resource(
+    'dynamodb',
+    aws_access_key_id=aws_access_key_id,
+    aws_secret_access_key=aws_secret_access_key,
+    region_name=region_name or os.getenv("DYNAMODB_REGION", "ap-south-1"),
+    endpoint_url=os.getenv("DYNAMODB_ENDPOINT_URL") or None
+  )
+
+def get_dynamodb_table(table_name: str, aws_access_key_id: str, aws_secret_access_key: str, region_name: Optional[str] = None):
+  """Return this thread's DynamoDB Table for the given credentials, creating the boto3 resource on first use."""
+  tables = getattr(_thread_local, "tables", None)
+  if tables is None:
+    tables = _thread_local.tables = {}
+  key = (table_name, aws_access_key_id, aws_secret_access_key, region_name, os.getenv("DYNAMODB_ENDPOINT_URL"))
+  if key not in tables:
+    tables[key] = get_dynamodb_resource(aws_access_key_id, aws_secret_access_key, region_name).Table(table_name)
+  return tables[key]
+
 class DynamoDBSessionManagement:
   def __init__(
       self,
@@ -18,22 +53,15 @@ class DynamoDBSessionManagement:
       aws_access_key_id: str,
       aws_secret_access_key: str,
       primary_key_name: str = "SessionId",
-      region_name: str = "ap-south-1"
+      region_name: Optional[str] = None
       ):
-    try:
-      import boto3
-    except ImportError as e:
-      raise ImportError(
-          "Unable to import boto3, please install with `pip install boto3`"
-      ) from e
-    client = boto3.resource('dynamodb', aws_access_key_id=aws_access_key_id, aws_secret_access_key=aws_secret_access_key, region_name=region_name)
-    self.table = client.Table(table_name)
+    self.table = get_dynamodb_table(table_name, aws_access_key_id, aws_secret_access_key, region_name)
     self.session_id = session_id
     self.key = {primary_key_name: session_id}
 
 
-  def messages(self) -> List[BaseMessage]:
-    """Retrieve Messages from DynamoDB"""
+  def messages(self, limit: Optional[int] = None) -> List[BaseMessage]:
+    """Retrieve Messages from DynamoDB. When limit is given only the last `limit` messages are returned."""
     response = None
     try:
       response = self.table.get_item(Key=self.key)
@@ -43,9 +71,26 @@ class DynamoDBSessionManagement:
       items = response["Item"]["History"]
     else:
       items = []
+    if limit is not None:
+      items = items[-limit:] if limit > 0 else []
     messages = messages_from_dict(items)
     return messages
   
+  def add_messages(self, messages: List[BaseMessage]) -> None:
+    """Append several messages to the record in DynamoDB with a single write"""
+    _messages = messages_to_dict(self.messages()) + messages_to_dict(messages)
+    try:
+      self.table.put_item(Item={**self.key, "History": _messages})
+    except Exception as e:
+      logging.error(f"Error adding messages to DynamoDB: {e}")
+
+  def replace_messages(self, messages: List[BaseMessage]) -> None:
+    """Overwrite the whole history of the session, eg. after compacting it"""
+    try:
+      self.table.put_item(Item={**self.key, "History": messages_to_dict(messages)})
+    except Exception as e:
+      logging.error(f"Error replacing messages in DynamoDB: {e}")
+
   def add_message(self, message: BaseMessage) -> None:
      """Append the message to the record in DynamoDB"""
      # get_item() and put_item()
@@ -64,5 +109,273 @@ class DynamoDBSessionManagement:
     except Exception as e:
       logging.error(f"Error clearing session memory from dynamoDB: {e}")
 
-    
 
+class DynamoDBAppendOnlySessionManagement:
+  """
+    Chat history stored as one item per message instead of one item per session.
+    Items are keyed by the session ID (partition key) and a numeric, increasing message key (sort key), so that:
+      - appending is a blind put of the new messages, no read-modify-write of the whole history,
+      - reading the last N messages is a single descending Query with a Limit,
+      - the history is no longer bound by the 400 KB item size limit.
+    The table must be created with both keys, see create_append_only_table().
+    The item at MARKER_KEY, above any message key, is not a message but the session's marker: the key the visible
+    history starts at, and while replace_messages() is writing, the range of keys it is writing to, which readers
+    skip. Being the newest item of the session, it comes first in the descending Query that reads the history.
+  """
+  MARKER_KEY = 10 ** 20
+
+  def __init__(
+      self,
+      table_name: str,
+      session_id: str,
+      aws_access_key_id: str,
+      aws_secret_access_key: str,
+      primary_key_name: str = "SessionId",
+      sort_key_name: str = "MessageKey",
+      region_name: Optional[str] = None
+      ):
+    self.table = get_dynamodb_table(table_name, aws_access_key_id, aws_secret_access_key, region_name)
+    self.session_id = session_id
+    self.primary_key_name = primary_key_name
+    self.sort_key_name = sort_key_name
+
+  def _query(self, attributes: Optional[str] = None, start: int = 1, end: Optional[int] = None) -> List[dict]:
+    """Items of the session with keys from `start` to `end` (included), newest first."""
+    from boto3.dynamodb.conditions import Key
+    sort_key = Key(self.sort_key_name).gte(start) if end is None else Key(self.sort_key_name).between(start, end)
+    kwargs = {
+      "KeyConditionExpression": Key(self.primary_key_name).eq(self.session_id) & sort_key,
+      "ScanIndexForward": False
+    }
+    if attributes:
+      kwargs["ProjectionExpression"] = attributes
+    items = []
+    while True:
+      response = self.table.query(**kwargs)
+      items.extend(response.get("Items", []))
+      if "LastEvaluatedKey" not in response:
+        return items
+      kwargs["ExclusiveStartKey"] = response["LastEvaluatedKey"]
+
+  def _marker_key(self) -> dict:
+    return {self.primary_key_name: self.session_id, self.sort_key_name: self.MARKER_KEY}
+
+  def _marker(self) -> dict:
+    return self.table.get_item(Key=self._marker_key()).get("Item", {})
+
+  def _put_marker(self, history_start: int, pending: Optional[Tuple[int, int]] = None) -> None:
+    item = {**self._marker_key(), "HistoryStart": history_start}
+    if pending is not None:
+      item["PendingFrom"], item["PendingTo"] = pending
+    self.table.put_item(Item=item)
+
+  @staticmethod
+  def _pending(marker: dict) -> Optional[Tuple[int, int]]:
+    if "PendingFrom" not in marker:
+      return None
+    return int(marker["PendingFrom"]), int(marker["PendingTo"])
+
+  def _read_history(self, limit: Optional[int] = None) -> List[dict]:
+    """Message items of the visible history, newest first, read together with the marker in one descending Query."""
+    from boto3.dynamodb.conditions import Key
+    kwargs = {
+      "KeyConditionExpression": Key(self.primary_key_name).eq(self.session_id) & Key(self.sort_key_name).gte(1),
+      "ScanIndexForward": False
+    }
+    marker = None
+    items = []
+    while True:
+      if limit is not None:
+        # One more item for the marker, until it was seen.
+        kwargs["Limit"] = limit - len(items) + (1 if marker is None else 0)
+      response = self.table.query(**kwargs)
+      for item in response.get("Items", []):
+        key = int(item[self.sort_key_name])
+        if key == self.MARKER_KEY:
+          marker = item
+          continue
+        marker = marker if marker is not None else {}
+        if key < int(marker.get("HistoryStart", 1)):
+          # Everything older is hidden, left over by replace_messages().
+          return items
+        pending = self._pending(marker)
+        if pending is None or not pending[0] <= key <= pending[1]:
+          items.append(item)
+      if "LastEvaluatedKey" not in response or (limit is not None and len(items) >= limit):
+        return items[:limit] if limit is not None else items
+      kwargs["ExclusiveStartKey"] = response["LastEvaluatedKey"]
+
+  def messages(self, limit: Optional[int] = None) -> List[BaseMessage]:
+    """Retrieve Messages from DynamoDB. When limit is given only the last `limit` messages are read."""
+    if limit is not None and limit <= 0:
+      return []
+    items = []
+    try:
+      items = self._read_history(limit)
+    except Exception as e:
+      logging.error(f"Error retrieving messages from dynamoDB: {e}")
+    return messages_from_dict([item["Message"] for item in reversed(items)])
+
+  def _put_messages(self, messages: List[BaseMessage], keys: Optional[List[int]] = None) -> None:
+    keys = keys or next_message_keys(len(messages))
+    with self.table.batch_writer() as batch:
+      for message, key in zip(messages, keys):
+        batch.put_item(Item={
+          self.primary_key_name: self.session_id,
+          self.sort_key_name: key,
+          "Message": message_to_dict(message)
+        })
+
+  def add_messages(self, messages: List[BaseMessage]) -> None:
+    """Append the messages as new items with a single batched write"""
+    try:
+      self._put_messages(messages)
+    except Exception as e:
+      logging.error(f"Error adding messages to DynamoDB: {e}")
+
+  def add_message(self, message: BaseMessage) -> None:
+    """Append the message to the session in DynamoDB"""
+    self.add_messages([message])
+
+  def _delete_items(self, items: List[dict]) -> None:
+    with self.table.batch_writer() as batch:
+      for item in items:
+        batch.delete_item(Key={self.primary_key_name: item[self.primary_key_name], self.sort_key_name: item[self.sort_key_name]})
+
+  def replace_messages(self, messages: List[BaseMessage]) -> None:
+    """
+      Overwrite the whole history of the session, eg. after compacting it. Readers see either the old or the new
+      history, never both, whichever step fails:
+        1. the marker reserves the keys of the new messages, readers skip them,
+        2. the new messages are written to those keys,
+        3. the marker moves the start of the history to the first new key, in a single write,
+        4. the old messages, now hidden, are deleted.
+      A retry after a failure deletes what the failed attempt wrote (or left hidden) and starts over.
+    """
+    keys_only = f"{self.primary_key_name}, {self.sort_key_name}"
+    try:
+      marker = self._marker()
+      history_start = int(marker.get("HistoryStart", 1))
+      stale = self._pending(marker)
+      if stale is not None:
+        # Messages of an attempt that failed before step 3, never visible.
+        self._delete_items(self._query(attributes=keys_only, start=stale[0], end=stale[1]))
+      keys = next_message_keys(len(messages)) if messages else [next_message_key()]
+      if messages:
+        self._put_marker(history_start, pending=(keys[0], keys[-1]))
+        self._put_messages(messages, keys)
+      self._put_marker(keys[0])
+      self._delete_items(self._query(attributes=keys_only, start=1, end=keys[0] - 1))
+    except Exception as e:
+      logging.error(f"Error replacing messages in DynamoDB: {e}")
+
+  def clear(self) -> None:
+    """Clear session memory from dynamoDB"""
+    try:
+      self._delete_items(self._query(attributes=f"{self.primary_key_name}, {self.sort_key_name}"))
+    except Exception as e:
+      logging.error(f"Error clearing session memory from dynamoDB: {e}")
+
+
+_message_key_lock = threading.Lock()
+_last_message_key = 0
+
+def next_message_key() -> int:
+  """Sort key for a new message: the current time in microseconds, strictly increasing within the process."""
+  return next_message_keys(1)[0]
+
+def next_message_keys(count: int) -> List[int]:
+  """`count` consecutive sort keys for new messages, no other message of the process gets a key in between."""
+  global _last_message_key
+  with _message_key_lock:
+    first = max(time.time_ns() // 1000, _last_message_key + 1)
+    _last_message_key = first + count - 1
+    return list(range(first, first + count))
+
+def get_session_history(
+    table_name: str,
+    session_id: str,
+    aws_access_key_id: str,
+    aws_secret_access_key: str,
+    storage_mode: str = "single_item"
+    ):
+  """
+    Return the chat history handler for the configured storage layout.
+    storage_mode - "single_item" (the whole history in one item) or "item_per_message".
+  """
+  if storage_mode == "item_per_message":
+    return DynamoDBAppendOnlySessionManagement(table_name, session_id, aws_access_key_id, aws_secret_access_key)
+  return DynamoDBSessionManagement(table_name, session_id, aws_access_key_id, aws_secret_access_key)
+
+def create_append_only_table(
+    table_name: str,
+    aws_access_key_id: str,
+    aws_secret_access_key: str,
+    primary_key_name: str = "SessionId",
+    sort_key_name: str = "MessageKey",
+    region_name: Optional[str] = None
+    ):
+  """Create the table used by DynamoDBAppendOnlySessionManagement (on-demand capacity)."""
+  table = get_dynamodb_resource(aws_access_key_id, aws_secret_access_key, region_name).create_table(
+    TableName=table_name,
+    KeySchema=[
+      {"AttributeName": primary_key_name, "KeyType": "HASH"},
+      {"AttributeName": sort_key_name, "KeyType": "RANGE"}
+    ],
+    AttributeDefinitions=[
+      {"AttributeName": primary_key_name, "AttributeType": "S"},
+      {"AttributeName": sort_key_name, "AttributeType": "N"}
+    ],
+    BillingMode="PAY_PER_REQUEST"
+  )
+  table.wait_until_exists()
+  return table
+
+def migrate_to_append_only(
+    source_table_name: str,
+    target_table_name: str,
+    aws_access_key_id: str,
+    aws_secret_access_key: str,
+    primary_key_name: str = "SessionId",
+    region_name: Optional[str] = None
+    ) -> int:
+  """
+    Copy every session of a single item table into an item per message table, preserving the order of the messages.
+    The source table is left untouched, so the migration can be re-run and the switch reverted.
+    Returns the number of migrated sessions.
+  """
+  source_table = get_dynamodb_table(source_table_name, aws_access_key_id, aws_secret_access_key, region_name)
+  migrated = 0
+  scan_kwargs = {}
+  while True:
+    response = source_table.scan(**scan_kwargs)
+    for item in response.get("Items", []):
+      target = DynamoDBAppendOnlySessionManagement(
+        target_table_name,
+        item[primary_key_name],
+        aws_access_key_id,
+        aws_secret_access_key,
+        primary_key_name=primary_key_name,
+        region_name=region_name
+      )
+      # Re-running the migration must not duplicate a session's history.
+      target.clear()
+      target.add_messages(messages_from_dict(item.get("History", [])))
+      migrated += 1
+    if "LastEvaluatedKey" not in response:
+      return migrated
+    scan_kwargs["ExclusiveStartKey"] = response["LastEvaluatedKey"]
+
+if __name__ == "__main__":
+  # Usage: python -m app.services.databases.dynamodb_setup <single item table> <item per message table>
+  import os
+  import sys
+  from dotenv import load_dotenv
+  load_dotenv()
+  source_table_name, target_table_name = sys.argv[1], sys.argv[2]
+  aws_access_key_id, aws_secret_access_key = os.getenv("AWS_ACCESS_KEY_ID"), os.getenv("AWS_SECRET_ACCESS_KEY")
+  try:
+    create_append_only_table(target_table_name, aws_access_key_id, aws_secret_access_key)
+  except Exception as e:
+    logging.warning(f"Could not create {target_table_name}, assuming it already exists: {e}")
+  print(f"Migrated {migrate_to_append_only(source_table_name, target_table_name, aws_access_key_id, aws_secret_access_key)} sessions.")
@@ -0,0 +1,120 @@
+import logging
+from dataclasses import dataclass
+from typing import List, Optional
+
+# Payload fields filtered on by the retrievers (group_id), the document registry (doc_id) and the catalog lookups.
+KEYWORD_INDEX_FIELDS = ["group_id", "media_id", "source_type", "doc_id"]
+# text-embedding-3-small
+DEFAULT_VECTOR_SIZE = 1536
+
+@dataclass
+class CollectionSettings:
+    vector_size: int = DEFAULT_VECTOR_SIZE
+    # int8 scalar quantization: 4x smaller vectors in RAM, with the original vectors kept for rescoring.
+    quantization: bool = True
+    quantile: float = 0.99
+    # Keep the original vectors (and the HNSW graph) on disk, memory mapped, and only the quantized ones in RAM.
+    on_disk: bool = False
+    # Every query is filtered on one user's group_id, so instead of one global HNSW graph (m) a graph is built
+    # per group_id value (payload_m). Unfiltered searches fall back to the payload indexes.
+    tenant_hnsw: bool = True
+    m: int = 16
+    ef_construct: int = 100
+
+def _hnsw_config(settings: CollectionSettings):
+    from qdrant_client.http import models
+    return models.HnswConfigDiff(
+        m=0 if settings.tenant_hnsw else settings.m,
+        payload_m=settings.m if settings.tenant_hnsw else None,
+        ef_construct=settings.ef_construct,
+        on_disk=settings.on_disk
+    )
+
+def _quantization_config(settings: CollectionSettings):
+    from qdrant_client.http import models
+    if not settings.quantization:
+        return None
+    return models.ScalarQuantization(
+        scalar=models.ScalarQuantizationConfig(
+            type=models.ScalarType.INT8,
+            quantile=settings.quantile,
+            always_ram=True
+        )
+    )
+
+def collection_exists(client, collection_name: str) -> bool:
+    return collection_name in [collection.name for collection in client.get_collections().collections]
+
+def create_payload_indexes(client, collection_name: str, fields: List[str] = KEYWORD_INDEX_FIELDS) -> None:
+    """Keyword payload indexes on the filtered fields. Creating an index that already exists is a no-op."""
+    from qdrant_client.http import models
+    existing = client.get_collection(collection_name).payload_schema or {}
+    for field in fields:
+        if field in existing:
+            continue
+        client.create_payload_index(collection_name, field_name=field, field_schema=models.PayloadSchemaType.KEYWORD, wait=True)
+        logging.info(f"Created keyword payload index on {field}.")
+
+def bootstrap_collection(client, collection_name: str, settings: Optional[CollectionSettings] = None) -> str:
+    """
+        Create the collection with the given settings, or migrate an existing one to them. The payload indexes
+        are created first on a new collection, so the per-tenant graphs are built as points come in.
+        Returns "created" or "migrated".
+        Searches without explicit search params (eg. LlamaIndex's QdrantVectorStore) let Qdrant decide whether
+        to rescore quantized results, quantized_search_params() asks for it explicitly.
+    """
+    from qdrant_client.http import models
+    settings = settings or CollectionSettings()
+    if not collection_exists(client, collection_name):
+        client.create_collection(
+            collection_name=collection_name,
+            vectors_config=models.VectorParams(size=settings.vector_size, distance=models.Distance.COSINE, on_disk=settings.on_disk),
+            hnsw_config=_hnsw_config(settings),
+            quantization_config=_quantization_config(settings),
+            on_disk_payload=settings.on_disk
+        )
+        create_payload_indexes(client, collection_name)
+        return "created"
+
+    # Indexes first, the HNSW graphs rebuilt by the update below then use them.
+    create_payload_indexes(client, collection_name)
+    client.update_collection(
+        collection_name=collection_name,
+        vectors_config={"": models.VectorParamsDiff(on_disk=settings.on_disk)},
+        hnsw_config=_hnsw_config(settings),
+        quantization_config=_quantization_config(settings) or models.Disabled.DISABLED
+    )
+    return "migrated"
+
+def quantized_search_params(oversampling: float = 2.0):
+    """Search params reading the quantized vectors, then rescoring the best candidates with the original ones."""
+    from qdrant_client.http import models
+    return models.SearchParams(quantization=models.QuantizationSearchParams(rescore=True, oversampling=oversampling))
+
+if __name__ == "__main__":
+    # Usage: python -m app.services.databases.qdrant_bootstrap [collection] [--on-disk] [--no-quantization] [--global-hnsw]
+    import argparse
+    import os
+    from dotenv import load_dotenv
+    from app.services.databases.qdrant_setup import configure_qdrant_path, get_qdrant_client
+    load_dotenv()
+    parser = argparse.ArgumentParser(description="Create or migrate the Qdrant collection used by the sentence window index.")
+    parser.add_argument("collection", nargs="?", default=os.getenv("COLLECTION_NAME"))
+    parser.add_argument("--vector-size", type=int, default=DEFAULT_VECTOR_SIZE)
+    parser.add_argument("--on-disk", action="store_true", help="Keep the original vectors and the HNSW graph on disk (mmap).")
+    parser.add_argument("--no-quantization", action="store_true", help="Do not quantize the vectors.")
+    parser.add_argument("--quantile", type=float, default=0.99)
+    parser.add_argument("--global-hnsw", action="store_true", help="Build one HNSW graph for all users instead of one per group_id.")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    configure_qdrant_path(os.getenv("QDRANT_PATH"))
+    client = get_qdrant_client(os.getenv("QDRANT_URL"), os.getenv("QDRANT_API_KEY"))
+    result = bootstrap_collection(client, args.collection, CollectionSettings(
+        vector_size=args.vector_size,
+        quantization=not args.no_quantization,
+        quantile=args.quantile,
+        on_disk=args.on_disk,
+        tenant_hnsw=not args.global_hnsw
+    ))
+    print(f"Collection {args.collection} {result}.")
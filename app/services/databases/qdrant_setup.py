@@ -1,149 +1,274 @@
-import logging
-
-# Function to build a Vector Store Index. This index is powered by LlamaIndex Sentence Window Retrieval.
-# Any document added to this index will be parsed using a node parser.
-def build_sentence_window_index(openai_api_key:str, qdrant_url:str, qdrant_api_key:str, qdrant_collection_name:str):
-    import openai
-    from llama_index.embeddings import FastEmbedEmbedding
-    from llama_index.embeddings import OpenAIEmbedding
-    from llama_index.llms import OpenAI
-    import qdrant_client
-    from llama_index.node_parser import SentenceWindowNodeParser
-    from llama_index.vector_stores.qdrant import QdrantVectorStore
-    from llama_index import (
-            ServiceContext,
-            VectorStoreIndex
-    )
-
-    try:
-        openai.api_key = openai_api_key
-        client = qdrant_client.QdrantClient(
-            url = qdrant_url,
-            api_key = qdrant_api_key,
-            timeout=60
-        )
-        llm = OpenAI(model = "gpt-3.5-turbo", temperature = 0.1, max_tokens=128)
-
-        # Create an instance of the embedding model to be used.
-        # Qdrant FastEmbed offers quantized models which are more optimal for CPU.
-        # Another option is to go with OpenAIEmbeddings.
-        # embed_model = FastEmbedEmbedding(model_name="BAAI/bge-small-en-v1.5")
-        embed_model = OpenAIEmbedding(model_name="text-embedding-3-small")
-
-        # Creating an instance of the SentenceWindowNodeParser. Each node will have a key called "window" in its metadata section
-        # that contains a window of sentences surrounding the original sentence.
-        sentence_node_parser = SentenceWindowNodeParser.from_defaults(
-                            window_size = 4,
-                            window_metadata_key = "window",
-                            original_text_metadata_key= "original_text"
-                        )
-        # Wrapping up all the tools and components into a service context, making them accessible to the Vector Store Index.
-        sentence_context = ServiceContext.from_defaults(
-                    llm=llm,
-                    embed_model = embed_model,
-                    node_parser=sentence_node_parser
-                )
-        # Passing the qdrant client we created earlier to an instance of the LlamaIndex QdrantVectorStore class.
-        vector_store = QdrantVectorStore(client=client, collection_name=qdrant_collection_name)
-        # Creating the sentence index using the vector store and the service context we just created.
-        sentence_index = VectorStoreIndex.from_vector_store(vector_store=vector_store, service_context=sentence_context, use_async=True, show_progress=True)
-        return sentence_index
-    except Exception as e:
-        logging.error(f"An error occurred while builing the sentence window index: {e}")
-
-# Function to build a Llama Index query engine.
-def build_sentence_window_query_engine(
-        senders_wa_id:str, 
-        cohere_api_key:str, 
-        openai_api_key:str, 
-        qdrant_url:str, 
-        qdrant_api_key:str, 
-        qdrant_collection_name:str, 
-        similarity_top_k=6, 
-        rerank_top_n=2
-    ):
-    from llama_index.postprocessor.cohere_rerank import CohereRerank
-    from llama_index.indices.postprocessor import MetadataReplacementPostProcessor
-    from llama_index.vector_stores.types import MetadataFilters, ExactMatchFilter
-    from app.services.databases.qdrant_setup import build_sentence_window_index
-    
-    # First we start by creating a Vector Store Index
-    sentence_index = build_sentence_window_index(openai_api_key, qdrant_url, qdrant_api_key, qdrant_collection_name)
-    # Creating a metadata replcacement post processor. This post processor is designed by Llama Index specially to perform 
-    # sentence window retrieval. It replaces the content of the original text with thoese in the "window" key.
-    postproc = MetadataReplacementPostProcessor(
-        target_metadata_key="window"
-    )
-    # We are loading the reranker model that assigns new similarity scores to the chunks retrieved from the vector store.
-    cohere_rerank = CohereRerank(api_key=cohere_api_key, top_n=rerank_top_n)
-    # Finally we can build the query engine using the post processors we just created.
-    # We are performing metadata based filtering, thereby separating the vectors belonging to different users.
-    # User's whatsapp ID ie. phone number is used to perform this partition. 
-    sentence_window_engine = sentence_index.as_query_engine(
-                                filters=MetadataFilters(
-                                    filters=[
-                                        ExactMatchFilter(
-                                            key="group_id",
-                                            value=senders_wa_id,
-                                        )
-                                    ]
-                                ),
-                                similarity_top_k=similarity_top_k, 
-                                node_postprocessors=[postproc, cohere_rerank]
-                            )
-    return sentence_window_engine
-
-# Function to build a node retriever. This will be useful to do file retrieval.
-def build_index_retriever(
-        senders_wa_id:str, 
-        cohere_api_key:str,
-        openai_api_key:str, 
-        qdrant_url:str, 
-        qdrant_api_key:str, 
-        qdrant_collection_name:str, 
-        similarity_top_k=6, 
-        rerank_top_n=3
-    ):
-    from llama_index.vector_stores.types import MetadataFilters, ExactMatchFilter
-    from app.services.databases.qdrant_setup import build_sentence_window_index
-    from llama_index.indices.postprocessor import MetadataReplacementPostProcessor
-    from llama_index.postprocessor.cohere_rerank import CohereRerank
-    postproc = MetadataReplacementPostProcessor(
-        target_metadata_key="window"
-    )
-    index = build_sentence_window_index(openai_api_key, qdrant_url, qdrant_api_key, qdrant_collection_name)
-    cohere_rerank = CohereRerank(api_key=cohere_api_key, top_n=rerank_top_n)
-    node_retriever = index.as_retriever(
-                                filters=MetadataFilters(
-                                    filters=[
-                                        ExactMatchFilter(
-                                            key="group_id",
-                                            value=senders_wa_id,
-                                        )
-                                    ]
-                                ),
-                                similarity_top_k=similarity_top_k,
-                                node_postprocessors=[postproc, cohere_rerank]
-                            )
-    return node_retriever
-
-# Function to establish a connection with qdrant and return a qdrant index.
-def load_qdrant_connection(qdrant_url: str, qdrant_api_key:str, qdrant_collection_name:str):
-    try:
-        import qdrant_client
-        from langchain.vectorstores import Qdrant
-        from langchain_community.embeddings.fastembed import FastEmbedEmbeddings
-        # https://python.langchain.com/docs/integrations/text_embedding/fastembed
-        embeddings = FastEmbedEmbeddings(model_name = "BAAI/bge-small-en-v1.5")
-        client = qdrant_client.QdrantClient(
-            url = qdrant_url,
-            api_key=qdrant_api_key, # For Qdrant Cloud, None for local instance
-            timeout=10
-        )
-        qdrant_index = Qdrant(client=client, collection_name=qdrant_collection_name, embeddings=embeddings)
-        return qdrant_index
-    except Exception as e:
-        logging.error(f"An error occurred while establishing connection to vector database: {e}")
-
-if __name__ == "__main__":
+import logging
+import threading
+
+class ComponentRegistry:
+    """
+        Process-wide registry of the heavy objects behind the sentence window index: Qdrant clients, embedding models,
+        service contexts, vector store indexes and rerankers. Each object is built lazily on first use, once per process
+        and per configuration, and then shared by every request. All of them are safe to share between threads.
+    """
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._components = {}
+
+    def get_or_create(self, key: tuple, factory):
+        component = self._components.get(key)
+        if component is not None:
+            return component
+        with self._lock:
+            # Check again, another thread may have built it while we were waiting for the lock.
+            component = self._components.get(key)
+            if component is None:
+                component = factory()
+                self._components[key] = component
+            return component
+
+    def clear(self):
+        with self._lock:
+            self._components.clear()
+
+registry = ComponentRegistry()
+
+# Directory (or ":memory:") of qdrant-client's embedded mode, None to connect to the Qdrant server at qdrant_url.
+_qdrant_path = None
+
+def configure_qdrant_path(path):
+    global _qdrant_path
+    _qdrant_path = path or None
+
+def is_local_qdrant() -> bool:
+    """Whether Qdrant runs embedded in the process (QDRANT_PATH is set) rather than as a server."""
+    return _qdrant_path is not None
+
+def get_qdrant_client(qdrant_url:str, qdrant_api_key:str, timeout:int = 60):
+    """
+        Shared Qdrant client. The client keeps its own pool of HTTP connections.
+        In local mode, the points live in this process (in memory or in the configured directory) and qdrant_url is
+        not used. A local storage can only be opened by one client, so there is one client for it, whatever the timeout.
+    """
+    def factory():
+        import qdrant_client
+        if is_local_qdrant():
+            if _qdrant_path == ":memory:":
+                return qdrant_client.QdrantClient(location = ":memory:")
+            return qdrant_client.QdrantClient(path = _qdrant_path)
+        return qdrant_client.QdrantClient(
+            url = qdrant_url,
+            api_key = qdrant_api_key,
+            timeout=timeout
+        )
+    if is_local_qdrant():
+        return registry.get_or_create(("qdrant_client", "local", _qdrant_path), factory)
+    return registry.get_or_create(("qdrant_client", qdrant_url, qdrant_api_key, timeout), factory)
+
+def get_embed_model(openai_api_key:str):
+    """Shared embedding model used for both indexing and querying."""
+    def factory():
+        from llama_index.embeddings import OpenAIEmbedding
+        from app.services.embedding_service import build_cached_embed_model, embedding_settings
+        if embedding_settings.backend == "fake":
+            # Deterministic offline vectors, for tests and benchmarks without an OpenAI key.
+            return build_cached_embed_model(None, "fake")
+        # Qdrant FastEmbed offers quantized models which are more optimal for CPU.
+        # Another option is to go with OpenAIEmbeddings.
+        # embed_model = FastEmbedEmbedding(model_name="BAAI/bge-small-en-v1.5")
+        # Document embeddings go through the batched, cached embedding engine, see embedding_service. The engine
+        # retries failed batches itself, the client's own retries would multiply with them.
+        return build_cached_embed_model(
+            OpenAIEmbedding(model_name="text-embedding-3-small", api_key=openai_api_key, max_retries=0),
+            "text-embedding-3-small"
+        )
+    return registry.get_or_create(("embed_model", openai_api_key), factory)
+
+def get_sentence_window_service_context(openai_api_key:str):
+    """Shared service context holding the LLM, the embedding model and the sentence window node parser."""
+    def factory():
+        from llama_index.llms import OpenAI
+        from llama_index.node_parser import SentenceWindowNodeParser
+        from llama_index import ServiceContext
+        llm = OpenAI(model = "gpt-3.5-turbo", temperature = 0.1, max_tokens=128, api_key=openai_api_key)
+        # Creating an instance of the SentenceWindowNodeParser. Each node will have a key called "window" in its metadata section
+        # that contains a window of sentences surrounding the original sentence.
+        sentence_node_parser = SentenceWindowNodeParser.from_defaults(
+                            window_size = 4,
+                            window_metadata_key = "window",
+                            original_text_metadata_key= "original_text"
+                        )
+        # Wrapping up all the tools and components into a service context, making them accessible to the Vector Store Index.
+        return ServiceContext.from_defaults(
+                    llm=llm,
+                    embed_model = get_embed_model(openai_api_key),
+                    node_parser=sentence_node_parser
+                )
+    return registry.get_or_create(("service_context", openai_api_key), factory)
+
+def get_sentence_splitter():
+    """Shared sentence splitter, the one SentenceWindowNodeParser uses by default."""
+    def factory():
+        from llama_index.node_parser.text.utils import split_by_sentence_tokenizer
+        return split_by_sentence_tokenizer()
+    return registry.get_or_create(("sentence_splitter",), factory)
+
+def get_cohere_rerank(cohere_api_key:str, top_n:int):
+    """Shared Cohere reranker for the given number of results."""
+    def factory():
+        from llama_index.postprocessor.cohere_rerank import CohereRerank
+        return CohereRerank(api_key=cohere_api_key, top_n=top_n)
+    return registry.get_or_create(("cohere_rerank", cohere_api_key, top_n), factory)
+
+def get_reranker(cohere_api_key:str, top_n:int):
+    """
+        Shared rerank stage. Cohere is only called when the vector scores leave the order open, and a local
+        lexical reranker takes over when Cohere is not configured or fails. See app.services.reranking.
+    """
+    def factory():
+        from app.services.reranking import build_adaptive_rerank_postprocessor
+        cohere_rerank = None
+        if cohere_api_key:
+            try:
+                cohere_rerank = get_cohere_rerank(cohere_api_key, top_n)
+            except Exception as e:
+                logging.error(f"Cohere rerank is not available, using the lexical reranker: {e}")
+        return build_adaptive_rerank_postprocessor(cohere_rerank, top_n)
+    return registry.get_or_create(("reranker", cohere_api_key, top_n), factory)
+
+def get_window_postprocessors():
+    """
+        Post processors turning each retrieved sentence into its window of sentences. With the compact window
+        storage, the windows are first rebuilt from the sentence store.
+    """
+    from app.services.databases.sentence_store import get_sentence_store, build_window_rebuild_postprocessor
+    sentence_store = get_sentence_store()
+    if sentence_store is None:
+        return [get_window_replacement_postprocessor()]
+    rebuild = registry.get_or_create(("window_rebuild_postprocessor", id(sentence_store)), lambda: build_window_rebuild_postprocessor(sentence_store))
+    return [rebuild, get_window_replacement_postprocessor()]
+
+def get_window_replacement_postprocessor():
+    """Shared post processor that swaps each retrieved sentence for its window of sentences."""
+    def factory():
+        from llama_index.indices.postprocessor import MetadataReplacementPostProcessor
+        return MetadataReplacementPostProcessor(target_metadata_key="window")
+    return registry.get_or_create(("window_postprocessor",), factory)
+
+# Function to build a Vector Store Index. This index is powered by LlamaIndex Sentence Window Retrieval.
+# Any document added to this index will be parsed using a node parser.
+# The index is built once per process and configuration, later calls return the shared instance.
+def build_sentence_window_index(openai_api_key:str, qdrant_url:str, qdrant_api_key:str, qdrant_collection_name:str):
+    def factory():
+        import openai
+        from llama_index.vector_stores.qdrant import QdrantVectorStore
+        from llama_index import VectorStoreIndex
+
+        openai.api_key = openai_api_key
+        client = get_qdrant_client(qdrant_url, qdrant_api_key)
+        if is_local_qdrant():
+            # Nobody provisions a local storage, create the collection on first use.
+            from app.services.databases.qdrant_bootstrap import bootstrap_collection, collection_exists
+            if not collection_exists(client, qdrant_collection_name):
+                bootstrap_collection(client, qdrant_collection_name)
+        # Passing the shared qdrant client to an instance of the LlamaIndex QdrantVectorStore class.
+        vector_store = QdrantVectorStore(client=client, collection_name=qdrant_collection_name)
+        # Creating the sentence index using the vector store and the shared service context.
+        return VectorStoreIndex.from_vector_store(
+            vector_store=vector_store,
+            service_context=get_sentence_window_service_context(openai_api_key),
+            use_async=True,
+            show_progress=True
+        )
+
+    try:
+        return registry.get_or_create(
+            ("sentence_window_index", openai_api_key, qdrant_url, qdrant_api_key, qdrant_collection_name),
+            factory
+        )
+    except Exception as e:
+        logging.error(f"An error occurred while builing the sentence window index: {e}")
+
+# Function to build a Llama Index query engine.
+def build_sentence_window_query_engine(
+        senders_wa_id:str, 
+        cohere_api_key:str, 
+        openai_api_key:str, 
+        qdrant_url:str, 
+        qdrant_api_key:str, 
+        qdrant_collection_name:str, 
+        similarity_top_k=6, 
+        rerank_top_n=2
+    ):
+    from llama_index.vector_stores.types import MetadataFilters, ExactMatchFilter
+    
+    # First we start by fetching the shared Vector Store Index
+    sentence_index = build_sentence_window_index(openai_api_key, qdrant_url, qdrant_api_key, qdrant_collection_name)
+    # Metadata replcacement post processor. This post processor is designed by Llama Index specially to perform 
+    # sentence window retrieval. It replaces the content of the original text with thoese in the "window" key.
+    window_postprocs = get_window_postprocessors()
+    # The reranker model that assigns new similarity scores to the chunks retrieved from the vector store.
+    reranker = get_reranker(cohere_api_key, rerank_top_n)
+    # Finally we can build the query engine using the post processors we just created.
+    # We are performing metadata based filtering, thereby separating the vectors belonging to different users.
+    # User's whatsapp ID ie. phone number is used to perform this partition. 
+    sentence_window_engine = sentence_index.as_query_engine(
+                                filters=MetadataFilters(
+                                    filters=[
+                                        ExactMatchFilter(
+                                            key="group_id",
+                                            value=senders_wa_id,
+                                        )
+                                    ]
+                                ),
+                                similarity_top_k=similarity_top_k, 
+                                node_postprocessors=window_postprocs + [reranker]
+                            )
+    return sentence_window_engine
+
+# Function to build a node retriever. This will be useful to do file retrieval.
+def build_index_retriever(
+        senders_wa_id:str, 
+        cohere_api_key:str,
+        openai_api_key:str, 
+        qdrant_url:str, 
+        qdrant_api_key:str, 
+        qdrant_collection_name:str, 
+        similarity_top_k=6, 
+        rerank_top_n=3
+    ):
+    from llama_index.vector_stores.types import MetadataFilters, ExactMatchFilter
+    # The heavy components are shared, only the per-user filter below is built per call.
+    window_postprocs = get_window_postprocessors()
+    index = build_sentence_window_index(openai_api_key, qdrant_url, qdrant_api_key, qdrant_collection_name)
+    reranker = get_reranker(cohere_api_key, rerank_top_n)
+    node_retriever = index.as_retriever(
+                                filters=MetadataFilters(
+                                    filters=[
+                                        ExactMatchFilter(
+                                            key="group_id",
+                                            value=senders_wa_id,
+                                        )
+                                    ]
+                                ),
+                                similarity_top_k=similarity_top_k,
+                                node_postprocessors=window_postprocs + [reranker]
+                            )
+    return node_retriever
+
+# Function to establish a connection with qdrant and return a qdrant index.
+def load_qdrant_connection(qdrant_url: str, qdrant_api_key:str, qdrant_collection_name:str):
+    try:
+        from langchain.vectorstores import Qdrant
+        from langchain_community.embeddings.fastembed import FastEmbedEmbeddings
+        # https://python.langchain.com/docs/integrations/text_embedding/fastembed
+        embeddings = registry.get_or_create(
+            ("fastembed", "BAAI/bge-small-en-v1.5"),
+            lambda: FastEmbedEmbeddings(model_name = "BAAI/bge-small-en-v1.5")
+        )
+        # api_key is for Qdrant Cloud, None for local instance. In local mode (QDRANT_PATH), this shares the
+        # embedded storage of the sentence window index.
+        client = get_qdrant_client(qdrant_url, qdrant_api_key, timeout=10)
+        qdrant_index = Qdrant(client=client, collection_name=qdrant_collection_name, embeddings=embeddings)
+        return qdrant_index
+    except Exception as e:
+        logging.error(f"An error occurred while establishing connection to vector database: {e}")
+
+if __name__ == "__main__":
     pass
\ No newline at end of file
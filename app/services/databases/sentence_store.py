@@ -0,0 +1,101 @@
+import os
+import sqlite3
+import threading
+from typing import Dict, Iterable, List, Optional, Tuple
+
+class SentenceStore:
+    """
+        Sentences of every indexed document, by document ID and position. In the compact window storage, Qdrant
+        points only carry their sentence and its position, and the window of sentences around a retrieved
+        sentence is rebuilt from this store at query time instead of being duplicated in every point's payload.
+    """
+    def __init__(self, path: str):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS sentences (doc_id TEXT NOT NULL, position INTEGER NOT NULL, sentence TEXT NOT NULL, "
+            "PRIMARY KEY (doc_id, position)) WITHOUT ROWID"
+        )
+        self._connection.commit()
+        self._lock = threading.Lock()
+
+    def put(self, doc_id: str, sentences: Iterable[Tuple[int, str]]) -> None:
+        """Store (position, sentence) pairs of a document, overwriting what was stored at those positions."""
+        with self._lock:
+            self._connection.executemany(
+                "INSERT OR REPLACE INTO sentences (doc_id, position, sentence) VALUES (?, ?, ?)",
+                [(doc_id, position, sentence) for position, sentence in sentences]
+            )
+            self._connection.commit()
+
+    def truncate(self, doc_id: str, length: int) -> None:
+        """Drop the sentences of a document from position `length` on, left over by a longer earlier version."""
+        with self._lock:
+            self._connection.execute("DELETE FROM sentences WHERE doc_id = ? AND position >= ?", (doc_id, length))
+            self._connection.commit()
+
+    def delete_document(self, doc_id: str) -> None:
+        self.truncate(doc_id, 0)
+
+    def windows(self, requests: List[Tuple[str, int]], window_size: int = 4) -> Dict[Tuple[str, int], str]:
+        """Window of `window_size` sentences on each side of each (doc_id, position). Unknown documents are left out."""
+        found = {}
+        with self._lock:
+            for doc_id, position in set(requests):
+                rows = self._connection.execute(
+                    "SELECT sentence FROM sentences WHERE doc_id = ? AND position BETWEEN ? AND ? ORDER BY position",
+                    (doc_id, position - window_size, position + window_size)
+                ).fetchall()
+                if rows:
+                    found[(doc_id, position)] = " ".join(row[0] for row in rows)
+        return found
+
+# Store of the compact window storage, None while windows are stored inline in the points' payload.
+_sentence_store: Optional[SentenceStore] = None
+
+def configure_sentence_store(path: Optional[str]) -> None:
+    global _sentence_store
+    _sentence_store = SentenceStore(path) if path else None
+
+def get_sentence_store() -> Optional[SentenceStore]:
+    return _sentence_store
+
+def build_window_rebuild_postprocessor(sentence_store: SentenceStore, window_size: int = 4):
+    """
+        Node post processor that fills in the "window" and "original_text" metadata of compact points from the
+        sentence store, so that MetadataReplacementPostProcessor, which runs after it, works as with inline windows.
+        Points that already carry their window are left untouched.
+    """
+    from llama_index.postprocessor.types import BaseNodePostprocessor
+    from llama_index.bridge.pydantic import PrivateAttr
+
+    class SentenceWindowRebuildPostprocessor(BaseNodePostprocessor):
+        _sentence_store: SentenceStore = PrivateAttr()
+        _window_size: int = PrivateAttr()
+
+        def __init__(self, sentence_store: SentenceStore, window_size: int):
+            super().__init__()
+            self._sentence_store = sentence_store
+            self._window_size = window_size
+
+        @classmethod
+        def class_name(cls) -> str:
+            return "SentenceWindowRebuildPostprocessor"
+
+        def _postprocess_nodes(self, nodes, query_bundle=None):
+            compact = [n for n in nodes if "window" not in n.node.metadata and "sentence_position" in n.node.metadata]
+            windows = self._sentence_store.windows(
+                [(n.node.ref_doc_id, n.node.metadata["sentence_position"]) for n in compact],
+                self._window_size
+            )
+            for n in compact:
+                sentence = n.node.get_content()
+                # Without a stored window, the sentence alone is used.
+                n.node.metadata["window"] = windows.get((n.node.ref_doc_id, n.node.metadata["sentence_position"]), sentence)
+                n.node.metadata["original_text"] = sentence
+            return nodes
+
+    return SentenceWindowRebuildPostprocessor(sentence_store, window_size)
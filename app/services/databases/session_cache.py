@@ -0,0 +1,198 @@
+import logging
+import threading
+import time
+from collections import OrderedDict
+from typing import Callable, List, Optional
+from langchain_core.messages import BaseMessage
+
+
+class _CachedSession:
+    def __init__(self, history):
+        self.history = history
+        self.messages: Optional[List[BaseMessage]] = None
+        self.pending: List[BaseMessage] = []
+        # Messages added while rewrite() transforms a snapshot of the history, None when no rewrite is running.
+        self.added_during_rewrite: Optional[List[BaseMessage]] = None
+        self.last_access = time.monotonic()
+        self.lock = threading.RLock()
+
+
+class CachedSessionHistory:
+    """
+        Chat history of one user served from memory. Reads never go to DynamoDB once the session is loaded,
+        and writes are only buffered until flush() writes all of them with a single call.
+        It exposes the same methods as DynamoDBSessionManagement so it can be used in its place.
+    """
+    def __init__(self, cache: "SessionHistoryCache", session_id: str):
+        self.cache = cache
+        self.session_id = session_id
+
+    def messages(self, limit: Optional[int] = None) -> List[BaseMessage]:
+        session = self.cache._get(self.session_id)
+        with session.lock:
+            if session.messages is None:
+                # Messages buffered before the first read are not in storage yet.
+                session.messages = (session.history.messages(limit=self.cache.window) + session.pending)[-self.cache.window:]
+            messages = list(session.messages)
+        if limit is not None:
+            messages = messages[-limit:] if limit > 0 else []
+        return messages
+
+    def add_messages(self, messages: List[BaseMessage]) -> None:
+        session = self.cache._get(self.session_id)
+        with session.lock:
+            session.pending.extend(messages)
+            if session.added_during_rewrite is not None:
+                session.added_during_rewrite.extend(messages)
+            if session.messages is not None:
+                session.messages = (session.messages + list(messages))[-self.cache.window:]
+
+    def add_message(self, message: BaseMessage) -> None:
+        self.add_messages([message])
+
+    def clear(self) -> None:
+        session = self.cache._get(self.session_id)
+        with session.lock:
+            session.pending = []
+            session.messages = []
+            # A running rewrite would bring back the history from before the clear.
+            session.added_during_rewrite = None
+            session.history.clear()
+
+    def flush(self) -> None:
+        self.cache.flush(self.session_id)
+
+
+class SessionHistoryCache:
+    """
+        Bounded, write-behind cache of chat histories in front of DynamoDB, keyed by the user's whatsapp ID.
+        Arguments:
+            history_factory - Builds the storage backed history of a session, eg. get_session_history(...).
+            max_sessions - Number of sessions kept in memory. The least recently used one is flushed and evicted first.
+            ttl_seconds - Sessions idle for longer than this are flushed and reloaded from storage on next use.
+            window - Number of most recent messages kept in memory per session.
+    """
+    def __init__(
+        self,
+        history_factory: Callable[[str], object],
+        max_sessions: int = 1000,
+        ttl_seconds: int = 900,
+        window: int = 20
+    ):
+        self.history_factory = history_factory
+        self.max_sessions = max_sessions
+        self.ttl_seconds = ttl_seconds
+        self.window = window
+        self._sessions: "OrderedDict[str, _CachedSession]" = OrderedDict()
+        # Evicted sessions whose buffered messages are being written. A session used again before its flush
+        # finishes is taken back from here, so that it is never reloaded from storage without those messages.
+        self._draining: "dict[str, _CachedSession]" = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def session(self, session_id: str) -> CachedSessionHistory:
+        return CachedSessionHistory(self, session_id)
+
+    def _get(self, session_id: str) -> _CachedSession:
+        evicted = []
+        with self._lock:
+            session = self._sessions.get(session_id)
+            now = time.monotonic()
+            if session is not None and now - session.last_access > self.ttl_seconds:
+                # Expired, drop it so that it is reloaded from storage. Its pending messages are still flushed below.
+                evicted.append(self._sessions.pop(session_id))
+                session = None
+            if session is None:
+                self.misses += 1
+                session = self._draining.pop(session_id, None) or _CachedSession(self.history_factory(session_id))
+                self._sessions[session_id] = session
+                while len(self._sessions) > self.max_sessions:
+                    evicted_id, evicted_session = self._sessions.popitem(last=False)
+                    self._draining[evicted_id] = evicted_session
+                    evicted.append(evicted_session)
+            else:
+                self.hits += 1
+                self._sessions.move_to_end(session_id)
+            session.last_access = now
+        for evicted_session in evicted:
+            self._flush_session(evicted_session)
+        if evicted:
+            with self._lock:
+                for evicted_id, evicted_session in list(self._draining.items()):
+                    if evicted_session in evicted:
+                        del self._draining[evicted_id]
+        return session
+
+    def _flush_session(self, session: _CachedSession) -> None:
+        with session.lock:
+            if not session.pending:
+                return
+            pending, session.pending = session.pending, []
+            try:
+                session.history.add_messages(pending)
+            except Exception as e:
+                # Keep the messages so that the next flush retries them.
+                session.pending = pending + session.pending
+                logging.error(f"Error flushing chat history to DynamoDB: {e}")
+
+    def flush(self, session_id: str) -> None:
+        """Write the buffered messages of one session with a single call."""
+        with self._lock:
+            session = self._sessions.get(session_id)
+        if session is not None:
+            self._flush_session(session)
+
+    def rewrite(self, session_id: str, transform: Callable[[List[BaseMessage]], List[BaseMessage]]) -> bool:
+        """
+            Replace the whole stored history of a session with transform(history), eg. to compact it.
+            Buffered messages are written first so that the transform sees the complete history. The transform runs
+            without holding the session's lock, the messages added meanwhile are kept after its result.
+            Returns False if the history could not be rewritten (failed flush, cleared or rewritten concurrently).
+        """
+        session = self._get(session_id)
+        with session.lock:
+            if session.added_during_rewrite is not None:
+                return False
+            self._flush_session(session)
+            if session.pending:
+                # The flush failed, rewriting now would drop the messages it could not write.
+                return False
+            snapshot = session.history.messages()
+            session.added_during_rewrite = []
+        try:
+            messages = transform(snapshot)
+        except Exception:
+            with session.lock:
+                session.added_during_rewrite = None
+            raise
+        with session.lock:
+            added, session.added_during_rewrite = session.added_during_rewrite, None
+            with self._lock:
+                # An evicted session could have been reloaded meanwhile, its new messages would be lost.
+                current = self._sessions.get(session_id) or self._draining.get(session_id)
+            if added is None or current is not session:
+                return False
+            # The messages added meanwhile that a flush already wrote would be deleted with the old history, the
+            # others are still buffered and written by the next flush.
+            flushed = added[:len(added) - len(session.pending)]
+            messages = messages + flushed
+            session.history.replace_messages(messages)
+            session.messages = (messages + session.pending)[-self.window:]
+        return True
+
+    def flush_all(self) -> None:
+        """Write the buffered messages of every session, eg. on shutdown."""
+        with self._lock:
+            sessions = list(self._sessions.values())
+        for session in sessions:
+            self._flush_session(session)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "sessions": len(self._sessions),
+                "pending_messages": sum(len(s.pending) for s in self._sessions.values()),
+                "hits": self.hits,
+                "misses": self.misses,
+            }
@@ -0,0 +1,329 @@
+import hashlib
+import logging
+import os
+import random
+import sqlite3
+import threading
+import time
+import unicodedata
+from array import array
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Any, Callable, Dict, Iterable, List, Optional
+
+Embedding = List[float]
+
+@dataclass
+class EmbeddingSettings:
+    """Process-wide settings of the embedding service, set once at startup with configure_embeddings()."""
+    batch_size: int = 100
+    max_in_flight: int = 4
+    max_retries: int = 6
+    # SQLite file of the persistent embedding cache, None to disable it.
+    cache_path: Optional[str] = None
+    # "openai", or "fake" for deterministic offline vectors (tests and benchmarks).
+    backend: str = "openai"
+    # Query embeddings kept in memory, 0 to disable the query embedding cache.
+    query_cache_size: int = 2048
+
+embedding_settings = EmbeddingSettings()
+# Every engine built in the process, for the /metrics endpoint.
+_engines: List["EmbeddingEngine"] = []
+
+def configure_embeddings(**kwargs) -> None:
+    for key, value in kwargs.items():
+        if not hasattr(embedding_settings, key):
+            raise ValueError(f"Unknown embedding setting: {key}")
+        setattr(embedding_settings, key, value)
+
+def document_batch_size() -> int:
+    """Texts handed to an embedding engine at once: enough for max_in_flight batches of batch_size to run in parallel."""
+    return embedding_settings.batch_size * embedding_settings.max_in_flight
+
+def content_hash(model_name: str, text: str) -> str:
+    return hashlib.sha256(f"{model_name}\0{text}".encode("utf-8")).hexdigest()
+
+class SQLiteEmbeddingCache:
+    """
+        Persistent content-hash -> vector cache, checked before any embedding API call.
+        Vectors are stored as float32 blobs, keyed by the sha256 of the model name and the text.
+    """
+    def __init__(self, path: str):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("CREATE TABLE IF NOT EXISTS embeddings (key TEXT PRIMARY KEY, vector BLOB NOT NULL)")
+        self._connection.commit()
+        self._lock = threading.Lock()
+
+    def get_many(self, keys: List[str]) -> Dict[str, Embedding]:
+        found = {}
+        with self._lock:
+            # SQLite limits the number of bound parameters, look the keys up in chunks.
+            for start in range(0, len(keys), 500):
+                chunk = keys[start:start + 500]
+                rows = self._connection.execute(
+                    f"SELECT key, vector FROM embeddings WHERE key IN ({','.join('?' * len(chunk))})",
+                    chunk
+                ).fetchall()
+                for key, blob in rows:
+                    found[key] = array("f", blob).tolist()
+        return found
+
+    def put_many(self, items: Dict[str, Embedding]) -> None:
+        with self._lock:
+            self._connection.executemany(
+                "INSERT OR REPLACE INTO embeddings (key, vector) VALUES (?, ?)",
+                [(key, array("f", vector).tobytes()) for key, vector in items.items()]
+            )
+            self._connection.commit()
+
+def _is_retryable(error: Exception) -> bool:
+    # Rate limits (HTTP 429) and transient connection errors of the embedding API.
+    status_code = getattr(error, "status_code", None) or getattr(getattr(error, "response", None), "status_code", None)
+    return status_code in (429, 500, 502, 503, 504) or type(error).__name__ in ("RateLimitError", "APITimeoutError", "APIConnectionError")
+
+def _retry_after(error: Exception) -> Optional[float]:
+    headers = getattr(getattr(error, "response", None), "headers", None) or {}
+    try:
+        return float(headers.get("retry-after"))
+    except (TypeError, ValueError):
+        return None
+
+class EmbeddingEngine:
+    """
+        Batched, bounded-concurrency embedding of texts in front of any embedding backend.
+        - identical texts are embedded once per call, and never again once they are in the cache,
+        - the remaining texts are sent in batches of `batch_size`, with up to `max_in_flight` batches at a time,
+        - rate limited or failed batches are retried with exponential backoff and jitter, honouring Retry-After.
+        Arguments:
+            embed_batch - Backend function embedding a list of texts, eg. openai_embedding_backend(OpenAIEmbedding(...)).
+            model_name - Part of the cache key, so that vectors of different models never mix.
+    """
+    def __init__(
+        self,
+        embed_batch: Callable[[List[str]], List[Embedding]],
+        model_name: str,
+        batch_size: int = 100,
+        max_in_flight: int = 4,
+        max_retries: int = 6,
+        cache: Optional[SQLiteEmbeddingCache] = None
+    ):
+        self.embed_batch = embed_batch
+        self.model_name = model_name
+        self.batch_size = batch_size
+        self.max_retries = max_retries
+        self.cache = cache
+        self._pool = ThreadPoolExecutor(max_workers=max_in_flight, thread_name_prefix="embedding-batch")
+        self._lock = threading.Lock()
+        self.stats = {"texts": 0, "cache_hits": 0, "api_texts": 0, "api_batches": 0, "retries": 0}
+        _engines.append(self)
+
+    def call_with_backoff(self, call: Callable[[], Any]) -> Any:
+        """Call the embedding API, retrying rate limited or transient failures with the engine's backoff."""
+        for attempt in range(self.max_retries + 1):
+            try:
+                return call()
+            except Exception as e:
+                if attempt == self.max_retries or not _is_retryable(e):
+                    raise
+                delay = _retry_after(e) or min(2 ** attempt, 60) * (0.5 + random.random())
+                logging.warning(f"Embedding batch failed ({e}), retrying in {delay:.1f}s.")
+                with self._lock:
+                    self.stats["retries"] += 1
+                time.sleep(delay)
+
+    def _embed_with_backoff(self, texts: List[str]) -> List[Embedding]:
+        embeddings = self.call_with_backoff(lambda: self.embed_batch(texts))
+        with self._lock:
+            self.stats["api_batches"] += 1
+            self.stats["api_texts"] += len(texts)
+        return embeddings
+
+    def embed(self, texts: Iterable[str]) -> List[Embedding]:
+        texts = list(texts)
+        keys = [content_hash(self.model_name, text) for text in texts]
+        vectors: Dict[str, Embedding] = self.cache.get_many(list(set(keys))) if self.cache is not None else {}
+
+        # Texts to send to the API, each distinct text once.
+        missing: Dict[str, str] = {}
+        for key, text in zip(keys, texts):
+            if key not in vectors:
+                missing.setdefault(key, text)
+        with self._lock:
+            self.stats["texts"] += len(texts)
+            self.stats["cache_hits"] += len(texts) - sum(1 for key in keys if key in missing)
+
+        missing_keys = list(missing.keys())
+        batches = [missing_keys[i:i + self.batch_size] for i in range(0, len(missing_keys), self.batch_size)]
+        for batch_keys, embeddings in zip(batches, self._pool.map(lambda batch: self._embed_with_backoff([missing[k] for k in batch]), batches)):
+            new_vectors = dict(zip(batch_keys, embeddings))
+            vectors.update(new_vectors)
+            if self.cache is not None:
+                self.cache.put_many(new_vectors)
+        return [vectors[key] for key in keys]
+
+def embedding_stats() -> Dict[str, int]:
+    """Counters of all the embedding engines of the process, summed."""
+    totals = {"texts": 0, "cache_hits": 0, "api_texts": 0, "api_batches": 0, "retries": 0}
+    for engine in _engines:
+        with engine._lock:
+            for key, value in engine.stats.items():
+                totals[key] += value
+    return totals
+
+def normalise_query(query: str) -> str:
+    """Query cache key: questions differing only in case, unicode form or whitespace share their embedding."""
+    return " ".join(unicodedata.normalize("NFKC", query).casefold().split())
+
+class QueryEmbeddingCache:
+    """
+        Process-wide, size-bounded LRU of query embeddings, keyed by model name and normalised query. Every
+        retrieval path (Rag, Retrieve, the answer cache) embeds its query through the same embed model, so a
+        question asked again, by the same user in the same turn or by anyone later, costs no embedding call.
+    """
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[tuple, Embedding]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._lookups = 0
+        self._hits = 0
+
+    def get_or_embed(self, model_name: str, query: str, embed: Callable[[str], Embedding]) -> Embedding:
+        if self.max_entries <= 0:
+            return embed(query)
+        key = (model_name, normalise_query(query))
+        with self._lock:
+            self._lookups += 1
+            embedding = self._entries.get(key)
+            if embedding is not None:
+                self._entries.move_to_end(key)
+                self._hits += 1
+                return embedding
+        # Embedded outside of the lock, two threads missing on the same query both embed it.
+        embedding = embed(query)
+        with self._lock:
+            self._entries[key] = embedding
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return embedding
+
+    def stats(self) -> Dict[str, float]:
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "lookups": self._lookups,
+                "hits": self._hits,
+                "hit_rate": round(self._hits / self._lookups, 3) if self._lookups else 0.0
+            }
+
+_query_cache: Optional[QueryEmbeddingCache] = None
+_query_cache_lock = threading.Lock()
+
+def get_query_embedding_cache() -> QueryEmbeddingCache:
+    """The process-wide query embedding cache, sized by embedding_settings.query_cache_size on first use."""
+    global _query_cache
+    with _query_cache_lock:
+        if _query_cache is None:
+            _query_cache = QueryEmbeddingCache(embedding_settings.query_cache_size)
+        return _query_cache
+
+def query_embedding_stats() -> Dict[str, float]:
+    return get_query_embedding_cache().stats()
+
+def fake_embedding_backend(dimensions: int = 1536) -> Callable[[List[str]], List[Embedding]]:
+    """Deterministic, offline stand-in for an embedding API, for tests and benchmarks."""
+    def embed_batch(texts: List[str]) -> List[Embedding]:
+        vectors = []
+        for text in texts:
+            seed = hashlib.sha256(text.encode("utf-8")).digest()
+            generator = random.Random(seed)
+            vector = [generator.uniform(-1, 1) for _ in range(dimensions)]
+            norm = sum(v * v for v in vector) ** 0.5
+            vectors.append([v / norm for v in vector])
+        return vectors
+    return embed_batch
+
+def openai_embedding_backend(embed_model, query: bool = False) -> Callable[[List[str]], List[Embedding]]:
+    """
+        Backend embedding texts with the OpenAI client of a LlamaIndex OpenAIEmbedding, called directly. The model's
+        own methods retry with tenacity (6 attempts each), which would nest inside the engine's retries and never
+        honour Retry-After.
+    """
+    model = embed_model._query_engine if query else embed_model._text_engine
+
+    def embed_batch(texts: List[str]) -> List[Embedding]:
+        texts = [text.replace("\n", " ") for text in texts]
+        data = embed_model._get_client().embeddings.create(input=texts, model=model, **embed_model.additional_kwargs).data
+        return [d.embedding for d in data]
+    return embed_batch
+
+def build_cached_embed_model(inner, model_name: str):
+    """
+        Wrap a LlamaIndex embedding model so that its document embeddings go through an EmbeddingEngine configured
+        with embedding_settings. Query embeddings are served from the process-wide query embedding cache, and
+        only embedded by the wrapped model on a miss.
+        Without a model to wrap, the fake embedding backend is used for both.
+    """
+    from llama_index.embeddings.base import BaseEmbedding
+    from llama_index.bridge.pydantic import PrivateAttr
+
+    class CachedBatchEmbedding(BaseEmbedding):
+        _inner: BaseEmbedding = PrivateAttr()
+        _engine: EmbeddingEngine = PrivateAttr()
+        _embed_queries: Optional[Callable[[List[str]], List[Embedding]]] = PrivateAttr()
+
+        def __init__(self, inner: BaseEmbedding, engine: EmbeddingEngine, **kwargs):
+            # LlamaIndex hands texts over in chunks of embed_batch_size. Make the chunks big enough for the
+            # engine to run several of its own batches in parallel.
+            super().__init__(model_name=engine.model_name, embed_batch_size=document_batch_size(), **kwargs)
+            self._inner = inner
+            self._engine = engine
+            self._embed_queries = openai_embedding_backend(inner, query=True) if inner is not None else None
+
+        @classmethod
+        def class_name(cls) -> str:
+            return "CachedBatchEmbedding"
+
+        @property
+        def engine(self) -> EmbeddingEngine:
+            return self._engine
+
+        def _embed_query(self, query: str) -> Embedding:
+            if self._embed_queries is None:
+                return self._engine.embed_batch([query])[0]
+            # The only retries of queries are the engine's, see openai_embedding_backend.
+            return self._engine.call_with_backoff(lambda: self._embed_queries([query])[0])
+
+        def _get_query_embedding(self, query: str) -> Embedding:
+            return get_query_embedding_cache().get_or_embed(self._engine.model_name, query, self._embed_query)
+
+        async def _aget_query_embedding(self, query: str) -> Embedding:
+            return self._get_query_embedding(query)
+
+        def _get_text_embedding(self, text: str) -> Embedding:
+            return self._engine.embed([text])[0]
+
+        def _get_text_embeddings(self, texts: List[str]) -> List[Embedding]:
+            return self._engine.embed(texts)
+
+        async def _aget_text_embedding(self, text: str) -> Embedding:
+            return self._get_text_embedding(text)
+
+        async def _aget_text_embeddings(self, texts: List[str]) -> List[Embedding]:
+            return self._get_text_embeddings(texts)
+
+    cache = SQLiteEmbeddingCache(embedding_settings.cache_path) if embedding_settings.cache_path else None
+    engine = EmbeddingEngine(
+        openai_embedding_backend(inner) if inner is not None else fake_embedding_backend(),
+        model_name,
+        batch_size=embedding_settings.batch_size,
+        max_in_flight=embedding_settings.max_in_flight,
+        max_retries=embedding_settings.max_retries,
+        cache=cache
+    )
+    return CachedBatchEmbedding(inner, engine)
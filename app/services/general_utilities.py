@@ -5,6 +5,8 @@ import re
 import json
 from starlette.responses import JSONResponse
 import httpx
+import queue
+from typing import Callable, Iterable, Iterator, Optional
 
 def get_media_file_content_from_whatsapp(media_id:str, whatsapp_version:str, whatsapp_access_token: str, whatsapp_phone_number_id: str):
     """"
@@ -33,6 +35,140 @@ def get_media_file_content_from_whatsapp(media_id:str, whatsapp_version:str, wha
     )
     return media_file_resp.content
 
+class MediaTooLargeError(Exception):
+    """Raised when a media file is bigger than the configured limit."""
+
+def stream_media_file_from_whatsapp(
+        media_id:str, 
+        whatsapp_version:str, 
+        whatsapp_access_token: str, 
+        whatsapp_phone_number_id: str, 
+        chunk_size: int = 1024 * 1024, 
+        max_bytes: Optional[int] = None
+    ) -> Iterator[bytes]:
+    """
+        Streaming version of get_media_file_content_from_whatsapp. Yields the content of the media file in chunks
+        instead of loading all of it in memory. Raises MediaTooLargeError as soon as the file is known to be
+        bigger than max_bytes, either from the size announced by Whatsapp or while downloading it.
+    """
+    url_request_response = requests.get(
+        url=f"https://graph.facebook.com/{whatsapp_version}/{media_id}/", 
+        headers={
+            "Authorization": f"Bearer {whatsapp_access_token}"
+        },
+        params=whatsapp_phone_number_id
+    )
+    url_request_response.raise_for_status()
+    media_url = url_request_response.json()["url"]
+    file_size = url_request_response.json().get("file_size")
+    if max_bytes is not None and file_size is not None and int(file_size) > max_bytes:
+        raise MediaTooLargeError(f"Media {media_id} is {file_size} bytes, the limit is {max_bytes} bytes.")
+
+    with requests.get(
+        url=media_url,
+        headers={
+            "Authorization": f"Bearer {whatsapp_access_token}"
+        },
+        stream=True,
+        timeout=60
+    ) as media_file_resp:
+        media_file_resp.raise_for_status()
+        received = 0
+        for chunk in media_file_resp.iter_content(chunk_size=chunk_size):
+            received += len(chunk)
+            if max_bytes is not None and received > max_bytes:
+                raise MediaTooLargeError(f"Media {media_id} is bigger than the limit of {max_bytes} bytes.")
+            yield chunk
+
+def tee_stream(chunks: Iterable[bytes], *sinks: Callable[[bytes], None]) -> int:
+    """Feed every chunk of a stream to each of the sinks, in order. Returns the number of bytes streamed."""
+    total = 0
+    for chunk in chunks:
+        for sink in sinks:
+            sink(chunk)
+        total += len(chunk)
+    return total
+
+class S3MultipartUpload:
+    """
+        Upload a file to S3 from a stream of chunks, without having the whole file on disk or in memory.
+        Chunks are buffered until a part of `part_size` bytes is ready (S3 requires at least 5 MB per part except
+        the last one). Files smaller than one part are sent with a single put_object instead.
+    """
+    def __init__(self, bucketName:str, key:str, aws_access_key_id:str, aws_secret_access_key:str, part_size: int = 8 * 1024 * 1024):
+        self.s3 = boto3.client('s3', aws_access_key_id=aws_access_key_id, aws_secret_access_key=aws_secret_access_key)
+        self.bucketName = bucketName
+        self.key = key
+        self.part_size = part_size
+        self._buffer = bytearray()
+        self._upload_id = None
+        self._parts = []
+
+    def write(self, chunk: bytes) -> None:
+        self._buffer.extend(chunk)
+        while len(self._buffer) >= self.part_size:
+            self._upload_part(bytes(self._buffer[:self.part_size]))
+            del self._buffer[:self.part_size]
+
+    def _upload_part(self, data: bytes) -> None:
+        if self._upload_id is None:
+            self._upload_id = self.s3.create_multipart_upload(Bucket=self.bucketName, Key=self.key)["UploadId"]
+        part_number = len(self._parts) + 1
+        response = self.s3.upload_part(Bucket=self.bucketName, Key=self.key, UploadId=self._upload_id, PartNumber=part_number, Body=data)
+        self._parts.append({"ETag": response["ETag"], "PartNumber": part_number})
+
+    def complete(self) -> None:
+        if self._upload_id is None:
+            self.s3.put_object(Bucket=self.bucketName, Key=self.key, Body=bytes(self._buffer))
+        else:
+            if self._buffer:
+                self._upload_part(bytes(self._buffer))
+            self.s3.complete_multipart_upload(
+                Bucket=self.bucketName,
+                Key=self.key,
+                UploadId=self._upload_id,
+                MultipartUpload={"Parts": self._parts}
+            )
+        self._buffer = bytearray()
+        logging.info(f"Successfully wrote file to s3: s3://{self.bucketName}/{self.key}")
+
+    # Sentinels put on the queue read by upload_from_queue().
+    END = object()
+    ABORT = object()
+
+    def upload_from_queue(self, chunk_queue: "queue.Queue") -> None:
+        """
+            Upload the chunks put on the queue by another thread, until S3MultipartUpload.END (complete the upload)
+            or S3MultipartUpload.ABORT (drop it). The queue is always drained up to the sentinel, even after an S3
+            error, so that the producer never blocks on a full queue.
+        """
+        error = None
+        while True:
+            chunk = chunk_queue.get()
+            if chunk is self.END or chunk is self.ABORT:
+                break
+            if error is None:
+                try:
+                    self.write(chunk)
+                except Exception as e:
+                    error = e
+        if error is not None or chunk is self.ABORT:
+            self.abort()
+            if error is not None:
+                raise error
+            raise RuntimeError("The upload was aborted by the producer.")
+        self.complete()
+
+    def abort(self) -> None:
+        """Drop the parts uploaded so far, eg. when the download failed half way."""
+        self._buffer = bytearray()
+        if self._upload_id is not None:
+            try:
+                self.s3.abort_multipart_upload(Bucket=self.bucketName, Key=self.key, UploadId=self._upload_id)
+            except Exception as e:
+                logging.error(f"Error aborting multipart upload to s3: {e}")
+            self._upload_id = None
+
 # Some cleaning up of the text before sending a text message from us(server) to user.
 def process_text_for_whatsapp(text):
     # Remove brackets
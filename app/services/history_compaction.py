@@ -0,0 +1,93 @@
+import logging
+from typing import List
+from cachetools import TTLCache
+from langchain_core.messages import BaseMessage, SystemMessage
+from app.services.service_utilities import message_token_count, with_token_count
+
+SUMMARY_PREFIX = "Summary of the earlier conversation:\n\n"
+
+class HistoryCompactor:
+    """
+        Folds the older part of a chat history into one rolling summary message.
+        Once the history passes `token_threshold` tokens (or `max_messages` messages), everything but the last
+        `keep_last` messages is summarised together with the previous summary. The older messages are folded in
+        windows of at most `chunk_tokens` tokens, one LLM call per window, so that a long history never makes a
+        prompt bigger than the model's context. Every stored message is read and folded, none is dropped unsummarised.
+        The summary is kept as a SystemMessage flagged with additional_kwargs["summary"].
+        A session whose compaction failed is not tried again for `retry_after_seconds`.
+    """
+    def __init__(
+        self,
+        openai_api_key: str,
+        token_threshold: int = 1500,
+        keep_last: int = 6,
+        max_messages: int = 20,
+        summary_max_tokens: int = 256,
+        chunk_tokens: int = 3000,
+        retry_after_seconds: float = 1800
+    ):
+        from langchain_openai import ChatOpenAI
+        self.llm = ChatOpenAI(model_name="gpt-3.5-turbo", openai_api_key=openai_api_key, max_tokens=summary_max_tokens, temperature=0)
+        self.token_threshold = token_threshold
+        self.keep_last = keep_last
+        self.max_messages = max_messages
+        self.chunk_tokens = chunk_tokens
+        # Sessions whose last compaction failed, until they may be retried.
+        self.failed_sessions = TTLCache(maxsize=10000, ttl=retry_after_seconds)
+
+    def needs_compaction(self, messages: List[BaseMessage]) -> bool:
+        if len(messages) <= self.keep_last:
+            return False
+        return len(messages) >= self.max_messages or sum(message_token_count(m) for m in messages) > self.token_threshold
+
+    def _windows(self, messages: List[BaseMessage]) -> List[List[str]]:
+        # Transcript lines grouped in windows of at most chunk_tokens tokens. A message bigger than a whole
+        # window is cut down (about 4 characters per token).
+        windows, window, window_tokens = [], [], 0
+        for message in messages:
+            tokens = min(message_token_count(message), self.chunk_tokens)
+            if window and window_tokens + tokens > self.chunk_tokens:
+                windows.append(window)
+                window, window_tokens = [], 0
+            window.append(f"{message.type}: {str(message.content)[:self.chunk_tokens * 4]}")
+            window_tokens += tokens
+        if window:
+            windows.append(window)
+        return windows
+
+    def _summarise(self, summary: str, lines: List[str]) -> str:
+        transcript = "\n".join(([f"Summary so far: {summary}"] if summary else []) + lines)
+        prompt = (
+            "Progressively summarise the conversation below between a Human and an AI assistant. "
+            "The transcript may start with the summary of an even earlier part of the conversation. "
+            "Keep the names, facts, documents, links and open questions the assistant may need later. "
+            "Answer with the summary only, in less than 150 words.\n\n"
+            f"{transcript}"
+        )
+        return self.llm.invoke(prompt).content
+
+    def compact(self, messages: List[BaseMessage]) -> List[BaseMessage]:
+        """Return the compacted history: the new rolling summary followed by the most recent messages."""
+        older, recent = messages[:-self.keep_last], messages[-self.keep_last:]
+        summary = ""
+        for window in self._windows(older):
+            summary = self._summarise(summary, window)
+        summary_message = SystemMessage(content=f"{SUMMARY_PREFIX}{summary}", additional_kwargs={"summary": True})
+        return [with_token_count(summary_message)] + recent
+
+def compact_session(session_cache, session_id: str, compactor: HistoryCompactor) -> bool:
+    """
+        Compact a user's history if it grew past the compactor's threshold. Meant to run after the reply is sent.
+        The check only looks at the cached recent messages, so a turn that does not need compaction costs no I/O.
+        Returns True if the history was compacted.
+    """
+    if session_id in compactor.failed_sessions:
+        return False
+    try:
+        if not compactor.needs_compaction(session_cache.session(session_id).messages()):
+            return False
+        return session_cache.rewrite(session_id, compactor.compact)
+    except Exception as e:
+        logging.error(f"An error occurred while compacting the chat history, not retrying it for a while: {e}")
+        compactor.failed_sessions[session_id] = True
+        return False
@@ -0,0 +1,145 @@
+import logging
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError
+from dataclasses import dataclass
+from typing import Any, Callable, Dict, Optional, Tuple
+from app.services.ingestion_pipeline import ingestion_counters
+
+# Threads shared by the stages of every ingestion running in the process.
+_stage_pool = ThreadPoolExecutor(max_workers=8, thread_name_prefix="ingestion-stage")
+
+@dataclass
+class StageResult:
+    name: str
+    result: Any = None
+    error: Optional[BaseException] = None
+    seconds: float = 0.0
+    timed_out: bool = False
+
+    @property
+    def ok(self) -> bool:
+        return self.error is None and not self.timed_out
+
+class IngestionOrchestrator:
+    """
+        Runs the independent stages of a document ingestion (summary, embedding/indexing, archival, ...) at the
+        same time instead of one after another, each with its own timeout, and reports the wall time of each stage
+        so that the critical path is visible.
+        A stage that times out is reported as such, but keeps running in the background since threads can not be killed.
+
+        eg.
+        orchestrator = IngestionOrchestrator("pdf 123")
+        orchestrator.start("summary", generate_summary, text, key, timeout=120, on_done=send_summary)
+        orchestrator.start("index", index_pdf_pages, pages, ..., timeout=600)
+        results = orchestrator.wait()  # or orchestrator.on_finished(record_results), without blocking
+    """
+    def __init__(self, name: str, pool: ThreadPoolExecutor = _stage_pool):
+        self.name = name
+        self.pool = pool
+        self._stages: Dict[str, Tuple[Future, float, Optional[float]]] = {}
+        # Wall time of each finished stage, excluding the time spent waiting for a free thread.
+        self._seconds: Dict[str, float] = {}
+        self._started_at = time.perf_counter()
+
+    def start(
+        self,
+        stage: str,
+        fn: Callable,
+        *args,
+        timeout: Optional[float] = None,
+        on_done: Optional[Callable[[Any], None]] = None,
+        dedicated: bool = False,
+        **kwargs
+    ) -> Future:
+        """
+            Start a stage. on_done is called with the stage's result as soon as the stage succeeds, on the stage's
+            thread, eg. to send the summary to the user without waiting for the other stages.
+            A dedicated stage gets a thread of its own instead of one of the pool, for a stage that another one
+            waits on (eg. the consumer of a bounded queue), which must never wait for a free thread.
+        """
+        def run():
+            started_at = time.perf_counter()
+            try:
+                result = fn(*args, **kwargs)
+                if on_done is not None:
+                    on_done(result)
+                return result
+            finally:
+                self._seconds[stage] = time.perf_counter() - started_at
+
+        if dedicated:
+            pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix=f"ingestion-{stage}")
+            future = pool.submit(run)
+            # The thread exits once the stage is over.
+            pool.shutdown(wait=False)
+        else:
+            future = self.pool.submit(run)
+        self._stages[stage] = (future, time.perf_counter(), timeout)
+        return future
+
+    def wait(self) -> Dict[str, StageResult]:
+        """Wait for every stage (up to its timeout) and return the result of each of them."""
+        results = {}
+        for stage, (future, started_at, timeout) in self._stages.items():
+            remaining = None if timeout is None else max(timeout - (time.perf_counter() - started_at), 0)
+            results[stage] = self._stage_result(stage, future, remaining)
+        self._report(results)
+        return results
+
+    def on_finished(self, callback: Optional[Callable[[Dict[str, StageResult]], None]] = None) -> None:
+        """
+            Same as wait(), without blocking: once every stage is over or timed out, the results are logged and
+            passed to callback, on the thread of the stage that finished last (or of the timer of the one that timed out).
+        """
+        lock = threading.Lock()
+        unsettled = set(self._stages)
+        timers = []
+
+        def settle(stage: Optional[str]):
+            with lock:
+                if stage is not None:
+                    if stage not in unsettled:
+                        return
+                    unsettled.discard(stage)
+                if unsettled:
+                    return
+            for timer in timers:
+                timer.cancel()
+            results = {stage: self._stage_result(stage, future, 0) for stage, (future, _, _) in self._stages.items()}
+            self._report(results)
+            if callback is not None:
+                callback(results)
+
+        for stage, (future, started_at, timeout) in list(self._stages.items()):
+            if timeout is not None:
+                timer = threading.Timer(max(timeout - (time.perf_counter() - started_at), 0), settle, args=(stage,))
+                timer.daemon = True
+                timers.append(timer)
+        for timer in timers:
+            timer.start()
+        for stage, (future, _, _) in list(self._stages.items()):
+            future.add_done_callback(lambda future, stage=stage: settle(stage))
+        if not self._stages:
+            settle(None)
+
+    def _stage_result(self, stage: str, future: Future, timeout: Optional[float]) -> StageResult:
+        started_at, stage_timeout = self._stages[stage][1:]
+        stage_result = StageResult(name=stage)
+        try:
+            stage_result.result = future.result(timeout=timeout)
+        except TimeoutError:
+            stage_result.timed_out = True
+            logging.error(f"Stage '{stage}' of {self.name} timed out after {stage_timeout} s.")
+        except Exception as e:
+            stage_result.error = e
+            logging.error(f"Stage '{stage}' of {self.name} failed: {e}")
+        stage_result.seconds = self._seconds.get(stage, time.perf_counter() - started_at)
+        ingestion_counters.record(f"stage_{stage}", 1, stage_result.seconds)
+        return stage_result
+
+    def _report(self, results: Dict[str, StageResult]) -> None:
+        total = time.perf_counter() - self._started_at
+        timings = ", ".join(f"{r.name}={r.seconds:.2f}s{'' if r.ok else ' (failed)'}" for r in results.values())
+        critical = max(results.values(), key=lambda r: r.seconds, default=None)
+        logging.info(f"Ingestion of {self.name} took {total:.2f}s: {timings}. Critical path: {critical.name if critical else '-'}.")
@@ -0,0 +1,214 @@
+import logging
+import threading
+import time
+import uuid
+from itertools import islice
+from typing import Any, Callable, Dict, IO, Iterable, Iterator, List, Optional, Tuple, Union
+
+class StageCounters:
+    """Items processed and time spent by each stage of the ingestion pipeline, for throughput monitoring."""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stages: Dict[str, Dict[str, float]] = {}
+
+    def record(self, stage: str, items: int, seconds: float) -> None:
+        with self._lock:
+            counters = self._stages.setdefault(stage, {"items": 0, "seconds": 0.0})
+            counters["items"] += items
+            counters["seconds"] += seconds
+
+    def stats(self) -> Dict[str, Dict[str, float]]:
+        with self._lock:
+            return {
+                stage: {
+                    "items": int(c["items"]),
+                    "seconds": round(c["seconds"], 3),
+                    "items_per_second": round(c["items"] / c["seconds"], 2) if c["seconds"] else 0.0
+                }
+                for stage, c in self._stages.items()
+            }
+
+# Process-wide counters of every document ingested.
+ingestion_counters = StageCounters()
+
+def _timed(stage: str, iterator: Iterable, counters: StageCounters = ingestion_counters) -> Iterator:
+    # Wrap a generator stage and record how many items it produced and how long producing them took.
+    # Stages are chained generators, so the time of a stage includes the time of the stages feeding it.
+    iterator = iter(iterator)
+    while True:
+        started_at = time.perf_counter()
+        try:
+            item = next(iterator)
+        except StopIteration:
+            return
+        counters.record(stage, 1, time.perf_counter() - started_at)
+        yield item
+
+def document_id(*parts: str) -> str:
+    """Stable ID of an ingested document, stored as the ref_doc_id of all its nodes."""
+    return str(uuid.uuid5(uuid.NAMESPACE_URL, "/".join(str(part) for part in parts)))
+
+def batched(iterable: Iterable, batch_size: int) -> Iterator[List]:
+    iterator = iter(iterable)
+    while True:
+        batch = list(islice(iterator, batch_size))
+        if not batch:
+            return
+        yield batch
+
+def iter_pdf_pages(pdf_file: Union[str, IO[bytes]]) -> Iterator[str]:
+    """Text of each page of a PDF, extracted one page at a time."""
+    from pypdf import PdfReader
+    reader = PdfReader(pdf_file)
+    for page in reader.pages:
+        text = page.extract_text() or ""
+        if text.strip():
+            yield text
+
+def iter_sentences(texts: Iterable[str]) -> Iterator[str]:
+    """Split a stream of texts (eg. pages) into sentences, with the splitter SentenceWindowNodeParser uses."""
+    from app.services.databases.qdrant_setup import get_sentence_splitter
+    sentence_splitter = get_sentence_splitter()
+    for text in texts:
+        for sentence in sentence_splitter(text):
+            if sentence.strip():
+                yield sentence
+
+def iter_sentence_windows(sentences: Iterable[str], window_size: int = 4) -> Iterator[Tuple[int, str, List[str]]]:
+    """
+        (position, sentence, window) for each sentence of a stream, where window holds up to `window_size`
+        sentences on each side. A sentence is emitted as soon as the sentences after it are known, so only
+        about 2 * window_size + 1 sentences are held in memory at any time.
+    """
+    buffer: List[str] = []
+    # Position of buffer[0] in the whole stream.
+    offset = 0
+    next_position = 0
+
+    def window_of(position: int) -> List[str]:
+        return buffer[max(position - window_size, 0) - offset:position + window_size + 1 - offset]
+
+    for sentence in sentences:
+        buffer.append(sentence)
+        while next_position + window_size < offset + len(buffer):
+            yield next_position, buffer[next_position - offset], window_of(next_position)
+            next_position += 1
+            # The sentences before the next window are not needed anymore.
+            stale = next_position - window_size - offset
+            if stale > 0:
+                del buffer[:stale]
+                offset += stale
+    # The last sentences, whose windows are cut by the end of the stream.
+    while next_position < offset + len(buffer):
+        yield next_position, buffer[next_position - offset], window_of(next_position)
+        next_position += 1
+
+def iter_window_nodes(
+    sentences: Iterable[str],
+    metadata: Dict[str, Any],
+    doc_id: str,
+    window_size: int = 4,
+    window_metadata_key: str = "window",
+    original_text_metadata_key: str = "original_text",
+    stable_ids: bool = False,
+    sentence_store = None
+):
+    """
+        Streaming equivalent of SentenceWindowNodeParser: one TextNode per sentence, with the window of sentences
+        around it stored in its metadata. Only the sentence itself is embedded, the metadata is left out of the
+        embedding text.
+        With stable_ids, a node's ID only depends on the document and its sentence (and which occurrence of that
+        sentence it is), so re-indexing an edited document overwrites the points of the sentences it kept.
+        With a sentence store (compact window storage), nodes only carry the position of their sentence, and the
+        sentences are written to the store, from which the windows are rebuilt at query time.
+    """
+    from llama_index.schema import TextNode, NodeRelationship, RelatedNodeInfo
+    occurrences: Dict[str, int] = {}
+    pending_sentences: List[Tuple[int, str]] = []
+    length = 0
+    for position, sentence, window in iter_sentence_windows(sentences, window_size):
+        node_id = {}
+        if stable_ids:
+            occurrence = occurrences[sentence] = occurrences.get(sentence, -1) + 1
+            node_id = {"id_": stable_node_id(doc_id, sentence, occurrence)}
+        if sentence_store is not None:
+            pending_sentences.append((position, sentence))
+            if len(pending_sentences) >= 64:
+                sentence_store.put(doc_id, pending_sentences)
+                pending_sentences = []
+            node_metadata = {**metadata, "sentence_position": position}
+            excluded_llm_metadata_keys = [window_metadata_key, original_text_metadata_key, "sentence_position"]
+        else:
+            node_metadata = {
+                **metadata,
+                window_metadata_key: " ".join(window),
+                original_text_metadata_key: sentence
+            }
+            excluded_llm_metadata_keys = [window_metadata_key, original_text_metadata_key]
+        length = position + 1
+        yield TextNode(
+            text=sentence,
+            metadata=node_metadata,
+            excluded_embed_metadata_keys=list(node_metadata.keys()),
+            excluded_llm_metadata_keys=excluded_llm_metadata_keys,
+            relationships={NodeRelationship.SOURCE: RelatedNodeInfo(node_id=doc_id)},
+            **node_id
+        )
+    if sentence_store is not None:
+        sentence_store.put(doc_id, pending_sentences)
+        # A previous, longer version of the document may have left sentences behind.
+        sentence_store.truncate(doc_id, length)
+
+def stable_node_id(doc_id: str, sentence: str, occurrence: int = 0) -> str:
+    return str(uuid.uuid5(uuid.UUID(doc_id), f"{occurrence}:{sentence}"))
+
+def invalidate_answers_of(nodes: Iterable) -> None:
+    """Drop the cached Rag answers of the users (group_id, or list of them for shared documents) of the nodes."""
+    from app.services.answer_cache import answer_cache
+    group_ids = set()
+    for node in nodes:
+        group_id = node.metadata.get("group_id")
+        group_ids.update(group_id if isinstance(group_id, list) else [group_id])
+    answer_cache.invalidate(group_id for group_id in group_ids if group_id)
+
+def embed_and_upsert(nodes: Iterable, embed_model, vector_store, batch_size: Optional[int] = None, on_stored: Optional[Callable[[List], None]] = None) -> int:
+    """
+        Embed the nodes and upsert them to the vector store in fixed size batches. Each batch is searchable as
+        soon as it is upserted, and memory stays bounded by the batch size. Returns the number of nodes stored.
+        on_stored is called with each batch once it is upserted.
+        By default a batch holds as many nodes as the embedding engine embeds at once (see document_batch_size).
+    """
+    from llama_index.schema import MetadataMode
+    from app.services.embedding_service import document_batch_size
+    batch_size = batch_size or document_batch_size()
+    stored = 0
+    for batch in batched(nodes, batch_size):
+        started_at = time.perf_counter()
+        embeddings = embed_model.get_text_embedding_batch([node.get_content(metadata_mode=MetadataMode.EMBED) for node in batch])
+        for node, embedding in zip(batch, embeddings):
+            node.embedding = embedding
+        ingestion_counters.record("embed", len(batch), time.perf_counter() - started_at)
+
+        started_at = time.perf_counter()
+        vector_store.add(batch)
+        ingestion_counters.record("upsert", len(batch), time.perf_counter() - started_at)
+        # Cached Rag answers of the users who can see these nodes may be outdated now.
+        invalidate_answers_of(batch)
+        if on_stored is not None:
+            on_stored(batch)
+        stored += len(batch)
+        logging.info(f"Upserted {stored} nodes so far.")
+    return stored
+
+def index_text_stream(
+    texts: Iterable[str],
+    metadata: Dict[str, Any],
+    doc_id: str,
+    sentence_index,
+    batch_size: Optional[int] = None
+) -> int:
+    """Run a stream of texts (eg. PDF pages) through sentence splitting, window building, embedding and upserting."""
+    from app.services.databases.sentence_store import get_sentence_store
+    sentences = _timed("sentences", iter_sentences(_timed("pages", texts)))
+    nodes = _timed("window_nodes", iter_window_nodes(sentences, metadata, doc_id, sentence_store=get_sentence_store()))
+    return embed_and_upsert(nodes, sentence_index.service_context.embed_model, sentence_index.vector_store, batch_size=batch_size)
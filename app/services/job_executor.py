@@ -0,0 +1,181 @@
+import logging
+import threading
+import time
+import zlib
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Any, Callable, Dict
+
+
+class JobQueueFullError(Exception):
+    """Raised when the executor already holds as many jobs as it is allowed to."""
+
+
+# Module level so that it can be pickled and shipped to a worker process.
+def _timed_call(fn: Callable, args: tuple, kwargs: dict):
+    started_at = time.time()
+    result = fn(*args, **kwargs)
+    return result, started_at, time.time()
+
+
+class BackgroundJobExecutor:
+    """
+        Bounded in-process executor for the work triggered by webhook events.
+        The webhook handler only validates, deduplicates and submits the event here, so that it can
+        acknowledge WhatsApp in a few milliseconds while the slow OpenAI/Qdrant/Cohere calls run on a worker.
+        Arguments:
+            max_workers - Number of threads (or processes) running jobs.
+            max_queue_size - Number of jobs allowed to wait for a free worker. Submissions beyond this are rejected.
+            use_processes - Run the jobs on a process pool instead of a thread pool.
+            latency_window - Number of most recent jobs used for the latency statistics.
+    """
+    def __init__(
+        self,
+        max_workers: int = 4,
+        max_queue_size: int = 100,
+        use_processes: bool = False,
+        latency_window: int = 500,
+        name: str = "jobs"
+    ):
+        self.name = name
+        self.max_workers = max_workers
+        self.max_queue_size = max_queue_size
+        if use_processes:
+            self._pool = ProcessPoolExecutor(max_workers=max_workers)
+        else:
+            self._pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=name)
+        # Every submitted job holds one slot until it finishes, which bounds queued + running jobs.
+        self._slots = threading.BoundedSemaphore(max_workers + max_queue_size)
+        self._lock = threading.Lock()
+        self._pending = 0
+        self._completed = 0
+        self._failed = 0
+        self._rejected = 0
+        # (time spent waiting in the queue, time spent running) of the most recent jobs, in seconds.
+        self._latencies = deque(maxlen=latency_window)
+
+    def submit(self, fn: Callable, *args, **kwargs) -> Future:
+        """Queue a job. Raises JobQueueFullError instead of blocking when the executor is saturated."""
+        if not self._slots.acquire(blocking=False):
+            with self._lock:
+                self._rejected += 1
+            raise JobQueueFullError(f"Executor '{self.name}' is full ({self.max_workers} running, {self.max_queue_size} queued).")
+        submitted_at = time.time()
+        with self._lock:
+            self._pending += 1
+        try:
+            future = self._pool.submit(_timed_call, fn, args, kwargs)
+        except Exception:
+            with self._lock:
+                self._pending -= 1
+            self._slots.release()
+            raise
+        future.add_done_callback(lambda f: self._on_done(f, submitted_at))
+        return future
+
+    def _on_done(self, future: Future, submitted_at: float) -> None:
+        finished_at = time.time()
+        with self._lock:
+            self._pending -= 1
+            if future.cancelled() or future.exception() is not None:
+                self._failed += 1
+                if not future.cancelled():
+                    logging.error(f"A background job failed in executor '{self.name}': {future.exception()}")
+                self._latencies.append((0.0, finished_at - submitted_at))
+            else:
+                _, started_at, job_finished_at = future.result()
+                self._completed += 1
+                self._latencies.append((max(started_at - submitted_at, 0.0), job_finished_at - started_at))
+        self._slots.release()
+
+    def stats(self) -> Dict[str, Any]:
+        """Queue depth, job counters and latency percentiles (in milliseconds) of the executor."""
+        with self._lock:
+            latencies = list(self._latencies)
+            in_flight = self._pending
+            stats = {
+                "name": self.name,
+                "max_workers": self.max_workers,
+                "max_queue_size": self.max_queue_size,
+                "in_flight": in_flight,
+                # Jobs beyond the worker count are waiting for a free worker.
+                "queue_depth": max(in_flight - self.max_workers, 0),
+                "completed": self._completed,
+                "failed": self._failed,
+                "rejected": self._rejected,
+            }
+        stats["queue_wait_ms"] = _percentiles([wait for wait, _ in latencies])
+        stats["run_time_ms"] = _percentiles([run for _, run in latencies])
+        return stats
+
+    def shutdown(self, wait: bool = True) -> None:
+        self._pool.shutdown(wait=wait)
+
+
+def _percentiles(samples) -> Dict[str, float]:
+    if not samples:
+        return {"count": 0, "p50": 0.0, "p95": 0.0, "max": 0.0}
+    ordered = sorted(samples)
+    pick = lambda q: ordered[min(int(q * len(ordered)), len(ordered) - 1)] * 1000
+    return {
+        "count": len(ordered),
+        "p50": round(pick(0.5), 2),
+        "p95": round(pick(0.95), 2),
+        "max": round(ordered[-1] * 1000, 2),
+    }
+
+
+class SenderShardedScheduler:
+    """
+        Runs each sender's turns strictly in the order they arrived, while different senders run in parallel.
+        Work is sharded by the sender's whatsapp ID onto one of `num_shards` single worker executors, so two
+        messages from the same user can never race on their chat history, yet one slow user only delays the
+        users that happen to share the shard.
+        Arguments:
+            num_shards - Number of shards, i.e. the number of turns that can run at the same time.
+            max_queue_size - Number of jobs allowed to wait on each shard.
+            use_processes - Run the shards on worker processes instead of threads.
+    """
+    def __init__(
+        self,
+        num_shards: int = 4,
+        max_queue_size: int = 100,
+        use_processes: bool = False,
+        name: str = "turns"
+    ):
+        self.name = name
+        self.shards = [
+            BackgroundJobExecutor(
+                max_workers=1,
+                max_queue_size=max_queue_size,
+                use_processes=use_processes,
+                name=f"{name}-shard-{i}"
+            )
+            for i in range(num_shards)
+        ]
+
+    def shard_for(self, senders_wa_id: str) -> int:
+        # crc32 rather than hash() so that a sender maps to the same shard in every process and run.
+        return zlib.crc32(str(senders_wa_id).encode("utf-8")) % len(self.shards)
+
+    def submit(self, senders_wa_id: str, fn: Callable, *args, **kwargs) -> Future:
+        """Queue a job behind every earlier job of the same sender."""
+        return self.shards[self.shard_for(senders_wa_id)].submit(fn, *args, **kwargs)
+
+    def stats(self) -> Dict[str, Any]:
+        """Aggregated counters along with the queue depth and latency of every shard."""
+        shard_stats = [shard.stats() for shard in self.shards]
+        return {
+            "name": self.name,
+            "num_shards": len(self.shards),
+            "in_flight": sum(s["in_flight"] for s in shard_stats),
+            "queue_depth": sum(s["queue_depth"] for s in shard_stats),
+            "completed": sum(s["completed"] for s in shard_stats),
+            "failed": sum(s["failed"] for s in shard_stats),
+            "rejected": sum(s["rejected"] for s in shard_stats),
+            "shards": shard_stats,
+        }
+
+    def shutdown(self, wait: bool = True) -> None:
+        for shard in self.shards:
+            shard.shutdown(wait=wait)
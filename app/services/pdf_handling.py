@@ -1,63 +1,96 @@
 import logging
-from typing import Optional
+from typing import IO, Iterator, List, Optional, Tuple, Union
 
 
-def process_pdf_document(
-    file_path: str, 
-    wa_id:str, 
-    media_id:str, 
-    caption: str, 
-    filename: str, 
+def pdf_document_metadata(wa_id: str, media_id: str, caption: str, filename: str) -> dict:
+    """Metadata stored with every node of an ingested PDF."""
+    from app.services.service_utilities import (
+        get_current_time, 
+        datetime_to_str
+    )
+    return {
+        "group_id": wa_id,
+        "type": "rag",
+        "source": filename,
+        "source_type": "document",
+        "media_id": media_id,
+        "caption": caption,
+        "date": datetime_to_str(get_current_time())
+    }
+
+def read_pdf_head(pdf_file: Union[str, IO[bytes]], head_chars: int = 3000) -> Tuple[str, Iterator[str]]:
+    """
+        Read only the first pages of a PDF, enough for `head_chars` characters.
+        Returns that text and an iterator over all the pages, where the pages already read are not extracted again.
+    """
+    from itertools import chain
+    from app.services.ingestion_pipeline import iter_pdf_pages
+    # Read pages lazily. Only the first pages, needed for the summary, are read ahead.
+    pages = iter_pdf_pages(pdf_file)
+    head_pages: List[str] = []
+    for page in pages:
+        head_pages.append(page)
+        if sum(len(p) for p in head_pages) >= head_chars:
+            break
+    return "\n\n".join(head_pages)[:head_chars], chain(head_pages, pages)
+
+def index_pdf_pages(
+    pages: Iterator[str],
+    metadata: dict,
+    qdrant_api_key:str, 
+    qdrant_url: str, 
+    qdrant_collection_name: str, 
+    openai_api_key:str,
+    batch_size: Optional[int] = None,
+    doc_id: Optional[str] = None
+    ) -> int:
+    """
+        Stream the pages into the vector store. Pages are split into sentences, embedded and upserted in batches
+        of `batch_size` nodes, so memory stays bounded and the first batches are searchable while the rest are
+        still being embedded. Returns the number of nodes stored.
+    """
+    from app.services.databases.qdrant_setup import build_sentence_window_index
+    from app.services.ingestion_pipeline import index_text_stream, document_id
+    sentence_index = build_sentence_window_index(openai_api_key, qdrant_url, qdrant_api_key, qdrant_collection_name)
+    doc_id = doc_id or document_id(metadata["group_id"], metadata["media_id"])
+    stored = index_text_stream(pages, metadata, doc_id, sentence_index, batch_size=batch_size)
+    logging.info(f"Document successfully indexed into {stored} nodes.")
+    return stored
+
+def record_pdf_ingestion(
+    document_registry,
+    indexed: bool,
+    wa_id: str,
+    media_id: str,
+    content_hash: str,
+    doc_id: str,
+    summary: str,
     qdrant_api_key:str, 
     qdrant_url: str, 
     qdrant_collection_name: str, 
-    openai_api_key:str
-    ):
+    openai_api_key:str,
+    metadata: Optional[dict] = None
+    ) -> None:
+    """
+        Record a fully indexed PDF in the document registry (and with the metadata of its nodes, in the document
+        catalog). PDFs are only deduplicated, never replaced: WhatsApp gives every upload a new media ID, so a new
+        version of a file is a new document, and the same file sent again is found by its content hash instead.
+        If indexing failed, the points stored so far are deleted instead, so a retry does not duplicate them.
+        Every indexed PDF is recorded, with a stand-in summary if its own could not be generated (see excerpt_summary),
+        so that its points are never left without a record.
+    """
+    from app.services.databases.qdrant_setup import build_sentence_window_index
+    from app.services.databases.document_registry import commit_document, discard_document
     try:
-        from llama_index import (
-            SimpleDirectoryReader, 
-            Document
-        )
-        from app.services.databases.qdrant_setup import build_sentence_window_index
-        from app.services.service_utilities import (
-            get_current_time, 
-            datetime_to_str
-        )
-        from app.services.service_utilities import generate_summary 
-
-        # Load all the pages of the PDF
-        reader = SimpleDirectoryReader(input_files = [file_path])
-        documents = reader.load_data()
-        logging.info("Document successfully read from the directory.")
-
-        # Stitch all pages of the document
-        document = Document(
-            text = "\n\n".join([doc.text for doc in documents]),
-            metadata={
-                "group_id": wa_id,
-                "type": "rag",
-                "source": filename,
-                "source_type": "document",
-                "media_id": media_id,
-                "caption": caption,
-                "date": datetime_to_str(get_current_time())
-                }
-            )
-
-        # Generate summary of the first 3000 characters
-        summary = generate_summary(document.text[:3000], openai_api_key)
-
-        # Insert the document in the vector store
-        sentence_index = build_sentence_window_index(openai_api_key, qdrant_url, qdrant_api_key, qdrant_collection_name)
-        sentence_index.insert(document=document)
-        return summary
-        
+        vector_store = build_sentence_window_index(openai_api_key, qdrant_url, qdrant_api_key, qdrant_collection_name).vector_store
+        if indexed:
+            commit_document(document_registry, vector_store, wa_id, media_id, content_hash, doc_id, summary, metadata, replaces=False)
+        else:
+            discard_document(document_registry, vector_store, wa_id, media_id, doc_id)
     except Exception as e:
-        logging.error(f"An error occurred while indexing the document: {e}")
+        logging.error(f"An error occurred while recording the document in the registry: {e}")
 
 
 
 if __name__ == "__main__":
     pass
-
-
@@ -0,0 +1,146 @@
+import logging
+import math
+import re
+import threading
+import time
+from collections import Counter
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Tuple
+from cachetools import LRUCache
+
+@dataclass
+class RerankSettings:
+    """Process-wide settings of the rerank stage, set once at startup with configure_reranking()."""
+    # Reranking is skipped when the best vector score beats the next one by at least this much.
+    score_margin: float = 0.08
+    # "cohere", falling back to the lexical reranker when Cohere fails, or "lexical" only.
+    backend: str = "cohere"
+    cache_size: int = 1024
+
+rerank_settings = RerankSettings()
+
+def configure_reranking(**kwargs) -> None:
+    for key, value in kwargs.items():
+        if not hasattr(rerank_settings, key):
+            raise ValueError(f"Unknown rerank setting: {key}")
+        setattr(rerank_settings, key, value)
+
+class RerankStats:
+    """How often each rerank path was taken and the time spent reranking, for the /metrics endpoint."""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counts = Counter()
+        self._seconds = 0.0
+
+    def record(self, outcome: str, seconds: float) -> None:
+        with self._lock:
+            self._counts[outcome] += 1
+            self._counts["calls"] += 1
+            self._seconds += seconds
+
+    def stats(self) -> Dict[str, float]:
+        with self._lock:
+            calls = self._counts["calls"]
+            return {
+                **{outcome: count for outcome, count in self._counts.items()},
+                "skip_rate": round(self._counts["skipped"] / calls, 3) if calls else 0.0,
+                "cache_hit_rate": round(self._counts["cache_hit"] / calls, 3) if calls else 0.0,
+                "avg_ms": round(self._seconds * 1000 / calls, 2) if calls else 0.0
+            }
+
+rerank_stats = RerankStats()
+
+def _tokenize(text: str) -> List[str]:
+    return re.findall(r"\w+", text.lower())
+
+def bm25_scores(query: str, documents: List[str], k1: float = 1.5, b: float = 0.75) -> List[float]:
+    """BM25 score of each document for the query, with the document frequencies of the candidates themselves."""
+    query_terms = set(_tokenize(query))
+    tokenized = [_tokenize(document) for document in documents]
+    if not tokenized or not query_terms:
+        return [0.0] * len(documents)
+    average_length = sum(len(tokens) for tokens in tokenized) / len(tokenized) or 1
+    document_frequency = Counter(term for tokens in tokenized for term in set(tokens) if term in query_terms)
+    scores = []
+    for tokens in tokenized:
+        term_frequency = Counter(tokens)
+        score = 0.0
+        for term in query_terms:
+            if not term_frequency[term]:
+                continue
+            idf = math.log(1 + (len(tokenized) - document_frequency[term] + 0.5) / (document_frequency[term] + 0.5))
+            score += idf * term_frequency[term] * (k1 + 1) / (term_frequency[term] + k1 * (1 - b + b * len(tokens) / average_length))
+        scores.append(score)
+    return scores
+
+def build_adaptive_rerank_postprocessor(cohere_rerank, top_n: int):
+    """
+        Rerank stage keeping the `top_n` best nodes, that only pays for a rerank when it can change the answer:
+        - when the best vector score clearly beats the others (rerank_settings.score_margin), the vector order is kept,
+        - results are cached per (query, candidate node IDs and texts), so an updated node is reranked again,
+        - otherwise the nodes go to Cohere, or to a local BM25 reranker over the node text (the window, once the
+          window post processors ran) when Cohere is not configured or fails.
+        cohere_rerank may be None.
+    """
+    from llama_index.postprocessor.types import BaseNodePostprocessor
+    from llama_index.bridge.pydantic import PrivateAttr
+    from llama_index.schema import NodeWithScore
+
+    class AdaptiveRerankPostprocessor(BaseNodePostprocessor):
+        _cohere_rerank = PrivateAttr()
+        _top_n: int = PrivateAttr()
+        _cache: LRUCache = PrivateAttr()
+        _cache_lock: threading.Lock = PrivateAttr()
+
+        def __init__(self, cohere_rerank, top_n: int):
+            super().__init__()
+            self._cohere_rerank = cohere_rerank
+            self._top_n = top_n
+            self._cache = LRUCache(maxsize=rerank_settings.cache_size)
+            self._cache_lock = threading.Lock()
+
+        @classmethod
+        def class_name(cls) -> str:
+            return "AdaptiveRerankPostprocessor"
+
+        def _lexical_rerank(self, nodes, query: str):
+            scores = bm25_scores(query, [n.node.get_content() for n in nodes])
+            ranked = sorted(zip(nodes, scores), key=lambda pair: pair[1], reverse=True)
+            return [NodeWithScore(node=n.node, score=score) for n, score in ranked[:self._top_n]]
+
+        def _rerank(self, nodes, query_bundle) -> Tuple[List, str]:
+            if rerank_settings.backend == "cohere" and self._cohere_rerank is not None:
+                try:
+                    return self._cohere_rerank.postprocess_nodes(nodes, query_bundle=query_bundle), "cohere"
+                except Exception as e:
+                    logging.error(f"Cohere rerank failed, falling back to the lexical reranker: {e}")
+            return self._lexical_rerank(nodes, query_bundle.query_str), "lexical"
+
+        def _postprocess_nodes(self, nodes, query_bundle=None):
+            started_at = time.perf_counter()
+            if query_bundle is None or len(nodes) <= 1:
+                rerank_stats.record("skipped", time.perf_counter() - started_at)
+                return nodes[:self._top_n]
+
+            scores = sorted((n.score or 0.0 for n in nodes), reverse=True)
+            if scores[0] - scores[1] >= rerank_settings.score_margin:
+                rerank_stats.record("skipped", time.perf_counter() - started_at)
+                return sorted(nodes, key=lambda n: n.score or 0.0, reverse=True)[:self._top_n]
+
+            # Node IDs are stable across updates of a document (see stable_node_id), the text the reranker reads
+            # is part of the key too.
+            cache_key = (query_bundle.query_str, tuple(sorted((n.node.node_id, hash(n.node.get_content())) for n in nodes)))
+            with self._cache_lock:
+                cached: Optional[List[Tuple[str, float]]] = self._cache.get(cache_key)
+            if cached is not None:
+                by_id = {n.node.node_id: n.node for n in nodes}
+                rerank_stats.record("cache_hit", time.perf_counter() - started_at)
+                return [NodeWithScore(node=by_id[node_id], score=score) for node_id, score in cached]
+
+            reranked, outcome = self._rerank(nodes, query_bundle)
+            with self._cache_lock:
+                self._cache[cache_key] = [(n.node.node_id, n.score) for n in reranked]
+            rerank_stats.record(outcome, time.perf_counter() - started_at)
+            return reranked
+
+    return AdaptiveRerankPostprocessor(cohere_rerank, top_n)
@@ -2,21 +2,56 @@ from langchain.text_splitter import RecursiveCharacterTextSplitter
 import tiktoken
 from langchain.docstore.document import Document
 from typing import List, Dict
+from functools import lru_cache
+from langchain_core.messages import BaseMessage
 from urlextract import URLExtract
 from datetime import datetime
 import pytz
 from llama_index.schema import NodeWithScore
 
-# Function to count the number of tokens using tiktoken. (IGNORE)
+# The encoder is built once per process, building it on every call costs more than encoding a short message.
+@lru_cache(maxsize=None)
+def get_tokenizer(encoding_name: str = 'cl100k_base'):
+    return tiktoken.get_encoding(encoding_name)
+
+# Function to count the number of tokens using tiktoken.
 # https://github.com/openai/tiktoken
 def tiktoken_len(text):
-    tokenizer = tiktoken.get_encoding('cl100k_base')
-    tokens = tokenizer.encode(
+    tokens = get_tokenizer().encode(
         text,
         disallowed_special=()
     )
     return len(tokens)
 
+# Tokens that OpenAI adds around every chat message (role and separators) and once per request to prime the reply,
+# as counted by ChatOpenAI.get_num_tokens_from_messages for gpt-3.5-turbo.
+TOKENS_PER_MESSAGE = 5
+TOKENS_PER_REQUEST = 3
+
+# Function to count the tokens of a chat message. The count is computed once and stored in the message's
+# additional_kwargs, so that it is saved along with the message in the chat history and never computed again.
+def message_token_count(message: BaseMessage) -> int:
+    token_count = message.additional_kwargs.get("token_count")
+    if token_count is None:
+        content = message.content if isinstance(message.content, str) else str(message.content)
+        token_count = tiktoken_len(content) + TOKENS_PER_MESSAGE
+        message.additional_kwargs["token_count"] = token_count
+    return token_count
+
+# Stamp the token count on a new message before it is written to the chat history.
+def with_token_count(message: BaseMessage) -> BaseMessage:
+    message_token_count(message)
+    return message
+
+# Function to keep the most recent messages that fit in max_tokens, with a single pass over the stored counts.
+def prune_messages_to_token_limit(messages: List[BaseMessage], max_tokens: int) -> List[BaseMessage]:
+    total_tokens = TOKENS_PER_REQUEST
+    start = len(messages)
+    while start > 0 and total_tokens + message_token_count(messages[start - 1]) <= max_tokens:
+        start -= 1
+        total_tokens += message_token_count(messages[start])
+    return messages[start:]
+
 # Function to split long texts into chunks based on number of tokens (not number of characters) (IGNORE)
 def split_text_by_token(text: str) -> List[Document]:
     text_splitter = RecursiveCharacterTextSplitter(
@@ -55,6 +90,11 @@ def str_to_datetime(date: str) -> datetime:
     parsed_date = date.datetime.strptime(date, "%Y-%m-%d %H:%M:%S")
     return parsed_date
 
+# Cosine similarity of two embeddings, eg. of two queries.
+def cosine_similarity(a: List[float], b: List[float]) -> float:
+    norm = (sum(x * x for x in a) * sum(y * y for y in b)) ** 0.5
+    return sum(x * y for x, y in zip(a, b)) / norm if norm else 0.0
+
 # Function for merging media ids of a list of documents into a unique media ids.
 # This function will be used in the Retrieve agent tool implementation.
 def merge_nodes_to_source(nodes: List[NodeWithScore]) -> List[str]:
@@ -73,6 +113,10 @@ def merge_nodes_to_source(nodes: List[NodeWithScore]) -> List[str]:
         else:
             source_dict[node_source] = 1
 
+    # Nothing was retrieved.
+    if not source_dict:
+        return []
+
     max_frequency = max(source_dict.values())
 
     max_frequency_keys = [key for key, value in source_dict.items() if value == max_frequency]
@@ -1,4 +1,72 @@
 import logging
+import threading
+import time
+import weakref
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import List, Optional, Union
+
+# One lock per URL being ingested in this process, dropped once nobody holds it. The threads of a process wait on
+# it, the registry claim (see document_registry.claimed) is what keeps other processes from ingesting the URL too.
+_url_locks: "weakref.WeakValueDictionary[str, threading.Lock]" = weakref.WeakValueDictionary()
+_url_locks_guard = threading.Lock()
+
+def _url_lock(source_url: str) -> threading.Lock:
+    with _url_locks_guard:
+        lock = _url_locks.get(source_url)
+        if lock is None:
+            lock = _url_locks[source_url] = threading.Lock()
+        return lock
+
+def fetch_url_content(source_url: str) -> str:
+    import trafilatura
+    # Fetch the contents of the url using trafilatura
+    # Documentation - https://trafilatura.readthedocs.io/en/latest/
+    downloaded = trafilatura.fetch_url(
+        url=source_url
+    )
+    return trafilatura.extract(downloaded)
+
+def url_document_metadata(group_id: Union[str, List[str]], source_url: str, caption: str) -> dict:
+    """Metadata stored with every node of an ingested URL. group_id is a list of wa_ids for shared documents."""
+    from app.services.service_utilities import (
+        get_current_time,
+        datetime_to_str
+    )
+    return {
+        'group_id': group_id,
+        'type': 'rag',
+        'media_id':source_url,
+        'source': source_url,
+        'source_type': 'url',
+        "caption":caption,
+        'date': datetime_to_str(get_current_time())
+    }
+
+@dataclass
+class UrlIngestion:
+    """Outcome of the ingestion of one URL of a batch."""
+    source_url: str
+    content: Optional[str] = None
+    content_hash: Optional[str] = None
+    doc_id: Optional[str] = None
+    # Summary on record for a URL that was already indexed.
+    summary: Optional[str] = None
+    error: Optional[str] = None
+
+    @property
+    def ok(self) -> bool:
+        return self.error is None
+
+def set_document_members(vector_store, doc_id: str, members: List[str]) -> None:
+    """Overwrite the group_id array of every point of a shared document."""
+    from qdrant_client.http import models
+    vector_store.client.set_payload(
+        collection_name=vector_store.collection_name,
+        payload={"group_id": members},
+        points=models.Filter(must=[models.FieldCondition(key="doc_id", match=models.MatchValue(value=doc_id))])
+    )
 
 def process_url_document(
     source_url: str, 
@@ -7,52 +75,276 @@ def process_url_document(
     qdrant_api_key:str, 
     qdrant_url: str, 
     qdrant_collection_name: str, 
-    openai_api_key:str
+    openai_api_key:str,
+    document_registry = None
     ):
+    """
+        Index the content of a URL and return its summary. With a document registry, a URL whose content is
+        already in the user's index is not summarised and embedded again, and a URL whose content changed
+        replaces the points of its previous version.
+    """
     try:
         from llama_index import (
             Document
         )
         from app.services.databases.qdrant_setup import build_sentence_window_index
-        from app.services.service_utilities import (
-            get_current_time, 
-            datetime_to_str
-        )
-        import trafilatura
         from app.services.service_utilities import generate_summary
+        from app.services.ingestion_pipeline import document_id, index_text_stream
+        from app.services.databases.document_registry import content_fingerprint, commit_document, discard_document
 
-        # Fetch the contents of the url using trafilatura
-        # Documentation - https://trafilatura.readthedocs.io/en/latest/
-        downloaded = trafilatura.fetch_url(
-            url=source_url
-        )
-        content = trafilatura.extract(downloaded)
+        content = fetch_url_content(source_url)
+
+        # Skip the summary and the embedding if the user already has this exact content indexed.
+        content_hash = content_fingerprint(content)
+        if document_registry is not None:
+            existing = document_registry.get(wa_id, source_url)
+            if existing is None or existing.content_hash != content_hash:
+                existing = document_registry.find_by_content(wa_id, content_hash)
+            if existing is not None:
+                logging.info(f"{source_url} is already indexed for this user, reusing its summary.")
+                return existing.summary
 
-        # Create a document using content of the URL
+        # Create a document using content of the URL. Every version of the content gets its own ID, so that a
+        # new version can be stored before the old one is deleted.
         document = Document(
+            id_ = document_id(wa_id, source_url, content_hash),
             text = content,
-            metadata= {
-                'group_id': wa_id,
-                'type': 'rag',
-                'media_id':source_url,
-                'source': source_url,
-                'source_type': 'url',
-                "caption":caption,
-                'date': datetime_to_str(get_current_time())
-            }
+            metadata= url_document_metadata(wa_id, source_url, caption)
         )
         # Generate summary of the first 3000 characters
         summary = generate_summary(document.text[:3000], openai_api_key)
         
         # Insert the document of the vector store
         sentence_index = build_sentence_window_index(openai_api_key, qdrant_url, qdrant_api_key, qdrant_collection_name)
-        sentence_index.insert(document=document)
+        try:
+            index_text_stream([document.text], document.metadata, document.doc_id, sentence_index)
+        except Exception:
+            if document_registry is not None:
+                discard_document(document_registry, sentence_index.vector_store, wa_id, source_url, document.doc_id)
+            raise
+        if document_registry is not None:
+            commit_document(document_registry, sentence_index.vector_store, wa_id, source_url, content_hash, document.doc_id, summary, document.metadata)
         
         return summary
         
     except Exception as e:
         logging.error(f"An error occurred while indexing html: {e}")
 
+def process_shared_url_document(
+    source_url: str,
+    wa_id:str,
+    qdrant_api_key:str,
+    qdrant_url: str,
+    qdrant_collection_name: str,
+    openai_api_key:str,
+    document_registry,
+    max_age_seconds: float = 86400
+    ):
+    """
+        Shared corpus mode of process_url_document. The content of a URL is fetched, summarised and embedded once
+        for all users: its points carry the wa_ids of the users who sent it in a group_id array, which the
+        group_id ExactMatchFilter of the retrievers matches as before. Another user sending the same link only
+        adds their wa_id to that array. The content is fetched again once it is older than `max_age_seconds`,
+        and a changed page replaces the points of its previous version, keeping all of its members.
+        The caption is not stored, since the points are shared between users.
+    """
+    try:
+        from llama_index import (
+            Document
+        )
+        from app.services.databases.qdrant_setup import build_sentence_window_index
+        from app.services.service_utilities import generate_summary
+        from app.services.ingestion_pipeline import document_id, index_text_stream
+        from app.services.answer_cache import answer_cache
+        from app.services.databases.document_catalog import get_document_catalog
+        from app.services.databases.document_registry import (
+            SHARED_CORPUS_GROUP,
+            claimed,
+            content_fingerprint,
+            commit_document,
+            discard_document
+        )
+
+        sentence_index = build_sentence_window_index(openai_api_key, qdrant_url, qdrant_api_key, qdrant_collection_name)
+        vector_store = sentence_index.vector_store
+
+        def share_with_user(record):
+            members = document_registry.members(source_url)
+            if wa_id not in members:
+                set_document_members(vector_store, record.doc_id, sorted(members + [wa_id]))
+                document_registry.add_member(source_url, wa_id)
+                answer_cache.invalidate(wa_id)
+                if get_document_catalog() is not None:
+                    get_document_catalog().share(source_url, wa_id)
+            return record.summary
+
+        # A link forwarded to many users at once is fetched and embedded only once, by whichever worker gets here first.
+        with _url_lock(source_url), claimed(document_registry, source_url):
+            shared = document_registry.get(SHARED_CORPUS_GROUP, source_url)
+            if shared is not None and time.time() - shared.indexed_at < max_age_seconds:
+                logging.info(f"{source_url} is in the shared corpus, adding the user to its members.")
+                return share_with_user(shared)
+
+            content = fetch_url_content(source_url)
+            content_hash = content_fingerprint(content)
+            if shared is not None and shared.content_hash == content_hash:
+                # Unchanged since it was indexed, only its age is reset.
+                document_registry.record(SHARED_CORPUS_GROUP, source_url, content_hash, shared.doc_id, shared.summary)
+                return share_with_user(shared)
+
+            # New or changed page. A new version is visible to everyone who could see the previous one.
+            members = sorted(set(document_registry.members(source_url)) | {wa_id})
+            document = Document(
+                id_ = document_id(SHARED_CORPUS_GROUP, source_url, content_hash),
+                text = content,
+                metadata= url_document_metadata(members, source_url, "")
+            )
+            # Generate summary of the first 3000 characters
+            summary = generate_summary(document.text[:3000], openai_api_key)
+            try:
+                index_text_stream([document.text], document.metadata, document.doc_id, sentence_index)
+            except Exception:
+                discard_document(document_registry, vector_store, SHARED_CORPUS_GROUP, source_url, document.doc_id)
+                raise
+            document_registry.add_member(source_url, wa_id)
+            commit_document(document_registry, vector_store, SHARED_CORPUS_GROUP, source_url, content_hash, document.doc_id, summary, document.metadata)
+            return summary
+
+    except Exception as e:
+        logging.error(f"An error occurred while indexing html: {e}")
+
+def combined_summary_text(ingestions: List[UrlIngestion], head_chars: int = 3000) -> str:
+    """The beginnings of several pages, together no longer than the beginning of one page used to be."""
+    per_page_chars = max(head_chars // max(len(ingestions), 1), 500)
+    return "\n\n".join(f"Source: {i.source_url}\n{i.content[:per_page_chars]}" for i in ingestions)
+
+def process_url_batch(
+    source_urls: List[str],
+    wa_id:str,
+    caption:str,
+    qdrant_api_key:str,
+    qdrant_url: str,
+    qdrant_collection_name: str,
+    openai_api_key:str,
+    document_registry = None,
+    max_workers: int = 4,
+    batch_size: Optional[int] = None,
+    summary_timeout: Optional[float] = None,
+    index_timeout: Optional[float] = None
+    ):
+    """
+        Index all the URLs of a message together and return (combined summary, ingestion of each URL).
+        - pages are fetched and extracted in parallel by up to `max_workers` threads,
+        - the sentences of all the pages go through the same embedding and upsert batches,
+        - one summary is generated for all the new pages, from as much text as a single page used to be,
+          at the same time as the embedding. That one is for the user's reply, a page is only recorded with it
+          if it is the only one, otherwise with an excerpt of its own text (see excerpt_summary).
+        A URL that can not be fetched, extracted or stored is reported as failed without affecting the others,
+        and the points it stored are deleted. If the index stage times out, the pages are recorded (or their points
+        deleted) once it is over. URLs already indexed for the user are reported with their stored summary.
+    """
+    from app.services.databases.qdrant_setup import build_sentence_window_index
+    from app.services.databases.document_registry import content_fingerprint, commit_document, discard_document, delete_document_points, excerpt_summary
+    from app.services.ingestion_orchestrator import IngestionOrchestrator
+    from app.services.databases.sentence_store import get_sentence_store
+    from app.services.ingestion_pipeline import document_id, embed_and_upsert, iter_sentences, iter_window_nodes
+    from app.services.service_utilities import generate_summary
+    sentence_store = get_sentence_store()
+
+    def fetch(source_url: str) -> UrlIngestion:
+        ingestion = UrlIngestion(source_url)
+        try:
+            ingestion.content = fetch_url_content(source_url)
+            if not ingestion.content:
+                raise ValueError("no text could be extracted")
+            ingestion.content_hash = content_fingerprint(ingestion.content)
+            if document_registry is not None:
+                existing = document_registry.get(wa_id, source_url)
+                if existing is None or existing.content_hash != ingestion.content_hash:
+                    existing = document_registry.find_by_content(wa_id, ingestion.content_hash)
+                if existing is not None:
+                    ingestion.summary = existing.summary
+                    return ingestion
+            ingestion.doc_id = document_id(wa_id, source_url, ingestion.content_hash)
+        except Exception as e:
+            logging.error(f"An error occurred while fetching {source_url}: {e}")
+            ingestion.error = str(e)
+        return ingestion
+
+    with ThreadPoolExecutor(max_workers=max(min(max_workers, len(source_urls)), 1), thread_name_prefix="url-fetch") as pool:
+        ingestions = list(pool.map(fetch, source_urls))
+    new_pages = [i for i in ingestions if i.ok and i.doc_id is not None]
+    if not new_pages:
+        return None, ingestions
+
+    sentence_index = build_sentence_window_index(openai_api_key, qdrant_url, qdrant_api_key, qdrant_collection_name)
+    vector_store = sentence_index.vector_store
+    nodes_per_page = {}
+
+    def page_nodes():
+        for page in new_pages:
+            nodes = list(iter_window_nodes(
+                iter_sentences([page.content]),
+                url_document_metadata(wa_id, page.source_url, caption),
+                page.doc_id,
+                sentence_store=sentence_store
+            ))
+            nodes_per_page[page.doc_id] = len(nodes)
+            yield from nodes
+
+    stored_per_page = defaultdict(int)
+    def count_stored(batch):
+        for node in batch:
+            stored_per_page[node.ref_doc_id] += 1
+
+    orchestrator = IngestionOrchestrator(f"{len(new_pages)} urls")
+    orchestrator.start("summary", generate_summary, combined_summary_text(new_pages), openai_api_key, timeout=summary_timeout)
+    index_future = orchestrator.start(
+        "index",
+        embed_and_upsert,
+        page_nodes(),
+        sentence_index.service_context.embed_model,
+        vector_store,
+        batch_size=batch_size,
+        on_stored=count_stored,
+        timeout=index_timeout
+    )
+    results = orchestrator.wait()
+    summary = results["summary"].result if results["summary"].ok else None
+
+    def stored_completely(page: UrlIngestion) -> bool:
+        # A page counts as stored only once all its nodes are upserted.
+        return page.doc_id in nodes_per_page and stored_per_page[page.doc_id] == nodes_per_page[page.doc_id]
+
+    def record_pages(indexed: bool):
+        for page in new_pages:
+            try:
+                if indexed or stored_completely(page):
+                    if document_registry is not None:
+                        # The combined summary of a single page is that page's own summary.
+                        page_summary = summary if len(new_pages) == 1 and summary is not None else excerpt_summary(page.content)
+                        commit_document(
+                            document_registry, vector_store, wa_id, page.source_url, page.content_hash, page.doc_id, page_summary,
+                            url_document_metadata(wa_id, page.source_url, caption)
+                        )
+                else:
+                    page.error = "indexing failed"
+                    if document_registry is not None:
+                        discard_document(document_registry, vector_store, wa_id, page.source_url, page.doc_id)
+                    else:
+                        delete_document_points(vector_store, page.doc_id)
+            except Exception as e:
+                logging.error(f"An error occurred while recording {page.source_url}: {e}")
+
+    if results["index"].timed_out:
+        # The stage is still running and storing points, the pages are recorded or cleaned up once it is over.
+        for page in new_pages:
+            if not stored_completely(page):
+                page.error = "indexing failed"
+        index_future.add_done_callback(lambda future: record_pages(not future.cancelled() and future.exception() is None))
+    else:
+        record_pages(results["index"].ok)
+    return summary, ingestions
+
 if __name__ == "__main__":
     pass
-    
\ No newline at end of file
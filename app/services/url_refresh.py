@@ -0,0 +1,201 @@
+import argparse
+import hashlib
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import List, Optional
+
+@dataclass
+class FetchResult:
+    html: str
+    etag: Optional[str]
+    last_modified: Optional[str]
+
+@dataclass
+class RefreshResult:
+    source_url: str
+    # "indexed" (first time), "updated", "unchanged", "not_modified" (HTTP 304) or "failed".
+    status: str
+    upserted: int = 0
+    deleted: int = 0
+    summary: Optional[str] = None
+
+def conditional_fetch(source_url: str, etag: Optional[str] = None, last_modified: Optional[str] = None, timeout: float = 30) -> Optional[FetchResult]:
+    """Fetch a page unless it is unchanged since the given validators were received. Returns None on 304 Not Modified."""
+    import requests
+    headers = {"User-Agent": "Mozilla/5.0 (compatible; realtyai-url-refresh)"}
+    if etag:
+        headers["If-None-Match"] = etag
+    if last_modified:
+        headers["If-Modified-Since"] = last_modified
+    response = requests.get(source_url, headers=headers, timeout=timeout)
+    if response.status_code == 304:
+        return None
+    response.raise_for_status()
+    return FetchResult(response.text, response.headers.get("ETag"), response.headers.get("Last-Modified"))
+
+def _point_hash(node) -> str:
+    # A point has to be rewritten if its sentence or its window changed, or with the compact window storage,
+    # the position of its sentence.
+    window = node.metadata.get("window", node.metadata.get("sentence_position", ""))
+    return hashlib.sha256(f"{node.text}\0{window}".encode("utf-8")).hexdigest()
+
+class _PendingSentences:
+    """Stands in for the sentence store while nodes are built, and writes what they stored once told to."""
+    def __init__(self):
+        self.calls = []
+
+    def put(self, doc_id, sentences):
+        self.calls.append(("put", doc_id, list(sentences)))
+
+    def truncate(self, doc_id, length):
+        self.calls.append(("truncate", doc_id, length))
+
+    def write(self, sentence_store) -> None:
+        for method, doc_id, argument in self.calls:
+            getattr(sentence_store, method)(doc_id, argument)
+
+def refresh_url(
+    source_url: str,
+    wa_id: str,
+    caption: str,
+    qdrant_api_key: str,
+    qdrant_url: str,
+    qdrant_collection_name: str,
+    openai_api_key: str,
+    document_registry,
+    batch_size: Optional[int] = None
+    ) -> RefreshResult:
+    """
+        Index a URL for a user, or bring an already indexed one up to date, for as little bandwidth and as few
+        embedding calls as possible:
+        - the page is fetched with If-None-Match/If-Modified-Since, a 304 answer ends the refresh,
+        - an unchanged extracted text ends it too,
+        - otherwise the sentences are diffed against the ones indexed last time. Points have stable IDs, only the
+          points of new sentences, or of sentences whose window changed, are upserted, and the points of removed
+          sentences are deleted. Only the sentence is embedded, so a sentence whose window changed is served by
+          the embedding cache.
+        The summary is generated again only if the beginning of the page changed.
+        A URL with no document on record (eg. its first indexing failed half way) is always fetched and indexed in full.
+    """
+    import trafilatura
+    from qdrant_client.http import models
+    from app.services.databases.qdrant_setup import build_sentence_window_index
+    from app.services.databases.document_registry import UrlState, content_fingerprint, commit_document
+    from app.services.databases.sentence_store import get_sentence_store
+    from app.services.ingestion_pipeline import document_id, embed_and_upsert, iter_sentences, iter_window_nodes
+    from app.services.service_utilities import generate_summary
+    from app.services.url_handling import url_document_metadata
+    from app.services.answer_cache import answer_cache
+
+    state = document_registry.get_url_state(wa_id, source_url)
+    record = document_registry.get(wa_id, source_url)
+    stored_summary = record.summary if record is not None else None
+    # The validators and the diff are only trusted if the last indexing got as far as recording the document.
+    indexed = state is not None and record is not None
+
+    fetched = conditional_fetch(source_url, state.etag if indexed else None, state.last_modified if indexed else None)
+    if fetched is None:
+        state.fetched_at = time.time()
+        document_registry.save_url_state(state)
+        return RefreshResult(source_url, "not_modified", summary=stored_summary)
+
+    content = trafilatura.extract(fetched.html)
+    if not content:
+        raise ValueError(f"No text could be extracted from {source_url}")
+    content_hash = content_fingerprint(content)
+    head_hash = content_fingerprint(content[:3000])
+    caption = caption if caption is not None else (state.caption if state else "")
+    if indexed and state.content_hash == content_hash:
+        document_registry.save_url_state(UrlState(
+            wa_id, source_url, caption, fetched.etag, fetched.last_modified, content_hash, head_hash, state.points, time.time()
+        ))
+        return RefreshResult(source_url, "unchanged", summary=stored_summary)
+
+    # Diff the sentences of the page against the points stored the last time. The sentences are only written to
+    # the sentence store once the points referring to them are upserted.
+    doc_id = document_id(wa_id, source_url)
+    sentence_store = get_sentence_store()
+    pending_sentences = _PendingSentences() if sentence_store is not None else None
+    nodes = list(iter_window_nodes(
+        iter_sentences([content]),
+        url_document_metadata(wa_id, source_url, caption),
+        doc_id,
+        stable_ids=True,
+        sentence_store=pending_sentences
+    ))
+    previous_points = state.points if state is not None else {}
+    points = {node.node_id: _point_hash(node) for node in nodes}
+    changed = [node for node in nodes if previous_points.get(node.node_id) != points[node.node_id]]
+    removed = [point_id for point_id in previous_points if point_id not in points]
+
+    sentence_index = build_sentence_window_index(openai_api_key, qdrant_url, qdrant_api_key, qdrant_collection_name)
+    vector_store = sentence_index.vector_store
+    # New points first, then the removed ones, so a search never misses the page.
+    upserted = embed_and_upsert(changed, sentence_index.service_context.embed_model, vector_store, batch_size=batch_size)
+    if pending_sentences is not None:
+        pending_sentences.write(sentence_store)
+    if removed:
+        vector_store.client.delete(
+            collection_name=vector_store.collection_name,
+            points_selector=models.PointIdsList(points=removed)
+        )
+        answer_cache.invalidate(wa_id)
+
+    summary = stored_summary
+    if summary is None or not indexed or state.head_hash != head_hash:
+        summary = generate_summary(content[:3000], openai_api_key)
+    commit_document(document_registry, vector_store, wa_id, source_url, content_hash, doc_id, summary, url_document_metadata(wa_id, source_url, caption))
+    document_registry.save_url_state(UrlState(
+        wa_id, source_url, caption, fetched.etag, fetched.last_modified, content_hash, head_hash, points, time.time()
+    ))
+    logging.info(f"Refreshed {source_url}: {upserted} points upserted, {len(removed)} deleted, {len(nodes) - len(changed)} kept.")
+    return RefreshResult(source_url, "indexed" if state is None else "updated", upserted, len(removed), summary)
+
+def refresh_tracked_urls(
+    document_registry,
+    qdrant_api_key: str,
+    qdrant_url: str,
+    qdrant_collection_name: str,
+    openai_api_key: str,
+    older_than_seconds: float = 0,
+    max_workers: int = 4
+    ) -> List[RefreshResult]:
+    """Refresh every tracked URL last fetched more than `older_than_seconds` ago. A failing URL does not stop the others."""
+    def refresh(tracked):
+        wa_id, source_url = tracked
+        try:
+            return refresh_url(source_url, wa_id, None, qdrant_api_key, qdrant_url, qdrant_collection_name, openai_api_key, document_registry)
+        except Exception as e:
+            logging.error(f"An error occurred while refreshing {source_url}: {e}")
+            return RefreshResult(source_url, "failed")
+
+    tracked_urls = document_registry.tracked_urls(fetched_before=time.time() - older_than_seconds)
+    with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="url-refresh") as pool:
+        results = list(pool.map(refresh, tracked_urls))
+    statuses = {}
+    for result in results:
+        statuses[result.status] = statuses.get(result.status, 0) + 1
+    logging.info(f"Refreshed {len(results)} URLs: {statuses}, {sum(r.upserted for r in results)} points upserted.")
+    return results
+
+if __name__ == "__main__":
+    # Meant to be run periodically, eg. from cron:
+    # python -m app.services.url_refresh --older-than 86400
+    parser = argparse.ArgumentParser(description="Re-index the tracked URLs that changed since they were last fetched.")
+    parser.add_argument("--older-than", type=float, default=0, help="Only refresh URLs fetched more than this many seconds ago.")
+    parser.add_argument("--workers", type=int, default=4, help="URLs refreshed at the same time.")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    from app.tasks import document_registry, QDRANT_API_KEY, QDRANT_URL, QDRANT_COLLECTION_NAME, OPENAI_API_KEY
+    refresh_tracked_urls(
+        document_registry,
+        QDRANT_API_KEY,
+        QDRANT_URL,
+        QDRANT_COLLECTION_NAME,
+        OPENAI_API_KEY,
+        older_than_seconds=args.older_than,
+        max_workers=args.workers
+    )
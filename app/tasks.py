@@ -1,19 +1,44 @@
 from app.services.general_utilities import (
-    get_media_file_content_from_whatsapp,
+    stream_media_file_from_whatsapp,
+    tee_stream,
+    S3MultipartUpload,
+    MediaTooLargeError,
     process_text_for_whatsapp,
     send_message,
     get_text_message_input,
-    get_media_message_input,
-    write_file_to_s3,
-    read_file_from_s3
+    get_media_message_input
     )
-from app.services.pdf_handling import process_pdf_document
-from app.services.url_handling import process_url_document
+from app.services.pdf_handling import (
+    read_pdf_head,
+    index_pdf_pages,
+    pdf_document_metadata,
+    record_pdf_ingestion
+    )
+from app.services.service_utilities import generate_summary
+from app.services.ingestion_orchestrator import IngestionOrchestrator
+from app.services.embedding_service import configure_embeddings
+from app.services.databases.sentence_store import configure_sentence_store
+from app.services.reranking import configure_reranking
+from app.services.answer_cache import answer_cache
+from app.services.url_handling import process_url_document, process_shared_url_document, process_url_batch
+from app.services.url_refresh import refresh_url
 from app.services.conversation_service import RealtyaiBot
-from app.services.databases.dynamodb_setup import DynamoDBSessionManagement
-from langchain_core.messages import SystemMessage
+from app.services.databases.dynamodb_setup import get_session_history
+from app.services.databases.session_cache import SessionHistoryCache
+from app.services.databases.artifact_store import DynamoDBArtifactStore, artifact_message
+from app.services.history_compaction import HistoryCompactor, compact_session
+from app.services.databases.document_registry import DocumentRegistry, excerpt_summary
+from app.services.databases.document_catalog import configure_document_catalog
+from app.services.databases.qdrant_setup import configure_qdrant_path, get_embed_model
+from app.services.ingestion_pipeline import document_id
+import hashlib
 import logging
 import os
+import queue
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
 load_dotenv()
 
@@ -24,6 +49,10 @@ AWS_ACCESS_KEY=os.getenv("AWS_ACCESS_KEY_ID")
 AWS_SECRET_KEY=os.getenv("AWS_SECRET_ACCESS_KEY")
 AWS_BUCKET_NAME=os.getenv("AWS_BUCKET_NAME")
 DYNAMODB_TABLE_NAME = os.getenv("DYNAMODB_TABLE_NAME")
+# Optional table (partition key "ArtifactId") keeping search results and document summaries out of the chat history.
+DYNAMODB_ARTIFACT_TABLE_NAME = os.getenv("DYNAMODB_ARTIFACT_TABLE_NAME")
+# "single_item" keeps the whole history in one item, "item_per_message" needs a table with a sort key.
+DYNAMODB_HISTORY_MODE = os.getenv("DYNAMODB_HISTORY_MODE", "single_item")
 QDRANT_URL = os.getenv("QDRANT_URL")
 QDRANT_API_KEY = os.getenv("QDRANT_API_KEY")
 QDRANT_COLLECTION_NAME = os.getenv("COLLECTION_NAME")
@@ -31,6 +60,133 @@ WHATSAPP_ACCESS_TOKEN = os.getenv("WHATSAPP_ACCESS_TOKEN")
 WHATSAPP_PHONE_NUMBER_ID = os.getenv("WHATSAPP_PHONE_NUMBER_ID")
 WHATSAPP_VERSION = os.getenv("WHATSAPP_VERSION")
 COHERE_API_KEY = os.getenv("COHERE_API_KEY")
+# Media bigger than this is refused while it is being downloaded (Whatsapp allows documents up to 100 MB).
+WHATSAPP_MAX_MEDIA_BYTES = int(os.getenv("WHATSAPP_MAX_MEDIA_BYTES", 100 * 1024 * 1024))
+# Downloaded media is kept in memory up to this size, and spills over to a temporary file beyond it.
+MEDIA_SPOOL_MAX_MEMORY_BYTES = int(os.getenv("MEDIA_SPOOL_MAX_MEMORY_BYTES", 16 * 1024 * 1024))
+# Timeouts, in seconds, of the stages of a PDF ingestion.
+INGESTION_SUMMARY_TIMEOUT = float(os.getenv("INGESTION_SUMMARY_TIMEOUT", 120))
+INGESTION_INDEX_TIMEOUT = float(os.getenv("INGESTION_INDEX_TIMEOUT", 600))
+INGESTION_ARCHIVE_TIMEOUT = float(os.getenv("INGESTION_ARCHIVE_TIMEOUT", 300))
+# Shared corpus mode: a URL is fetched and embedded once for all the users who send it.
+URL_SHARED_CORPUS = os.getenv("URL_SHARED_CORPUS", "false").lower() in ("1", "true", "yes")
+# Age after which a shared URL is fetched again when someone sends it.
+URL_SHARED_MAX_AGE_SECONDS = float(os.getenv("URL_SHARED_MAX_AGE_SECONDS", 86400))
+# Incremental mode: URLs are tracked, fetched conditionally and only their changed sentences are re-embedded.
+# Tracked URLs are refreshed with: python -m app.services.url_refresh
+URL_INCREMENTAL_INDEXING = os.getenv("URL_INCREMENTAL_INDEXING", "false").lower() in ("1", "true", "yes")
+# Links of one message fetched at the same time.
+URL_BATCH_MAX_WORKERS = int(os.getenv("URL_BATCH_MAX_WORKERS", 4))
+
+# QDRANT_PATH (a directory, or ":memory:") runs Qdrant embedded in the process instead of connecting to QDRANT_URL.
+configure_qdrant_path(os.getenv("QDRANT_PATH"))
+
+# Embedding API batches: texts per request, requests in flight, and the persistent cache of embedded texts.
+configure_embeddings(
+    batch_size=int(os.getenv("EMBEDDING_BATCH_SIZE", 100)),
+    max_in_flight=int(os.getenv("EMBEDDING_MAX_IN_FLIGHT", 4)),
+    max_retries=int(os.getenv("EMBEDDING_MAX_RETRIES", 6)),
+    cache_path=os.getenv("EMBEDDING_CACHE_PATH") or None,
+    backend=os.getenv("EMBEDDING_BACKEND", "openai"),
+    query_cache_size=int(os.getenv("QUERY_EMBEDDING_CACHE_SIZE", 2048))
+)
+
+# Write-behind cache of the chat histories. Turns read the history from memory and all the messages written
+# during a turn are flushed to DynamoDB with a single write once the reply is sent.
+session_cache = SessionHistoryCache(
+    lambda session_id: get_session_history(DYNAMODB_TABLE_NAME, session_id, AWS_ACCESS_KEY, AWS_SECRET_KEY, DYNAMODB_HISTORY_MODE),
+    max_sessions=int(os.getenv("SESSION_CACHE_MAX_SESSIONS", 1000)),
+    ttl_seconds=int(os.getenv("SESSION_CACHE_TTL_SECONDS", 900))
+)
+# Every job flushes the sessions it wrote before it returns, nothing is left buffered when it ends. Worker processes
+# are terminated without running atexit handlers, so this is the only flush they get. In thread mode, the web
+# server's shutdown handler also flushes whatever is left.
+
+# Side store for the large texts referenced from the chat history. Without a table they stay inline.
+artifact_store = None
+if DYNAMODB_ARTIFACT_TABLE_NAME:
+    artifact_store = DynamoDBArtifactStore(DYNAMODB_ARTIFACT_TABLE_NAME, AWS_ACCESS_KEY, AWS_SECRET_KEY)
+
+# Rerank stage: Cohere is skipped when the best vector score leads by RERANK_SCORE_MARGIN, "lexical" never calls it.
+configure_reranking(
+    score_margin=float(os.getenv("RERANK_SCORE_MARGIN", 0.08)),
+    backend=os.getenv("RERANK_BACKEND", "cohere"),
+    cache_size=int(os.getenv("RERANK_CACHE_SIZE", 1024))
+)
+
+# Rag answers reused for near-identical questions of the same user, until something new is indexed for them.
+answer_cache.configure(
+    enabled=os.getenv("ANSWER_CACHE_ENABLED", "true").lower() in ("1", "true", "yes"),
+    threshold=float(os.getenv("ANSWER_CACHE_THRESHOLD", 0.95)),
+    max_entries=int(os.getenv("ANSWER_CACHE_MAX_ENTRIES", 32)),
+    ttl_seconds=float(os.getenv("ANSWER_CACHE_TTL_SECONDS", 3600))
+)
+
+# "inline" stores each sentence's window in its Qdrant point, "compact" only stores the sentence and its position,
+# and rebuilds the windows at query time from a local sentence store.
+SENTENCE_WINDOW_STORAGE = os.getenv("SENTENCE_WINDOW_STORAGE", "inline")
+if SENTENCE_WINDOW_STORAGE == "compact":
+    configure_sentence_store(os.getenv("SENTENCE_STORE_PATH", "data/sentence_store.sqlite3"))
+
+# Fingerprints of the documents already indexed for each user, so that re-sent files and links are not indexed twice.
+document_registry = DocumentRegistry(os.getenv("DOCUMENT_REGISTRY_PATH", "data/document_registry.sqlite3"))
+
+# Per-user catalog of the indexed documents, the Retrieve tool matches file requests against it instead of Qdrant.
+# Entries are matched on the embedding of their file name, caption and summary, and on keywords.
+configure_document_catalog(
+    os.getenv("DOCUMENT_CATALOG_PATH", "data/document_catalog.sqlite3"),
+    embed_text=lambda text: get_embed_model(OPENAI_API_KEY).get_text_embedding(text),
+    min_score=float(os.getenv("DOCUMENT_CATALOG_MIN_SCORE", 0.45))
+)
+
+# Start retrieving for a user's message while the agent is still picking a tool, for users with indexed documents.
+SPECULATIVE_RETRIEVAL = os.getenv("SPECULATIVE_RETRIEVAL", "false").lower() in ("1", "true", "yes")
+
+# The conversation agent is stateless between turns, so a single instance is built lazily and shared by all workers.
+_realtyai_bot = None
+_singleton_lock = threading.Lock()
+
+def get_realtyai_bot() -> RealtyaiBot:
+    global _realtyai_bot
+    if _realtyai_bot is None:
+        with _singleton_lock:
+            if _realtyai_bot is None:
+                _realtyai_bot = RealtyaiBot(
+                    max_token_length=1000, # Maximum number of tokens in chat history.
+                    openai_api_key=OPENAI_API_KEY,
+                    cohere_api_key=COHERE_API_KEY, 
+                    aws_access_key_id=AWS_ACCESS_KEY, 
+                    aws_secret_access_key=AWS_SECRET_KEY,
+                    qdrant_api_key=QDRANT_API_KEY,
+                    qdrant_url=QDRANT_URL,
+                    qdrant_collection_name=QDRANT_COLLECTION_NAME,
+                    whatsapp_version=WHATSAPP_VERSION,
+                    whatsapp_access_token=WHATSAPP_ACCESS_TOKEN,
+                    whatsapp_phone_number_id=WHATSAPP_PHONE_NUMBER_ID,
+                    dynamo_db_table_name=DYNAMODB_TABLE_NAME,
+                    history_storage_mode=DYNAMODB_HISTORY_MODE,
+                    session_cache=session_cache,
+                    artifact_store=artifact_store,
+                    speculative_retrieval=SPECULATIVE_RETRIEVAL,
+                    speculative_min_similarity=float(os.getenv("SPECULATIVE_MIN_SIMILARITY", 0.85))
+                )
+    return _realtyai_bot
+
+# Folds older turns into a rolling summary once a user's history passes the token threshold.
+_history_compactor = None
+
+def get_history_compactor() -> HistoryCompactor:
+    global _history_compactor
+    if _history_compactor is None:
+        with _singleton_lock:
+            if _history_compactor is None:
+                _history_compactor = HistoryCompactor(
+                    OPENAI_API_KEY,
+                    token_threshold=int(os.getenv("HISTORY_COMPACTION_TOKEN_THRESHOLD", 1500)),
+                    keep_last=int(os.getenv("HISTORY_COMPACTION_KEEP_LAST", 6)),
+                    retry_after_seconds=float(os.getenv("HISTORY_COMPACTION_RETRY_AFTER_SECONDS", 1800))
+                )
+    return _history_compactor
 
 def embedd_pdf(embed_pdf_request):
     """
@@ -47,65 +203,211 @@ def embedd_pdf(embed_pdf_request):
             "mime_type": "appliction/pdf"
         }
     """
-    # This is directory where we shall store the file temporarily.
-    temp_files_dir = "./app/temp_files_dir"
+    senders_wa_id = embed_pdf_request["senders_wa_id"]
     # This is the object key in of the file the S3 where we store the file permanently.
-    s3_object_key = f"user_resources/{embed_pdf_request['senders_wa_id']}/{embed_pdf_request['media_id']}.pdf"
-    # Check if the temporary files directory actually exists.
-    if not os.path.exists(temp_files_dir):
-        raise ValueError("Please provide a temporary folder to save the files.")
-    # The media id sent by whatsapp for a particular file is being used as the name of the file when we store it temporarily or permanently.
-    # This ensures uniqueness while naming the files.
-    path_to_file = f'{temp_files_dir}/{embed_pdf_request["media_id"]}.pdf'
+    # The media id sent by whatsapp for a particular file is being used as the name of the file, this ensures uniqueness.
+    s3_object_key = f"user_resources/{senders_wa_id}/{embed_pdf_request['media_id']}.pdf"
+    # The file never touches the local disk unless it is bigger than MEDIA_SPOOL_MAX_MEMORY_BYTES.
+    pdf_file = tempfile.SpooledTemporaryFile(max_size=MEDIA_SPOOL_MAX_MEMORY_BYTES)
+    # Archival, summary and indexing are independent, so they run at the same time.
+    orchestrator = IngestionOrchestrator(f"pdf {embed_pdf_request['media_id']}")
+    # Fingerprint of the file, computed while it is downloaded.
+    content_hasher = hashlib.sha256()
+    doc_id = None
+    summary_future = index_future = None
 
     try:
-        # Get the content of the file from Whatsapp Cloud API and save it to the temporary path. 
-        with open(path_to_file, 'wb') as file:
-            file.write(get_media_file_content_from_whatsapp(embed_pdf_request["media_id"], WHATSAPP_VERSION, WHATSAPP_ACCESS_TOKEN, WHATSAPP_PHONE_NUMBER_ID))
-
-        # Calling the PDF processing function here. This splits the document into nodes, 
-        # creates index for each node, store the nodes in the vector
-        # database, and generates a summary using langchain Map-Reduce method.
-        summary = process_pdf_document(
-            path_to_file, 
-            embed_pdf_request["senders_wa_id"], 
-            embed_pdf_request["media_id"], 
-            embed_pdf_request["caption"], 
-            embed_pdf_request["filename"], 
+        # The archive stage uploads to S3 the chunks the download below puts on the queue, while the download goes on.
+        s3_upload = S3MultipartUpload(AWS_BUCKET_NAME, s3_object_key, AWS_ACCESS_KEY, AWS_SECRET_KEY)
+        chunk_queue = queue.Queue(maxsize=16)
+        # On a thread of its own: the download below waits on it whenever the queue is full.
+        orchestrator.start("archive", s3_upload.upload_from_queue, chunk_queue, timeout=INGESTION_ARCHIVE_TIMEOUT, dedicated=True)
+
+        def put_chunk(chunk):
+            try:
+                chunk_queue.put(chunk, timeout=INGESTION_ARCHIVE_TIMEOUT)
+            except queue.Full:
+                raise RuntimeError(f"The upload of {s3_object_key} to S3 stalled.")
+
+        # Stream the content of the file from Whatsapp Cloud API. Every chunk is written both to the in-memory
+        # file the PDF parser reads and to the queue of the S3 multipart upload that stores the file permanently.
+        try:
+            tee_stream(
+                stream_media_file_from_whatsapp(
+                    embed_pdf_request["media_id"], 
+                    WHATSAPP_VERSION, 
+                    WHATSAPP_ACCESS_TOKEN, 
+                    WHATSAPP_PHONE_NUMBER_ID, 
+                    max_bytes=WHATSAPP_MAX_MEDIA_BYTES
+                ),
+                pdf_file.write,
+                put_chunk,
+                content_hasher.update
+            )
+            # A file the user already sent is not archived, summarised and indexed again, the stored summary is
+            # sent back instead. The upload is only completed once the file is known to be new.
+            content_hash = content_hasher.hexdigest()
+            existing = document_registry.find_by_content(senders_wa_id, content_hash)
+            if existing is None:
+                put_chunk(S3MultipartUpload.END)
+        except Exception:
+            abort_queued_upload(chunk_queue)
+            raise
+        pdf_file.seek(0)
+
+        if existing is not None:
+            abort_queued_upload(chunk_queue)
+            logging.info(f"Document {embed_pdf_request['media_id']} is already indexed as {existing.source_key}.")
+            publish_summary(senders_wa_id, existing.summary)
+            return
+        doc_id = document_id(senders_wa_id, embed_pdf_request["media_id"], content_hash)
+        metadata = pdf_document_metadata(senders_wa_id, embed_pdf_request["media_id"], embed_pdf_request["caption"], embed_pdf_request["filename"])
+
+        # The summary only needs the first pages. It is sent to the user as soon as it is ready, while the
+        # whole document is still being split into nodes and stored in the vector database.
+        head_text, pages = read_pdf_head(pdf_file)
+        summary_future = orchestrator.start(
+            "summary", 
+            generate_summary, 
+            head_text, 
+            OPENAI_API_KEY, 
+            timeout=INGESTION_SUMMARY_TIMEOUT, 
+            on_done=lambda summary: publish_summary(senders_wa_id, summary)
+        )
+        index_future = orchestrator.start(
+            "index",
+            index_pdf_pages,
+            pages,
+            metadata,
             QDRANT_API_KEY, 
             QDRANT_URL, 
             QDRANT_COLLECTION_NAME, 
-            OPENAI_API_KEY
+            OPENAI_API_KEY,
+            timeout=INGESTION_INDEX_TIMEOUT,
+            doc_id=doc_id
+        )
+    except MediaTooLargeError as e:
+        logging.error(f"Refused to embed pdf: {e}")
+        send_message(
+            get_text_message_input(senders_wa_id, "_Sorry, this file is too large to process._"),
+            WHATSAPP_VERSION,
+            WHATSAPP_ACCESS_TOKEN,
+            WHATSAPP_PHONE_NUMBER_ID 
         )
-        # In order to make the chatbot aware of the what it just did i.e. processed the PDF,  we are storing the generated
-        # summary as a chat history too. This avoids a stituation where the chatbot it completely oblivious of what it
-        # just did when we ask a followup question.
-        DynamoDBSessionManagement(
-            DYNAMODB_TABLE_NAME, 
-            embed_pdf_request["senders_wa_id"], 
-            AWS_ACCESS_KEY, 
-            AWS_SECRET_KEY).add_message(SystemMessage(content = f"These context might help you:\n\n{summary}"))
-        
-        # Sending the generated summary to the Whatsapp user who sent the PDF file. 
-        try:
-            send_bot_response = send_message(
-                get_text_message_input(embed_pdf_request["senders_wa_id"], summary + "\n\n_Use the_ *Rag* _keyword to ask these questions._"),
-                WHATSAPP_VERSION,
-                WHATSAPP_ACCESS_TOKEN,
-                WHATSAPP_PHONE_NUMBER_ID 
-            )
-            assert send_bot_response.status_code == 200
-        except Exception as e:
-            logging.error(f"An error occurred while sending the summary: {e}")
-        
-        # Storing the PDF file in the S3 bucket.
-        write_file_to_s3(path_to_file, AWS_BUCKET_NAME, s3_object_key, AWS_ACCESS_KEY, AWS_SECRET_KEY)
     except Exception as e:
         logging.error(f"An error occurred while embedding pdf: {e}")
     finally:
-        # Remove the temporary file we stored earlier.
-        os.remove(path_to_file)    
+        # The job returns as soon as the stages are started, so that it does not hold the sender's shard while
+        # they run. The wall time of each stage is logged once all of them are over (or timed out).
+        if index_future is None:
+            pdf_file.close()
+            orchestrator.on_finished()
+        else:
+            # An index stage that timed out is still reading the file and writing points, the file is closed
+            # and the document recorded (or its points discarded) only once that stage is over.
+            orchestrator.on_finished(lambda results: index_future.add_done_callback(
+                lambda future: finish_pdf_ingestion(pdf_file, future, summary_future, head_text, senders_wa_id, embed_pdf_request["media_id"], content_hash, doc_id, metadata)
+            ))
+
+def abort_queued_upload(chunk_queue: queue.Queue) -> None:
+    """Tell the S3 upload reading chunk_queue to drop the file, making room for the sentinel if the upload stalled."""
+    while True:
+        try:
+            chunk_queue.put_nowait(S3MultipartUpload.ABORT)
+            return
+        except queue.Full:
+            try:
+                chunk_queue.get_nowait()
+            except queue.Empty:
+                pass
+
+def finish_pdf_ingestion(pdf_file, index_future, summary_future, head_text: str, senders_wa_id: str, media_id: str, content_hash: str, doc_id: str, metadata: dict):
+    """
+        Close the downloaded PDF and record it in the registry once its index stage is over, see embedd_pdf.
+        A PDF whose summary failed or timed out is recorded with the beginning of its text instead.
+    """
+    pdf_file.close()
+    indexed = not index_future.cancelled() and index_future.exception() is None
+    summary = None
+    if summary_future.done() and not summary_future.cancelled() and summary_future.exception() is None:
+        summary = summary_future.result()
+    if summary is None:
+        summary = excerpt_summary(head_text)
+    record_pdf_ingestion(
+        document_registry,
+        indexed,
+        senders_wa_id,
+        media_id,
+        content_hash,
+        doc_id,
+        summary,
+        QDRANT_API_KEY, 
+        QDRANT_URL, 
+        QDRANT_COLLECTION_NAME, 
+        OPENAI_API_KEY,
+        metadata
+    )
+
+def publish_summary(senders_wa_id: str, summary: str):
+    """Send the summary of an ingested document to the user and keep it in the user's chat history."""
+    # In order to make the chatbot aware of the what it just did i.e. processed the document,  we are storing the generated
+    # summary as a chat history too. This avoids a stituation where the chatbot it completely oblivious of what it
+    # just did when we ask a followup question.
+    try:
+        session_cache.session(senders_wa_id).add_message(artifact_message(artifact_store, f"These context might help you:\n\n{summary}"))
+        # Sending the generated summary to the Whatsapp user who sent the document. 
+        send_bot_response = send_message(
+            get_text_message_input(senders_wa_id, summary + "\n\n_Use the_ *Rag* _keyword to ask these questions._"),
+            WHATSAPP_VERSION,
+            WHATSAPP_ACCESS_TOKEN,
+            WHATSAPP_PHONE_NUMBER_ID 
+        )
+        assert send_bot_response.status_code == 200
+    except Exception as e:
+        logging.error(f"An error occurred while sending the summary: {e}")
+    finally:
+        # The reply is out, write the buffered chat history to DynamoDB.
+        session_cache.flush(senders_wa_id)
+    compact_session(session_cache, senders_wa_id, get_history_compactor())
     
+def index_single_url(source_url: str, senders_wa_id: str, caption: str):
+    """Index one URL with the configured mode and return its summary (None if it failed)."""
+    # Calling the URL processing function here. This splits the content of the URL into nodes, 
+    # creates index for each node, store the nodes in the vector database, and generates a summary 
+    # using langchain Map-Reduce method.
+    if URL_SHARED_CORPUS:
+        return process_shared_url_document(
+            source_url, 
+            senders_wa_id, 
+            QDRANT_API_KEY, 
+            QDRANT_URL, 
+            QDRANT_COLLECTION_NAME, 
+            OPENAI_API_KEY,
+            document_registry,
+            max_age_seconds=URL_SHARED_MAX_AGE_SECONDS
+        )
+    elif URL_INCREMENTAL_INDEXING:
+        return refresh_url(
+            source_url, 
+            senders_wa_id, 
+            caption, 
+            QDRANT_API_KEY, 
+            QDRANT_URL, 
+            QDRANT_COLLECTION_NAME, 
+            OPENAI_API_KEY,
+            document_registry
+        ).summary
+    return process_url_document(
+        source_url, 
+        senders_wa_id, 
+        caption, 
+        QDRANT_API_KEY, 
+        QDRANT_URL, 
+        QDRANT_COLLECTION_NAME, 
+        OPENAI_API_KEY,
+        document_registry=document_registry
+    )
+
 def embedd_url(embed_url_request):
     """
     Embeds the url address to the vector database
@@ -121,40 +423,75 @@ def embedd_url(embed_url_request):
     logging.info("Embedding URL document.")
 
     try:
-        # Calling the URL processing function here. This splits the content of the URL into nodes, 
-        # creates index for each node, store the nodes in the vector database, and generates a summary 
-        # using langchain Map-Reduce method.
-        summary = process_url_document(
-            embed_url_request["url_address"], 
-            embed_url_request["senders_wa_id"], 
-            embed_url_request["caption"], 
-            QDRANT_API_KEY, 
-            QDRANT_URL, 
-            QDRANT_COLLECTION_NAME, 
-            OPENAI_API_KEY
-        )
-        # In order to make the chatbot aware of the what it just did i.e. processed the URL,  we are storing the generated
-        # summary as a chat history too. This avoids a stituation where the chatbot it completely oblivious of what it
-        # just did when we ask a followup question.
-        DynamoDBSessionManagement(
-            DYNAMODB_TABLE_NAME, 
-            embed_url_request["senders_wa_id"], 
-            AWS_ACCESS_KEY, 
-            AWS_SECRET_KEY).add_message(SystemMessage(content = f"These context might help you:\n\n{summary}"))
-        # Sending the generated summary to the Whatsapp user who sent the URL. 
-        try:
-            send_bot_response = send_message(
-                get_text_message_input(embed_url_request["senders_wa_id"], summary + "\n\n_Use the_ *Rag* _keyword to ask these questions._"),
+        summary = index_single_url(embed_url_request["url_address"], embed_url_request["senders_wa_id"], embed_url_request["caption"])
+        publish_summary(embed_url_request["senders_wa_id"], summary)
+
+    except Exception as e:
+        logging.error(f"An error occurred while embedding url: {e}")
+
+def embedd_urls(embed_urls_request):
+    """
+    Embeds all the URLs of a message at once and replies with a single summary.
+    Parameters:
+        embed_urls_request - Payload that contain information about the URLs to be embedded.
+        eg.
+        embed_urls_request_example = {
+            "url_addresses": ["https://example/url", "https://example/other-url"],
+            "senders_wa_id": "919089342948",
+            "caption": "This is an example"
+        }
+    """
+    senders_wa_id = embed_urls_request["senders_wa_id"]
+    caption = embed_urls_request["caption"]
+    # The same link sent twice in a message is indexed once.
+    source_urls = list(dict.fromkeys(embed_urls_request["url_addresses"]))
+    logging.info(f"Embedding {len(source_urls)} URL documents.")
+
+    try:
+        if URL_SHARED_CORPUS or URL_INCREMENTAL_INDEXING:
+            # These modes index URL by URL, the URLs still run at the same time.
+            def index(source_url):
+                try:
+                    return index_single_url(source_url, senders_wa_id, caption)
+                except Exception as e:
+                    logging.error(f"An error occurred while embedding {source_url}: {e}")
+            with ThreadPoolExecutor(max_workers=URL_BATCH_MAX_WORKERS, thread_name_prefix="url-batch") as pool:
+                summaries = list(pool.map(index, source_urls))
+            parts = [f"*{url}*\n{summary}" for url, summary in zip(source_urls, summaries) if summary]
+            failed = [url for url, summary in zip(source_urls, summaries) if not summary]
+        else:
+            summary, ingestions = process_url_batch(
+                source_urls,
+                senders_wa_id,
+                caption,
+                QDRANT_API_KEY, 
+                QDRANT_URL, 
+                QDRANT_COLLECTION_NAME, 
+                OPENAI_API_KEY,
+                document_registry=document_registry,
+                max_workers=URL_BATCH_MAX_WORKERS,
+                summary_timeout=INGESTION_SUMMARY_TIMEOUT,
+                index_timeout=INGESTION_INDEX_TIMEOUT
+            )
+            parts = [summary] if summary else []
+            # Links the user had already sent keep the summary they got back then.
+            parts += [f"*{i.source_url}*\n{i.summary}" for i in ingestions if i.ok and i.doc_id is None and i.summary]
+            failed = [i.source_url for i in ingestions if not i.ok]
+
+        if failed:
+            parts.append("_Could not process:_ " + ", ".join(failed))
+        if parts and len(failed) < len(source_urls):
+            publish_summary(senders_wa_id, "\n\n".join(parts))
+        else:
+            send_message(
+                get_text_message_input(senders_wa_id, "_Sorry, none of these links could be processed._"),
                 WHATSAPP_VERSION,
                 WHATSAPP_ACCESS_TOKEN,
                 WHATSAPP_PHONE_NUMBER_ID 
             )
-            assert send_bot_response.status_code == 200
-        except Exception as e:
-            logging.error(f"An error occurred while sending the summary: {e}")
 
     except Exception as e:
-        logging.error(f"An error occurred while embedding url: {e}")
+        logging.error(f"An error occurred while embedding urls: {e}")
     
 def agent_call(agent_call_request):
     """
@@ -166,25 +503,13 @@ def agent_call(agent_call_request):
         "senders_wa_id": "91xxxxxxxxxx"
     }
     """
-    # Create an instance of the conversation agent.
-    realtyai_bot = RealtyaiBot(
-            1000, # Maximum number of tokens in chat history.
-            agent_call_request["senders_wa_id"],
-            OPENAI_API_KEY,
-            COHERE_API_KEY, 
-            AWS_ACCESS_KEY, 
-            AWS_SECRET_KEY,
-            QDRANT_API_KEY,
-            QDRANT_URL,
-            QDRANT_COLLECTION_NAME,
-            WHATSAPP_VERSION,
-            WHATSAPP_ACCESS_TOKEN,
-            WHATSAPP_PHONE_NUMBER_ID,
-            DYNAMODB_TABLE_NAME
-        )
-    bot_response = realtyai_bot(agent_call_request["message_body"])
-    bot_response = process_text_for_whatsapp(bot_response)
+    # Fetch the shared conversation agent. Only the first turn of the process pays for building it.
+    setup_started_at = time.perf_counter()
+    realtyai_bot = get_realtyai_bot()
+    logging.info(f"Agent setup took {(time.perf_counter() - setup_started_at) * 1000:.2f} ms")
     try:
+        bot_response = realtyai_bot(agent_call_request["message_body"], agent_call_request["senders_wa_id"])
+        bot_response = process_text_for_whatsapp(bot_response)
         send_bot_response = send_message(
             get_text_message_input(agent_call_request["senders_wa_id"], bot_response),
             WHATSAPP_VERSION,
@@ -194,5 +519,11 @@ def agent_call(agent_call_request):
         assert send_bot_response.status_code == 200
         return bot_response
     except Exception as e:
-        logging.error(f"An error occurred while sending the reply of agent call: {e}")
-        return "Agent Response error."
\ No newline at end of file
+        logging.error(f"An error occurred in the agent call: {e}")
+        return "Agent Response error."
+    finally:
+        # The reply is out, write every message of this turn to DynamoDB with a single write.
+        session_cache.flush(agent_call_request["senders_wa_id"])
+        # Off the hot path, compact the history if it grew too long. This still runs on the user's shard,
+        # so it can not race with the user's next turn.
+        compact_session(session_cache, agent_call_request["senders_wa_id"], get_history_compactor())
\ No newline at end of file
@@ -0,0 +1,92 @@
+"""
+Benchmark of the group_id filtered vector search every Rag/Retrieve call runs.
+
+Loads the same synthetic points (one group_id per user, 1536 dimensions) into two collections of a running Qdrant:
+one created with Qdrant's defaults, as the collection used to be created, and one provisioned by
+qdrant_bootstrap (keyword payload indexes, per-group_id HNSW graphs, int8 scalar quantization), then compares
+the latency of filtered searches.
+
+Usage: python -m benchmarks.bench_filtered_search [--points 50000] [--users 500] [--queries 200]
+Needs QDRANT_URL (and QDRANT_API_KEY) pointing at a disposable Qdrant instance.
+"""
+import argparse
+import os
+import random
+import time
+import uuid
+from qdrant_client import QdrantClient
+from qdrant_client.http import models
+from app.services.databases.qdrant_bootstrap import CollectionSettings, bootstrap_collection, quantized_search_params
+
+DIMENSIONS = 1536
+
+def random_vector(generator: random.Random):
+    return [generator.gauss(0, 1) for _ in range(DIMENSIONS)]
+
+def load_points(client: QdrantClient, collection_name: str, points: int, users: int, seed: int = 0, batch_size: int = 256):
+    generator = random.Random(seed)
+    for start in range(0, points, batch_size):
+        client.upsert(collection_name, points=[
+            models.PointStruct(
+                id=str(uuid.UUID(int=generator.getrandbits(128))),
+                vector=random_vector(generator),
+                payload={"group_id": str(generator.randrange(users)), "media_id": str(i // 100), "source_type": "document"}
+            )
+            for i in range(start, min(start + batch_size, points))
+        ], wait=True)
+
+def wait_until_indexed(client: QdrantClient, collection_name: str, timeout: float = 600):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if client.get_collection(collection_name).status == models.CollectionStatus.GREEN:
+            return
+        time.sleep(1)
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(int(len(values) * p / 100), len(values) - 1)]
+
+def measure(client: QdrantClient, collection_name: str, queries: int, users: int, search_params=None, seed: int = 1):
+    generator = random.Random(seed)
+    latencies = []
+    for _ in range(queries):
+        query_filter = models.Filter(must=[models.FieldCondition(key="group_id", match=models.MatchValue(value=str(generator.randrange(users))))])
+        vector = random_vector(generator)
+        started_at = time.perf_counter()
+        client.search(collection_name, query_vector=vector, query_filter=query_filter, limit=6, search_params=search_params)
+        latencies.append((time.perf_counter() - started_at) * 1000)
+    return percentile(latencies, 50), percentile(latencies, 95)
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--points", type=int, default=50000)
+    parser.add_argument("--users", type=int, default=500)
+    parser.add_argument("--queries", type=int, default=200)
+    args = parser.parse_args()
+    client = QdrantClient(url=os.getenv("QDRANT_URL"), api_key=os.getenv("QDRANT_API_KEY"), timeout=120)
+
+    default_collection, provisioned_collection = "bench_default", "bench_provisioned"
+    for collection_name in [default_collection, provisioned_collection]:
+        client.delete_collection(collection_name)
+    client.create_collection(default_collection, vectors_config=models.VectorParams(size=DIMENSIONS, distance=models.Distance.COSINE))
+    bootstrap_collection(client, provisioned_collection, CollectionSettings(vector_size=DIMENSIONS))
+
+    for collection_name in [default_collection, provisioned_collection]:
+        load_points(client, collection_name, args.points, args.users)
+        wait_until_indexed(client, collection_name)
+
+    print(f"{args.points} points, {args.users} users, {args.queries} filtered queries")
+    print(f"{'collection':>32} {'p50 (ms)':>9} {'p95 (ms)':>9}")
+    for label, collection_name, search_params in [
+        ("default", default_collection, None),
+        ("provisioned", provisioned_collection, None),
+        ("provisioned, explicit rescoring", provisioned_collection, quantized_search_params()),
+    ]:
+        p50, p95 = measure(client, collection_name, args.queries, args.users, search_params)
+        print(f"{label:>32} {p50:>9.2f} {p95:>9.2f}")
+
+    for collection_name in [default_collection, provisioned_collection]:
+        client.delete_collection(collection_name)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,49 @@
+"""
+Microbenchmark of the chat history pruning done on every turn.
+
+Compares the previous implementation, which recounts the whole list with ChatOpenAI.get_num_tokens_from_messages
+after every pop(0), with prune_messages_to_token_limit, which uses the token count stored with each message.
+
+Usage: python -m benchmarks.bench_history_pruning
+"""
+import random
+import timeit
+from langchain_core.messages import AIMessage, HumanMessage, SystemMessage, messages_from_dict, messages_to_dict
+from langchain_openai import ChatOpenAI
+from app.services.service_utilities import prune_messages_to_token_limit, with_token_count
+
+WORDS = "the quick brown fox jumps over a lazy dog while reading documents about logistic regression".split()
+
+def make_history(length: int):
+    random.seed(length)
+    message_types = [HumanMessage, AIMessage, SystemMessage]
+    return [
+        message_types[i % 3](content=" ".join(random.choices(WORDS, k=random.randint(20, 200))))
+        for i in range(length)
+    ]
+
+def prune_previous(llm: ChatOpenAI, messages, max_tokens: int):
+    # The implementation RealtyaiBot._prune_long_messages used before token counts were stored.
+    curr_buffer_length = llm.get_num_tokens_from_messages(messages)
+    while curr_buffer_length > max_tokens:
+        messages.pop(0)
+        curr_buffer_length = llm.get_num_tokens_from_messages(messages)
+    return messages
+
+def main(repeat: int = 5):
+    llm = ChatOpenAI(model_name="gpt-3.5-turbo", openai_api_key="not-used")
+    max_tokens = 1000
+    print(f"{'messages':>8} {'previous (ms)':>14} {'first count (ms)':>17} {'stored counts (ms)':>19}")
+    for length in [6, 50, 200, 1000]:
+        history = make_history(length)
+        # Stamped copies, as they come back from DynamoDB once the counts have been stored.
+        stamped = [with_token_count(m) for m in messages_from_dict(messages_to_dict(history))]
+        previous = min(timeit.repeat(lambda: prune_previous(llm, list(history), max_tokens), number=1, repeat=repeat))
+        # Unstamped copies, as they come back from DynamoDB for history written before the counts were stored.
+        unstamped = iter([messages_from_dict(messages_to_dict(history)) for _ in range(repeat)])
+        first_count = min(timeit.repeat(lambda: prune_messages_to_token_limit(next(unstamped), max_tokens), number=1, repeat=repeat))
+        stored = min(timeit.repeat(lambda: prune_messages_to_token_limit(stamped, max_tokens), number=1, repeat=repeat))
+        print(f"{length:>8} {previous * 1000:>14.2f} {first_count * 1000:>17.2f} {stored * 1000:>19.3f}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,60 @@
+"""
+Offline benchmark of the ingestion and retrieval paths, against Qdrant's embedded (":memory:") mode and the fake
+embedding backend, so that it needs neither a Qdrant server nor an OpenAI key.
+
+Ingests synthetic documents for a number of users through index_text_stream, the path PDFs take, then times the
+group_id filtered retrieval the Retrieve tool runs (without reranking).
+
+Usage: python -m benchmarks.bench_local_pipeline [--users 20] [--pages 20] [--queries 100]
+"""
+import argparse
+import random
+import time
+from app.services.embedding_service import configure_embeddings
+from app.services.databases.qdrant_setup import build_sentence_window_index, configure_qdrant_path, get_window_postprocessors
+from app.services.ingestion_pipeline import document_id, index_text_stream, ingestion_counters
+from app.services.pdf_handling import pdf_document_metadata
+
+WORDS = "the buyer signed a lease for the apartment near the station with two bedrooms and a balcony in march".split()
+
+def make_page(generator: random.Random, sentences: int = 30) -> str:
+    return " ".join(" ".join(generator.choices(WORDS, k=generator.randint(6, 20))).capitalize() + "." for _ in range(sentences))
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--users", type=int, default=20)
+    parser.add_argument("--pages", type=int, default=20)
+    parser.add_argument("--queries", type=int, default=100)
+    args = parser.parse_args()
+    configure_embeddings(backend="fake")
+    configure_qdrant_path(":memory:")
+    generator = random.Random(0)
+
+    sentence_index = build_sentence_window_index("offline", None, None, "bench_local")
+    started_at = time.perf_counter()
+    nodes = 0
+    for user in range(args.users):
+        metadata = pdf_document_metadata(str(user), f"media-{user}", "", f"document-{user}.pdf")
+        pages = [make_page(generator) for _ in range(args.pages)]
+        nodes += index_text_stream(pages, metadata, document_id(str(user), metadata["media_id"]), sentence_index)
+    ingest_seconds = time.perf_counter() - started_at
+    print(f"Ingested {nodes} nodes for {args.users} users in {ingest_seconds:.2f}s ({nodes / ingest_seconds:.0f} nodes/s)")
+    for stage, counters in ingestion_counters.stats().items():
+        print(f"  {stage:>14}: {counters['items']:>7} items, {counters['seconds']:>7.2f}s")
+
+    from llama_index.vector_stores.types import MetadataFilters, ExactMatchFilter
+    latencies = []
+    for _ in range(args.queries):
+        retriever = sentence_index.as_retriever(
+            filters=MetadataFilters(filters=[ExactMatchFilter(key="group_id", value=str(generator.randrange(args.users)))]),
+            similarity_top_k=6,
+            node_postprocessors=get_window_postprocessors()
+        )
+        started_at = time.perf_counter()
+        retriever.retrieve(" ".join(generator.choices(WORDS, k=8)))
+        latencies.append((time.perf_counter() - started_at) * 1000)
+    latencies.sort()
+    print(f"Filtered retrieval: p50 {latencies[len(latencies) // 2]:.2f} ms, p95 {latencies[int(len(latencies) * 0.95)]:.2f} ms")
+
+if __name__ == "__main__":
+    main()
@@ -5,8 +5,9 @@ import os
 from dotenv import load_dotenv
 from app.tasks import (
     embedd_pdf,
-    embedd_url,
-    agent_call
+    embedd_urls,
+    agent_call,
+    session_cache
 )
 from app.services.general_utilities import (
     mark_msg_as_read,
@@ -15,6 +16,11 @@ from app.services.general_utilities import (
     get_text_message_input
 )
 from app.services.service_utilities import detect_and_extract_urls
+from app.services.ingestion_pipeline import ingestion_counters
+from app.services.embedding_service import embedding_stats, query_embedding_stats
+from app.services.reranking import rerank_stats
+from app.services.answer_cache import answer_cache
+from app.services.job_executor import SenderShardedScheduler, JobQueueFullError
 import time
 load_dotenv()
 
@@ -25,6 +31,14 @@ WHATSAPP_VERSION = os.getenv('WHATSAPP_VERSION')
 WHATSAPP_PHONE_NUMBER_ID = os.getenv('WHATSAPP_PHONE_NUMBER_ID')
 
 myapp = FastAPI()
+# Bounded executor running the agent calls and the PDF/URL ingestion in the background.
+# Jobs are sharded by the sender, so each user's turns run in order while different users run in parallel.
+job_executor = SenderShardedScheduler(
+    num_shards=int(os.getenv("TURN_SCHEDULER_SHARDS", 4)),
+    max_queue_size=int(os.getenv("JOB_EXECUTOR_MAX_QUEUE_SIZE", 100)),
+    use_processes=os.getenv("JOB_EXECUTOR_KIND", "thread") == "process",
+    name="webhook-turns"
+)
 # Creating a cache with a TTL of 300 seconds. This will be use to deduplicate incoming packets.
 cache = TTLCache(maxsize=1000, ttl=300)
 
@@ -43,10 +57,11 @@ async def handle_message(request: Request):
     """
     Handle incoming webhook events from the WhatsApp API.
 
-    This function processes incoming WhatsApp messages and other events,
-    such as delivery statuses. If the event is a valid message, it gets
-    processed. If the incoming payload is not a recognized WhatsApp event,
-    an error is returned.
+    This function validates and deduplicates incoming WhatsApp messages and other events,
+    such as delivery statuses. If the event is a valid message, it is handed over to the
+    background job executor and acknowledged right away, so that a slow agent call never
+    keeps WhatsApp waiting (and retrying). If the incoming payload is not a recognized
+    WhatsApp event, an error is returned.
 
     Every message send will trigger 4 HTTP requests to your webhook: message, sent, delivered, read.
 
@@ -78,49 +93,15 @@ async def handle_message(request: Request):
             else:
                 cache[msg_id] = True
             
-            # Incoming notification is for a text message.
-            if message_type == "text":
-                message_body = message["text"]["body"]
-                detected_urls = detect_and_extract_urls(message_body)
-                if len(detected_urls) > 0:
-                    send_message(
-                        get_text_message_input(
-                            wa_id, 
-                            f"_Processing your urls_..."
-                        ),
-                        WHATSAPP_VERSION,
-                        WHATSAPP_ACCESS_TOKEN,
-                        WHATSAPP_PHONE_NUMBER_ID
-                    )
-                    for url in detected_urls:
-                        url_request_body = {
-                            "url_address": url,
-                            "senders_wa_id": wa_id,
-                            "caption": message_body
-                        }
-                        embedd_url(embed_url_request = url_request_body)
-                    return JSONResponse(content = {'answer': "Url indexed."})
-                else:
-                    agent_call_body = {
-                        "message_body": message_body,
-                        "senders_wa_id": wa_id
-                    }
-                    agent_call_response = agent_call(agent_call_request=agent_call_body)
-                    return JSONResponse(content = {'answer': agent_call_response})
-            
-            # Incoming notification is for a document or an image.
-            elif message_type == "document" or message_type == "image":
-                mime_type = message[message_type]["mime_type"]
-                if mime_type in ["application/pdf", "image/jpeg", "image/png"]:
-                    send_message(
-                        get_text_message_input(
-                            wa_id, 
-                            f"_Processing your media_..."
-                        ),
-                        WHATSAPP_VERSION,
-                        WHATSAPP_ACCESS_TOKEN,
-                        WHATSAPP_PHONE_NUMBER_ID
-                    )
+            try:
+                # Incoming notification is for a text message.
+                if message_type == "text":
+                    job_executor.submit(wa_id, process_text_message, wa_id, message["text"]["body"])
+                    return JSONResponse(content = {'body': "Message queued."}, status_code = 200)
+                
+                # Incoming notification is for a document or an image.
+                elif message_type == "document" or message_type == "image":
+                    mime_type = message[message_type]["mime_type"]
                     if mime_type == "application/pdf":
                         pdf_file_request_body = {
                             "filename": message[message_type].get("filename", "Unamed"),
@@ -130,13 +111,91 @@ async def handle_message(request: Request):
                             "media_type": message_type,
                             "mime_type": mime_type
                         }
-                        embedd_pdf(embed_pdf_request=pdf_file_request_body)
-                        return JSONResponse(content = {'body': 'Successfully indexed your media.'}, status_code = 200)
+                        job_executor.submit(wa_id, process_pdf_message, pdf_file_request_body)
+                        return JSONResponse(content = {'body': 'Media queued.'}, status_code = 200)
+                    elif mime_type in ["image/jpeg", "image/png"]:
+                        # Images are acknowledged to the user, but not indexed.
+                        job_executor.submit(wa_id, process_image_message, wa_id)
+                        return JSONResponse(content= {'body': 'Invalid mime type'}, status_code = 200)
                     else:
                         return JSONResponse(content= {'body': 'Invalid mime type'}, status_code = 200)
+            except JobQueueFullError as e:
+                # Forget the message so that the retry WhatsApp sends after a non 200 answer is not treated as a duplicate.
+                cache.pop(msg_id, None)
+                print(f"Rejected message {msg_id}: {e}")
+                return JSONResponse(content = {'body': 'Server busy.'}, status_code = 503)
     except Exception as e:
         print(f"An error occured: {e}")
         return JSONResponse(status_code = 500)
 
+# Background jobs submitted by the webhook. They run on the job executor, never on the event loop.
+def process_text_message(wa_id: str, message_body: str):
+    detected_urls = detect_and_extract_urls(message_body)
+    if len(detected_urls) > 0:
+        send_message(
+            get_text_message_input(
+                wa_id, 
+                f"_Processing your urls_..."
+            ),
+            WHATSAPP_VERSION,
+            WHATSAPP_ACCESS_TOKEN,
+            WHATSAPP_PHONE_NUMBER_ID
+        )
+        # All the links of the message are fetched in parallel and summarised in one reply.
+        embedd_urls(embed_urls_request = {
+            "url_addresses": detected_urls,
+            "senders_wa_id": wa_id,
+            "caption": message_body
+        })
+    else:
+        agent_call_body = {
+            "message_body": message_body,
+            "senders_wa_id": wa_id
+        }
+        agent_call(agent_call_request=agent_call_body)
+
+def process_pdf_message(pdf_file_request_body: dict):
+    send_message(
+        get_text_message_input(
+            pdf_file_request_body["senders_wa_id"], 
+            f"_Processing your media_..."
+        ),
+        WHATSAPP_VERSION,
+        WHATSAPP_ACCESS_TOKEN,
+        WHATSAPP_PHONE_NUMBER_ID
+    )
+    embedd_pdf(embed_pdf_request=pdf_file_request_body)
+
+def process_image_message(wa_id: str):
+    send_message(
+        get_text_message_input(
+            wa_id, 
+            f"_Processing your media_..."
+        ),
+        WHATSAPP_VERSION,
+        WHATSAPP_ACCESS_TOKEN,
+        WHATSAPP_PHONE_NUMBER_ID
+    )
+
+# Queue depth and latency of the background jobs, and the state of the in-memory caches.
+@myapp.get("/metrics")
+def metrics():
+    return JSONResponse(content = {
+        "job_executor": job_executor.stats(),
+        "session_cache": session_cache.stats(),
+        "ingestion": ingestion_counters.stats(),
+        "embeddings": embedding_stats(),
+        "query_embeddings": query_embedding_stats(),
+        "rerank": rerank_stats.stats(),
+        "answer_cache": answer_cache.stats()
+    }, status_code = 200)
+
+@myapp.on_event("shutdown")
+def shutdown():
+    # Let the jobs that were already acknowledged to WhatsApp finish.
+    job_executor.shutdown(wait=True)
+    # Write the chat history still buffered in memory.
+    session_cache.flush_all()
+
 # Payload examples:
 # https://developers.facebook.com/docs/whatsapp/cloud-api/webhooks/payload-examples
\ No newline at end of file
@@ -0,0 +1,57 @@
+"""Semantic answer cache of the Rag tool, and its invalidation by ingestion."""
+import time
+
+import pytest
+
+from app.services.answer_cache import SemanticAnswerCache
+
+ALICE, BOB = "911111111111", "922222222222"
+
+def store(cache, group_id, embedding, answer="The villa has a pool."):
+    cache.store(group_id, "does the villa have a pool?", embedding, answer, ["villa.pdf"], latency_seconds=2.0)
+
+def test_similar_questions_of_the_same_user_get_the_answer_back():
+    cache = SemanticAnswerCache(threshold=0.95)
+    store(cache, ALICE, [1.0, 0.0, 0.0])
+
+    hit = cache.lookup(ALICE, [0.99, 0.05, 0.0])
+    assert (hit.answer, hit.citations) == ("The villa has a pool.", ["villa.pdf"])
+    assert cache.lookup(ALICE, [0.6, 0.8, 0.0]) is None
+    # Answers are never shared between users.
+    assert cache.lookup(BOB, [1.0, 0.0, 0.0]) is None
+    assert cache.stats()["saved_seconds"] == 2.0
+
+def test_answers_expire(monkeypatch):
+    from app.services import answer_cache
+    cache = SemanticAnswerCache(ttl_seconds=60)
+    store(cache, ALICE, [1.0, 0.0])
+    later = time.time() + 120
+    monkeypatch.setattr(answer_cache.time, "time", lambda: later)
+
+    assert cache.lookup(ALICE, [1.0, 0.0]) is None
+
+def test_ingestion_invalidates_the_answers_of_the_users_who_can_see_the_nodes(monkeypatch):
+    pytest.importorskip("llama_index")
+    from llama_index.schema import TextNode
+    from app.services import answer_cache, embedding_service, ingestion_pipeline
+    cache = SemanticAnswerCache()
+    monkeypatch.setattr(answer_cache, "answer_cache", cache)
+    carol = "933333333333"
+    for group_id in (ALICE, BOB, carol):
+        store(cache, group_id, [1.0, 0.0])
+
+    class VectorStore:
+        def add(self, nodes):
+            pass
+
+    nodes = [
+        TextNode(text="The villa now has a sauna.", metadata={"group_id": ALICE}),
+        # A shared document is visible to several users.
+        TextNode(text="The flat was sold.", metadata={"group_id": [BOB, "*"]}),
+    ]
+    ingestion_pipeline.embed_and_upsert(nodes, embedding_service.build_cached_embed_model(None, "fake"), VectorStore())
+
+    assert cache.lookup(ALICE, [1.0, 0.0]) is None
+    assert cache.lookup(BOB, [1.0, 0.0]) is None
+    assert cache.lookup(carol, [1.0, 0.0]) is not None
+    assert cache.stats()["invalidations"] == 2
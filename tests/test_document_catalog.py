@@ -0,0 +1,42 @@
+"""Document catalog lookups of the Retrieve tool."""
+from app.services.databases.document_catalog import DocumentCatalog
+
+WA_ID = "911234567890"
+
+def pdf(media_id, filename, caption="", group_id=WA_ID):
+    return {"group_id": group_id, "media_id": media_id, "source": filename, "source_type": "document", "caption": caption, "date": ""}
+
+def vectors(mapping):
+    """embed_text returning fixed vectors for the texts starting with each key."""
+    def embed_text(text):
+        return next(vector for prefix, vector in mapping.items() if text.startswith(prefix))
+    return embed_text
+
+def test_writes_of_other_processes_are_seen(tmp_path):
+    path = str(tmp_path / "catalog.sqlite")
+    # Two connections to the same file, as the web process and an ingestion worker would have.
+    reader = DocumentCatalog(path)
+    writer = DocumentCatalog(path)
+    assert reader.entries(WA_ID) == []
+
+    writer.add(pdf("media-1", "palm-residency-brochure.pdf"), "Brochure of Palm Residency.")
+
+    assert [entry.media_id for entry in reader.entries(WA_ID)] == ["media-1"]
+    assert [entry.media_id for entry in reader.search(WA_ID, "send me the palm residency brochure")] == ["media-1"]
+
+def test_keyword_matches_are_sent_back(tmp_path):
+    catalog = DocumentCatalog(str(tmp_path / "catalog.sqlite"))
+    catalog.add(pdf("media-1", "palm-residency-brochure.pdf"), "Brochure.")
+    catalog.add(pdf("media-2", "lease-agreement.pdf"), "Lease.")
+
+    assert [entry.media_id for entry in catalog.search(WA_ID, "the lease please")] == ["media-2"]
+
+def test_weak_embedding_matches_are_not_sent_back(tmp_path):
+    embed_text = vectors({"palm-residency": [1.0, 0.0, 0.0], "lease-agreement": [0.0, 1.0, 0.0]})
+    catalog = DocumentCatalog(str(tmp_path / "catalog.sqlite"), embed_text=embed_text, min_score=0.45)
+    catalog.add(pdf("media-1", "palm-residency.pdf"), "Brochure.")
+    catalog.add(pdf("media-2", "lease-agreement.pdf"), "Lease.")
+
+    # No keyword in common, and only as similar as unrelated texts are: left to the sentence search.
+    assert catalog.search(WA_ID, "floor plan of the villa", query_embedding=[0.3, 0.3, 0.9]) == []
+    assert [entry.media_id for entry in catalog.search(WA_ID, "floor plan of the villa", query_embedding=[0.9, 0.1, 0.1])] == ["media-1"]
@@ -0,0 +1,46 @@
+"""Claims of the document registry, the guard against two workers ingesting the same shared URL."""
+import threading
+import time
+
+from app.services.databases.document_registry import DocumentRegistry, claimed
+
+URL = "https://example.com/listing"
+
+def test_only_one_process_gets_the_claim(tmp_path):
+    # Two connections to the same file, as two worker processes would have.
+    first = DocumentRegistry(str(tmp_path / "registry.sqlite"))
+    second = DocumentRegistry(str(tmp_path / "registry.sqlite"))
+
+    assert first.try_claim(URL, "worker-1", ttl_seconds=60)
+    assert not second.try_claim(URL, "worker-2", ttl_seconds=60)
+    first.release_claim(URL, "worker-1")
+    assert second.try_claim(URL, "worker-2", ttl_seconds=60)
+
+def test_expired_claims_can_be_taken_over(tmp_path):
+    registry = DocumentRegistry(str(tmp_path / "registry.sqlite"))
+
+    assert registry.try_claim(URL, "crashed-worker", ttl_seconds=-1)
+    assert registry.try_claim(URL, "worker-2", ttl_seconds=60)
+    # The crashed worker's release does not drop the new claim.
+    registry.release_claim(URL, "crashed-worker")
+    assert not registry.try_claim(URL, "worker-3", ttl_seconds=60)
+
+def test_claimed_waits_for_the_claim_to_be_released(tmp_path):
+    path = str(tmp_path / "registry.sqlite")
+    order = []
+    entered = threading.Event()
+
+    def ingest(name, hold_seconds):
+        with claimed(DocumentRegistry(path), URL, poll_seconds=0.01):
+            entered.set()
+            order.append(f"{name} start")
+            time.sleep(hold_seconds)
+            order.append(f"{name} end")
+
+    first = threading.Thread(target=ingest, args=("first", 0.2))
+    first.start()
+    entered.wait()
+    ingest("second", 0)
+    first.join()
+
+    assert order == ["first start", "first end", "second start", "second end"]
@@ -0,0 +1,97 @@
+"""Item per message chat history layout, against moto's DynamoDB stand-in (or DynamoDB Local via DYNAMODB_ENDPOINT_URL)."""
+import pytest
+
+boto3 = pytest.importorskip("boto3")
+moto = pytest.importorskip("moto")
+pytest.importorskip("langchain_core")
+
+from langchain_core.messages import AIMessage, HumanMessage
+from app.services.databases import dynamodb_setup
+from app.services.databases.dynamodb_setup import DynamoDBAppendOnlySessionManagement, create_append_only_table
+
+TABLE_NAME = "chat-history-test"
+
+@pytest.fixture
+def history(monkeypatch):
+    monkeypatch.setenv("AWS_ACCESS_KEY_ID", "testing")
+    monkeypatch.setenv("AWS_SECRET_ACCESS_KEY", "testing")
+    monkeypatch.setenv("DYNAMODB_REGION", "us-east-1")
+    mock = moto.mock_aws() if hasattr(moto, "mock_aws") else moto.mock_dynamodb()
+    with mock:
+        # Tables cached by an earlier test point at an earlier mock.
+        dynamodb_setup._thread_local.tables = {}
+        create_append_only_table(TABLE_NAME, "testing", "testing")
+        yield DynamoDBAppendOnlySessionManagement(TABLE_NAME, "911234567890", "testing", "testing")
+
+def conversation(turns: int):
+    messages = []
+    for i in range(turns):
+        messages += [HumanMessage(content=f"question {i}"), AIMessage(content=f"answer {i}")]
+    return messages
+
+def contents(messages):
+    return [message.content for message in messages]
+
+def stored_items(history):
+    return history.table.scan()["Items"]
+
+def test_appends_are_read_back_in_order(history):
+    history.add_messages(conversation(2))
+    history.add_message(HumanMessage(content="question 2"))
+    assert contents(history.messages()) == ["question 0", "answer 0", "question 1", "answer 1", "question 2"]
+
+def test_limit_reads_only_the_last_messages(history, monkeypatch):
+    history.add_messages(conversation(5))
+    queries = []
+    query = history.table.query
+    monkeypatch.setattr(history.table, "query", lambda **kwargs: queries.append(kwargs) or query(**kwargs))
+    assert contents(history.messages(limit=3)) == ["answer 3", "question 4", "answer 4"]
+    # A single descending Query, limited to the messages asked for and the marker.
+    assert len(queries) == 1
+    assert queries[0]["ScanIndexForward"] is False and queries[0]["Limit"] == 4
+    assert history.messages(limit=0) == []
+
+def test_history_and_marker_are_read_in_one_query(history, monkeypatch):
+    history.add_messages(conversation(3))
+    history.replace_messages(conversation(3)[2:])
+    calls = []
+    query = history.table.query
+    monkeypatch.setattr(history.table, "query", lambda **kwargs: calls.append("query") or query(**kwargs))
+    monkeypatch.setattr(history.table, "get_item", lambda **kwargs: calls.append("get_item"))
+    assert contents(history.messages(limit=3)) == ["answer 1", "question 2", "answer 2"]
+    assert contents(history.messages()) == ["question 1", "answer 1", "question 2", "answer 2"]
+    assert calls == ["query", "query"]
+
+def test_replace_messages(history):
+    history.add_messages(conversation(3))
+    history.replace_messages([AIMessage(content="summary"), HumanMessage(content="question 2"), AIMessage(content="answer 2")])
+    assert contents(history.messages()) == ["summary", "question 2", "answer 2"]
+    # The old items are deleted, only the new ones and the marker are left.
+    assert len(stored_items(history)) == 4
+    history.add_message(HumanMessage(content="question 3"))
+    assert contents(history.messages(limit=2)) == ["answer 2", "question 3"]
+
+def test_interrupted_replace_never_duplicates_the_history(history, monkeypatch):
+    history.add_messages(conversation(2))
+    put_marker = history._put_marker
+    def fail_when_publishing(history_start, pending=None):
+        # Fails at step 3, after the new messages were written.
+        if pending is None:
+            raise RuntimeError("crash")
+        put_marker(history_start, pending)
+    monkeypatch.setattr(history, "_put_marker", fail_when_publishing)
+    history.replace_messages([AIMessage(content="summary")])
+    assert contents(history.messages()) == ["question 0", "answer 0", "question 1", "answer 1"]
+
+    # The retry cleans up the failed attempt.
+    monkeypatch.setattr(history, "_put_marker", put_marker)
+    history.replace_messages([AIMessage(content="summary")])
+    assert contents(history.messages()) == ["summary"]
+    assert len(stored_items(history)) == 2
+
+def test_clear(history):
+    history.add_messages(conversation(2))
+    history.replace_messages([AIMessage(content="summary")])
+    history.clear()
+    assert history.messages() == []
+    assert stored_items(history) == []
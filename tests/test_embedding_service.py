@@ -0,0 +1,153 @@
+"""Embedding engine (cache, batching, retries) against the fake embedding backend."""
+import pytest
+
+from app.services import embedding_service
+from app.services.embedding_service import EmbeddingEngine, SQLiteEmbeddingCache, fake_embedding_backend
+
+class CountingBackend:
+    """Fake embedding backend recording the batches it is called with, failing the first `failures` calls."""
+    def __init__(self, failures: int = 0, error: Exception = None):
+        self.embed = fake_embedding_backend(dimensions=8)
+        self.batches = []
+        self.failures = failures
+        self.error = error
+
+    def __call__(self, texts):
+        if self.failures:
+            self.failures -= 1
+            raise self.error
+        self.batches.append(list(texts))
+        return self.embed(texts)
+
+class RateLimitError(Exception):
+    status_code = 429
+
+@pytest.fixture(autouse=True)
+def no_sleep(monkeypatch):
+    monkeypatch.setattr(embedding_service.time, "sleep", lambda seconds: None)
+
+def test_cache_hits_skip_the_backend(tmp_path):
+    backend = CountingBackend()
+    cache = SQLiteEmbeddingCache(str(tmp_path / "embeddings.sqlite"))
+    first = EmbeddingEngine(backend, "fake", cache=cache).embed(["a", "b"])
+    # A new engine on the same file, eg. after a restart, only embeds the texts it has never seen.
+    engine = EmbeddingEngine(backend, "fake", cache=SQLiteEmbeddingCache(str(tmp_path / "embeddings.sqlite")))
+    second = engine.embed(["b", "a", "c"])
+
+    assert backend.batches == [["a", "b"], ["c"]]
+    # The cache stores float32 vectors.
+    assert second[0] == pytest.approx(first[1], abs=1e-6)
+    assert second[1] == pytest.approx(first[0], abs=1e-6)
+    assert engine.stats["cache_hits"] == 2
+    assert engine.stats["api_texts"] == 1
+
+def test_cache_keys_include_the_model(tmp_path):
+    backend = CountingBackend()
+    cache = SQLiteEmbeddingCache(str(tmp_path / "embeddings.sqlite"))
+    EmbeddingEngine(backend, "model-a", cache=cache).embed(["a"])
+    EmbeddingEngine(backend, "model-b", cache=cache).embed(["a"])
+
+    assert backend.batches == [["a"], ["a"]]
+
+def test_texts_are_deduplicated_and_batched():
+    backend = CountingBackend()
+    engine = EmbeddingEngine(backend, "fake", batch_size=3, max_in_flight=2)
+    texts = [f"text {i}" for i in range(7)]
+    vectors = engine.embed(texts + texts[:2])
+
+    assert sorted(len(batch) for batch in backend.batches) == [1, 3, 3]
+    assert sorted(text for batch in backend.batches for text in batch) == sorted(texts)
+    assert vectors[7:] == vectors[:2]
+    assert vectors[:7] == fake_embedding_backend(dimensions=8)(texts)
+
+def test_rate_limited_batches_are_retried():
+    backend = CountingBackend(failures=2, error=RateLimitError("slow down"))
+    engine = EmbeddingEngine(backend, "fake", max_retries=3)
+
+    assert engine.embed(["a"]) == fake_embedding_backend(dimensions=8)(["a"])
+    assert engine.stats["retries"] == 2
+    assert engine.stats["api_batches"] == 1
+
+def test_retries_give_up_after_max_retries():
+    backend = CountingBackend(failures=5, error=RateLimitError("slow down"))
+    engine = EmbeddingEngine(backend, "fake", max_retries=2)
+
+    with pytest.raises(RateLimitError):
+        engine.embed(["a"])
+    assert engine.stats["retries"] == 2
+
+def test_other_errors_are_not_retried():
+    backend = CountingBackend(failures=1, error=ValueError("bad input"))
+    engine = EmbeddingEngine(backend, "fake", max_retries=3)
+
+    with pytest.raises(ValueError):
+        engine.embed(["a"])
+    assert engine.stats["retries"] == 0
+
+def test_upsert_batches_follow_the_embedding_settings(monkeypatch):
+    pytest.importorskip("llama_index")
+    from llama_index.schema import TextNode
+    from app.services import ingestion_pipeline
+    monkeypatch.setattr(embedding_service.embedding_settings, "batch_size", 2)
+    monkeypatch.setattr(embedding_service.embedding_settings, "max_in_flight", 3)
+    monkeypatch.setattr(ingestion_pipeline, "invalidate_answers_of", lambda nodes: None)
+
+    class VectorStore:
+        def __init__(self):
+            self.batches = []
+
+        def add(self, nodes):
+            self.batches.append(len(nodes))
+
+    vector_store = VectorStore()
+    embed_model = embedding_service.build_cached_embed_model(None, "fake")
+    nodes = [TextNode(text=f"sentence {i}") for i in range(14)]
+
+    assert ingestion_pipeline.embed_and_upsert(nodes, embed_model, vector_store) == 14
+    assert vector_store.batches == [6, 6, 2]
+    assert all(node.embedding for node in nodes)
+
+class FakeOpenAIClient:
+    """The embeddings endpoint of the OpenAI client, answering 429 to the first `failures` requests."""
+    def __init__(self, failures: int, retry_after: str = None):
+        self.failures = failures
+        self.retry_after = retry_after
+        self.requests = 0
+        self.embeddings = self
+
+    def create(self, input, model, **kwargs):
+        from types import SimpleNamespace
+        self.requests += 1
+        if self.failures:
+            self.failures -= 1
+            error = RateLimitError("slow down")
+            error.response = SimpleNamespace(status_code=429, headers={"retry-after": self.retry_after} if self.retry_after else {})
+            raise error
+        return SimpleNamespace(data=[SimpleNamespace(embedding=vector) for vector in fake_embedding_backend(dimensions=8)(input)])
+
+def openai_embed_model(monkeypatch, client):
+    pytest.importorskip("llama_index")
+    from llama_index.embeddings import OpenAIEmbedding
+    monkeypatch.setattr(embedding_service.embedding_settings, "max_retries", 2)
+    inner = OpenAIEmbedding(model_name="text-embedding-3-small", api_key="sk-test", max_retries=0)
+    inner._client = client
+    return embedding_service.build_cached_embed_model(inner, "text-embedding-3-small")
+
+def test_rate_limited_documents_are_only_retried_by_the_engine(monkeypatch):
+    client = FakeOpenAIClient(failures=10)
+    embed_model = openai_embed_model(monkeypatch, client)
+
+    with pytest.raises(RateLimitError):
+        embed_model.get_text_embedding_batch(["a", "b"])
+    # One request per attempt of the engine, none of the wrapped model's own retries.
+    assert client.requests == 3
+
+def test_rate_limited_queries_wait_for_retry_after(monkeypatch):
+    sleeps = []
+    monkeypatch.setattr(embedding_service.time, "sleep", sleeps.append)
+    client = FakeOpenAIClient(failures=1, retry_after="7")
+    embed_model = openai_embed_model(monkeypatch, client)
+
+    assert embed_model.get_query_embedding("a query about tenacity") == fake_embedding_backend(dimensions=8)(["a query about tenacity"])[0]
+    assert client.requests == 2
+    assert sleeps == [7.0]
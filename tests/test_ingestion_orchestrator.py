@@ -0,0 +1,84 @@
+"""Stages of an ingestion run side by side, with their timeouts and completion callbacks."""
+import threading
+import time
+
+import pytest
+
+pytest.importorskip("llama_index")
+
+from app.services.ingestion_orchestrator import IngestionOrchestrator
+
+def test_stages_run_at_the_same_time():
+    orchestrator = IngestionOrchestrator("test")
+    both_started = threading.Barrier(2, timeout=5)
+    orchestrator.start("summary", lambda: (both_started.wait(), "summary")[1])
+    orchestrator.start("index", lambda: (both_started.wait(), 3)[1])
+
+    results = orchestrator.wait()
+    assert {name: result.result for name, result in results.items()} == {"summary": "summary", "index": 3}
+    assert all(result.ok for result in results.values())
+
+def test_on_done_gets_the_result_before_the_other_stages_finish():
+    orchestrator = IngestionOrchestrator("test")
+    release = threading.Event()
+    sent = []
+    orchestrator.start("summary", lambda: "summary", on_done=sent.append)
+    orchestrator.start("index", release.wait, 5)
+
+    deadline = time.monotonic() + 5
+    while not sent and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert sent == ["summary"]
+    release.set()
+    orchestrator.wait()
+
+def test_timed_out_and_failed_stages_are_reported():
+    orchestrator = IngestionOrchestrator("test")
+    release = threading.Event()
+    slow = orchestrator.start("index", release.wait, 5, timeout=0.05)
+    orchestrator.start("summary", lambda: 1 / 0)
+
+    results = orchestrator.wait()
+    assert results["index"].timed_out and not results["index"].ok
+    assert isinstance(results["summary"].error, ZeroDivisionError)
+    # A stage that timed out keeps running.
+    assert not slow.done()
+    release.set()
+    assert slow.result(timeout=5) is True
+
+def test_on_finished_does_not_block_and_reports_timeouts():
+    orchestrator = IngestionOrchestrator("test")
+    release = threading.Event()
+    finished = threading.Event()
+    reported = []
+    orchestrator.start("summary", lambda: "summary")
+    index = orchestrator.start("index", release.wait, 5, timeout=0.1)
+
+    started_at = time.monotonic()
+    orchestrator.on_finished(lambda results: reported.append(results) or finished.set())
+    assert time.monotonic() - started_at < 0.05
+    assert finished.wait(5)
+    assert reported[0]["summary"].result == "summary"
+    assert reported[0]["index"].timed_out
+    release.set()
+    index.result(timeout=5)
+    # Reported once, not again when the timed out stage ends.
+    time.sleep(0.05)
+    assert len(reported) == 1
+
+def test_on_finished_without_stages_reports_right_away():
+    reported = []
+    IngestionOrchestrator("test").on_finished(reported.append)
+
+    assert reported == [{}]
+
+def test_dedicated_stages_do_not_wait_for_the_pool():
+    from concurrent.futures import ThreadPoolExecutor
+    # Every pool thread is taken by a stage waiting on the dedicated one.
+    orchestrator = IngestionOrchestrator("test", pool=ThreadPoolExecutor(max_workers=1))
+    consumed = threading.Event()
+    orchestrator.start("download", consumed.wait, 5)
+    orchestrator.start("archive", consumed.set, dedicated=True)
+
+    results = orchestrator.wait()
+    assert results["download"].result is True
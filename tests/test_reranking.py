@@ -0,0 +1,71 @@
+"""Adaptive rerank stage: skipped on a clear winner, cached per query and candidates, lexical when Cohere fails."""
+import pytest
+
+pytest.importorskip("llama_index")
+
+from llama_index.schema import NodeWithScore, QueryBundle, TextNode
+from app.services.reranking import bm25_scores, build_adaptive_rerank_postprocessor
+
+class FakeCohereRerank:
+    """Reverses the candidates, or fails, counting its calls."""
+    def __init__(self, error: Exception = None):
+        self.calls = 0
+        self.error = error
+
+    def postprocess_nodes(self, nodes, query_bundle=None):
+        self.calls += 1
+        if self.error is not None:
+            raise self.error
+        return [NodeWithScore(node=n.node, score=float(i)) for i, n in enumerate(reversed(nodes))][:2]
+
+def candidates(*scored_texts):
+    return [NodeWithScore(node=TextNode(text=text, id_=f"node-{i}"), score=score) for i, (text, score) in enumerate(scored_texts)]
+
+def rerank(postprocessor, nodes, query="pool villa near the beach"):
+    return [n.node.node_id for n in postprocessor.postprocess_nodes(nodes, query_bundle=QueryBundle(query))]
+
+def test_a_clear_winner_is_not_reranked():
+    cohere = FakeCohereRerank()
+    postprocessor = build_adaptive_rerank_postprocessor(cohere, top_n=2)
+
+    assert rerank(postprocessor, candidates(("a", 0.70), ("b", 0.90), ("c", 0.60))) == ["node-1", "node-0"]
+    assert cohere.calls == 0
+
+def test_close_scores_are_reranked_once_per_query_and_candidates():
+    cohere = FakeCohereRerank()
+    postprocessor = build_adaptive_rerank_postprocessor(cohere, top_n=2)
+    nodes = candidates(("a", 0.81), ("b", 0.80), ("c", 0.79))
+
+    assert rerank(postprocessor, nodes) == ["node-2", "node-1"]
+    assert rerank(postprocessor, nodes) == ["node-2", "node-1"]
+    assert cohere.calls == 1
+    rerank(postprocessor, nodes, query="another question")
+    assert cohere.calls == 2
+
+def test_updated_node_texts_are_reranked_again():
+    cohere = FakeCohereRerank()
+    postprocessor = build_adaptive_rerank_postprocessor(cohere, top_n=2)
+    rerank(postprocessor, candidates(("a", 0.81), ("b", 0.80)))
+    # Same node IDs (see stable_node_id), new text.
+    rerank(postprocessor, candidates(("a", 0.81), ("b, updated", 0.80)))
+
+    assert cohere.calls == 2
+
+def test_failed_cohere_calls_fall_back_to_bm25():
+    cohere = FakeCohereRerank(error=RuntimeError("rate limited"))
+    postprocessor = build_adaptive_rerank_postprocessor(cohere, top_n=1)
+    nodes = candidates(("The flat is on the third floor.", 0.80), ("The villa has a pool near the beach.", 0.79))
+
+    assert rerank(postprocessor, nodes) == ["node-1"]
+    assert cohere.calls == 1
+
+def test_without_cohere_the_lexical_reranker_is_used():
+    postprocessor = build_adaptive_rerank_postprocessor(None, top_n=1)
+    nodes = candidates(("The flat is on the third floor.", 0.80), ("The villa has a pool near the beach.", 0.79))
+
+    assert rerank(postprocessor, nodes) == ["node-1"]
+
+def test_bm25_prefers_documents_with_the_rarer_query_terms():
+    scores = bm25_scores("villa pool", ["the villa", "the villa with a pool", "a flat"])
+
+    assert scores[1] > scores[0] > scores[2] == 0.0
@@ -0,0 +1,195 @@
+"""Write-behind session history cache, against an in-memory stand-in for the DynamoDB history."""
+import threading
+import time
+
+import pytest
+
+pytest.importorskip("langchain_core")
+
+from langchain_core.messages import AIMessage, HumanMessage
+from app.services.databases.session_cache import SessionHistoryCache
+
+class FakeHistory:
+    """Stored history of one session, counting the round trips made to it."""
+    def __init__(self, stored=None):
+        self.stored = list(stored or [])
+        self.reads = 0
+        self.writes = 0
+        self.fail_writes = False
+
+    def messages(self, limit=None):
+        self.reads += 1
+        return self.stored[-limit:] if limit else list(self.stored)
+
+    def add_messages(self, messages):
+        if self.fail_writes:
+            raise RuntimeError("throttled")
+        self.writes += 1
+        self.stored.extend(messages)
+
+    def replace_messages(self, messages):
+        self.writes += 1
+        self.stored = list(messages)
+
+    def clear(self):
+        self.stored = []
+
+class Storage:
+    def __init__(self):
+        self.histories = {}
+
+    def __call__(self, session_id):
+        return self.histories.setdefault(session_id, FakeHistory())
+
+def turn(i):
+    return [HumanMessage(content=f"question {i}"), AIMessage(content=f"answer {i}")]
+
+def contents(messages):
+    return [message.content for message in messages]
+
+def test_a_turn_reads_once_and_writes_once_on_flush():
+    storage = Storage()
+    storage.histories["user"] = FakeHistory(turn(0))
+    cache = SessionHistoryCache(storage)
+    history = cache.session("user")
+
+    assert contents(history.messages()) == ["question 0", "answer 0"]
+    history.add_message(turn(1)[0])
+    history.add_message(turn(1)[1])
+    assert contents(history.messages(limit=2)) == ["question 1", "answer 1"]
+    assert storage.histories["user"].writes == 0
+    history.flush()
+
+    assert storage.histories["user"].reads == 1
+    assert storage.histories["user"].writes == 1
+    assert contents(storage.histories["user"].stored) == ["question 0", "answer 0", "question 1", "answer 1"]
+
+def test_messages_buffered_before_the_first_read_are_not_lost():
+    storage = Storage()
+    storage.histories["user"] = FakeHistory(turn(0))
+    history = SessionHistoryCache(storage).session("user")
+    history.add_messages(turn(1))
+
+    assert contents(history.messages()) == ["question 0", "answer 0", "question 1", "answer 1"]
+
+def test_least_recently_used_sessions_are_flushed_on_eviction():
+    storage = Storage()
+    cache = SessionHistoryCache(storage, max_sessions=2)
+    cache.session("a").add_messages(turn(0))
+    cache.session("b").add_messages(turn(0))
+    cache.session("a").messages()
+    cache.session("c").add_messages(turn(0))
+
+    assert contents(storage.histories["b"].stored) == ["question 0", "answer 0"]
+    assert storage.histories["a"].stored == [] and storage.histories["c"].stored == []
+    assert cache.stats()["sessions"] == 2
+
+def test_expired_sessions_are_flushed_and_reloaded(monkeypatch):
+    from app.services.databases import session_cache
+    now = [1000.0]
+    monkeypatch.setattr(session_cache.time, "monotonic", lambda: now[0])
+    storage = Storage()
+    cache = SessionHistoryCache(storage, ttl_seconds=60)
+    cache.session("user").add_messages(turn(0))
+    now[0] += 120
+    # Written by another worker while the session was idle here.
+    storage.histories["user"].stored.extend(turn(1))
+
+    assert contents(cache.session("user").messages()) == ["question 1", "answer 1", "question 0", "answer 0"]
+    assert storage.histories["user"].writes == 1
+    assert storage.histories["user"].reads == 1
+
+def test_failed_flushes_keep_the_messages_for_the_next_one():
+    storage = Storage()
+    cache = SessionHistoryCache(storage)
+    history = cache.session("user")
+    history.add_messages(turn(0))
+    storage.histories["user"].fail_writes = True
+    history.flush()
+    assert cache.stats()["pending_messages"] == 2
+
+    storage.histories["user"].fail_writes = False
+    history.add_messages(turn(1))
+    cache.flush_all()
+    assert contents(storage.histories["user"].stored) == ["question 0", "answer 0", "question 1", "answer 1"]
+
+def test_a_session_used_while_its_eviction_flush_runs_is_not_reloaded_without_its_messages():
+    storage = Storage()
+    cache = SessionHistoryCache(storage, max_sessions=1)
+    cache.session("a").add_messages(turn(0))
+    flushing = threading.Event()
+    release = threading.Event()
+    history_a = storage.histories["a"]
+    add_messages = history_a.add_messages
+
+    def slow_add_messages(messages):
+        flushing.set()
+        release.wait(5)
+        add_messages(messages)
+    history_a.add_messages = slow_add_messages
+
+    # Evicts "a", whose flush blocks until released.
+    evicting = threading.Thread(target=lambda: cache.session("b").messages())
+    evicting.start()
+    assert flushing.wait(5)
+    # "a" comes back from the draining map, with its buffered messages, instead of being reloaded from storage.
+    results = []
+    reader = threading.Thread(target=lambda: results.append(contents(cache.session("a").messages())))
+    reader.start()
+    while "a" not in cache._sessions:
+        time.sleep(0.01)
+    release.set()
+    evicting.join(5)
+    reader.join(5)
+
+    assert results == [["question 0", "answer 0"]]
+    assert contents(history_a.stored) == ["question 0", "answer 0"]
+
+def test_messages_added_while_a_rewrite_runs_are_kept():
+    storage = Storage()
+    cache = SessionHistoryCache(storage)
+    history = cache.session("user")
+    history.add_messages(turn(0) + turn(1))
+
+    def transform(messages):
+        # Eg. a turn answered, and flushed, while the compaction's LLM calls run, then one still buffered.
+        history.add_messages(turn(2))
+        history.flush()
+        history.add_messages(turn(3))
+        return [AIMessage(content="summary")]
+
+    assert cache.rewrite("user", transform)
+    assert contents(storage.histories["user"].stored) == ["summary", "question 2", "answer 2"]
+    assert contents(history.messages()) == ["summary", "question 2", "answer 2", "question 3", "answer 3"]
+    history.flush()
+    assert contents(storage.histories["user"].stored) == ["summary", "question 2", "answer 2", "question 3", "answer 3"]
+
+def test_a_history_cleared_while_a_rewrite_runs_stays_cleared():
+    storage = Storage()
+    cache = SessionHistoryCache(storage)
+    history = cache.session("user")
+    history.add_messages(turn(0))
+
+    def transform(messages):
+        history.clear()
+        return [AIMessage(content="summary")]
+
+    assert not cache.rewrite("user", transform)
+    assert storage.histories["user"].stored == [] and history.messages() == []
+
+def test_compaction_folds_every_stored_message(monkeypatch):
+    pytest.importorskip("langchain_openai")
+    from app.services import history_compaction
+    monkeypatch.setattr(history_compaction, "message_token_count", lambda message: 10)
+    monkeypatch.setattr(history_compaction, "with_token_count", lambda message: message)
+    compactor = history_compaction.HistoryCompactor("sk-test", keep_last=2, chunk_tokens=50)
+    folded = []
+    monkeypatch.setattr(compactor, "_summarise", lambda summary, lines: folded.extend(lines) or f"summary of {len(folded)}")
+    storage = Storage()
+    storage.histories["user"] = FakeHistory([message for i in range(30) for message in turn(i)])
+    cache = SessionHistoryCache(storage)
+
+    assert history_compaction.compact_session(cache, "user", compactor)
+    # None of the 58 older messages is dropped, they are folded in windows of 5.
+    assert len(folded) == 58
+    assert contents(storage.histories["user"].stored) == [f"{history_compaction.SUMMARY_PREFIX}summary of 58", "question 29", "answer 29"]
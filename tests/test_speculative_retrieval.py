@@ -0,0 +1,106 @@
+"""Speculative retrieval of the raw message while the agent picks a tool: reused by Rag, dropped, or skipped."""
+import threading
+import time
+
+import pytest
+
+pytest.importorskip("langchain_openai")
+
+from app.services.conversation_service import PrefetchedRetrieval, RealtyaiBot, TurnState, _current_turn
+from app.services.databases import document_catalog
+
+WA_ID = "911234567890"
+
+@pytest.fixture
+def bot(tmp_path, monkeypatch):
+    document_catalog.configure_document_catalog(str(tmp_path / "catalog.sqlite"))
+    document_catalog.get_document_catalog().add(
+        {"group_id": WA_ID, "media_id": "media-1", "source": "villa.pdf", "source_type": "document", "caption": "", "date": ""},
+        "Brochure of the villa."
+    )
+    bot = RealtyaiBot(openai_api_key="sk-test", speculative_retrieval=True, speculative_min_similarity=0.85, speculative_timeout=5)
+    yield bot
+    document_catalog.configure_document_catalog(None)
+
+def in_turn(fn, wa_id=WA_ID):
+    """Run fn in the context of a turn of wa_id, as the tools do."""
+    token = _current_turn.set(TurnState(senders_wa_id=wa_id, dynamodb=None))
+    try:
+        return fn(_current_turn.get())
+    finally:
+        _current_turn.reset(token)
+
+def prefetched(query, embedding):
+    return lambda user_input: PrefetchedRetrieval(query, embedding, ["node"])
+
+def test_prefetch_is_reused_for_a_query_meaning_the_same_thing(bot, monkeypatch):
+    monkeypatch.setattr(bot, "_prefetch", prefetched("villa pool?", [1.0, 0.0]))
+
+    def turn(state):
+        state.prefetch = bot._start_prefetch("villa pool?")
+        first = bot._take_prefetch([0.99, 0.1])
+        # Taken once, a second tool call retrieves on its own.
+        return first, bot._take_prefetch([0.99, 0.1])
+    first, second = in_turn(turn)
+
+    assert first.nodes == ["node"] and second is None
+
+def test_prefetch_is_dropped_for_a_different_query(bot, monkeypatch):
+    monkeypatch.setattr(bot, "_prefetch", prefetched("villa pool?", [1.0, 0.0]))
+
+    def turn(state):
+        state.prefetch = bot._start_prefetch("villa pool?")
+        return bot._take_prefetch([0.0, 1.0])
+
+    assert in_turn(turn) is None
+
+def test_failed_prefetches_are_not_used(bot, monkeypatch):
+    def fail(user_input):
+        raise RuntimeError("qdrant unavailable")
+    monkeypatch.setattr(bot, "_prefetch", fail)
+
+    def turn(state):
+        state.prefetch = bot._start_prefetch("villa pool?")
+        return bot._take_prefetch([1.0, 0.0])
+
+    assert in_turn(turn) is None
+
+def test_users_without_documents_get_no_prefetch(bot, monkeypatch):
+    calls = []
+    monkeypatch.setattr(bot, "_prefetch", calls.append)
+
+    assert in_turn(lambda state: bot._start_prefetch("hello"), wa_id="922222222222") is None
+    assert calls == []
+
+def test_prefetches_are_skipped_while_their_threads_are_busy(bot, monkeypatch):
+    release = threading.Event()
+    monkeypatch.setattr(bot, "_prefetch", lambda user_input: release.wait(5))
+
+    running = [in_turn(lambda state: bot._start_prefetch("villa pool?")) for _ in range(4)]
+    assert all(running)
+    assert in_turn(lambda state: bot._start_prefetch("villa pool?")) is None
+    release.set()
+    for prefetch in running:
+        prefetch.result(timeout=5)
+    # The threads are free again. The slots are released by done-callbacks, which run once result() returned.
+    for _ in range(100):
+        prefetch = in_turn(lambda state: bot._start_prefetch("villa pool?"))
+        if prefetch is not None:
+            break
+        time.sleep(0.01)
+    assert prefetch is not None
+
+def test_prefetches_dropped_before_they_started_free_their_slot(bot, monkeypatch):
+    release = threading.Event()
+    # Every thread is busy, eg. with the prefetches of turns that skipped them.
+    busy = [bot._prefetch_executor.submit(release.wait, 5) for _ in range(4)]
+    monkeypatch.setattr(bot, "_prefetch", prefetched("villa pool?", [1.0, 0.0]))
+
+    # The turn's prefetch is queued, then dropped because no tool asked for it.
+    prefetch = in_turn(lambda state: bot._start_prefetch("villa pool?"))
+    assert prefetch.cancel()
+    release.set()
+    for future in busy:
+        future.result(timeout=5)
+
+    assert all(in_turn(lambda state: bot._start_prefetch("villa pool?")) for _ in range(4))
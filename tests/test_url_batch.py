@@ -0,0 +1,89 @@
+"""Recording of the pages of a URL batch in the document registry, whatever happens to the summary and index stages."""
+import threading
+import time
+from types import SimpleNamespace
+
+import pytest
+
+pytest.importorskip("llama_index")
+
+from app.services import embedding_service, ingestion_pipeline, service_utilities, url_handling
+from app.services.databases import qdrant_setup
+from app.services.databases.document_registry import DocumentRegistry
+
+WA_ID = "911234567890"
+PAGES = {
+    "https://example.com/villa": "The villa has four bedrooms and a pool. It is ten minutes from the beach.",
+    "https://example.com/flat": "The flat is on the third floor. It comes with a parking space.",
+}
+
+class VectorStore:
+    """In-memory stand-in for the Qdrant vector store, optionally holding the upserts until released."""
+    def __init__(self):
+        self.points = {}
+        self.release = threading.Event()
+        self.release.set()
+
+    def add(self, nodes):
+        self.release.wait(5)
+        for node in nodes:
+            self.points[node.node_id] = node.ref_doc_id
+
+    def delete(self, doc_id):
+        self.points = {node_id: ref for node_id, ref in self.points.items() if ref != doc_id}
+
+@pytest.fixture
+def batch(tmp_path, monkeypatch):
+    vector_store = VectorStore()
+    sentence_index = SimpleNamespace(
+        vector_store=vector_store,
+        service_context=SimpleNamespace(embed_model=embedding_service.build_cached_embed_model(None, "fake"))
+    )
+    monkeypatch.setattr(qdrant_setup, "build_sentence_window_index", lambda *args: sentence_index)
+    monkeypatch.setattr(url_handling, "fetch_url_content", PAGES.get)
+    monkeypatch.setattr(ingestion_pipeline, "invalidate_answers_of", lambda nodes: None)
+    summaries = []
+    monkeypatch.setattr(service_utilities, "generate_summary", lambda text, key: summaries.append(text) or "combined summary")
+    registry = DocumentRegistry(str(tmp_path / "registry.sqlite"))
+
+    def run(urls, **kwargs):
+        return url_handling.process_url_batch(urls, WA_ID, "", "", "", "test", "", document_registry=registry, **kwargs)
+    return SimpleNamespace(run=run, registry=registry, vector_store=vector_store, summaries=summaries, monkeypatch=monkeypatch)
+
+def test_one_summary_per_message(batch):
+    summary, ingestions = batch.run(list(PAGES))
+
+    assert summary == "combined summary"
+    assert len(batch.summaries) == 1
+    # Each page is recorded with an excerpt of its own text, not with the summary of all of them.
+    assert [batch.registry.get(WA_ID, url).summary for url in PAGES] == list(PAGES.values())
+    assert all(ingestion.ok for ingestion in ingestions)
+
+def test_a_single_page_is_recorded_with_the_summary(batch):
+    url = "https://example.com/villa"
+    batch.run([url])
+
+    assert batch.registry.get(WA_ID, url).summary == "combined summary"
+
+def test_pages_are_recorded_when_the_summary_fails(batch):
+    def fail(text, key):
+        raise RuntimeError("LLM unavailable")
+    batch.monkeypatch.setattr(service_utilities, "generate_summary", fail)
+    url = "https://example.com/villa"
+    summary, _ = batch.run([url])
+
+    assert summary is None
+    assert batch.registry.get(WA_ID, url).summary == PAGES[url]
+
+def test_pages_of_a_timed_out_index_are_recorded_once_it_is_over(batch):
+    batch.vector_store.release.clear()
+    summary, ingestions = batch.run(list(PAGES), index_timeout=0.1)
+
+    assert [ingestion.error for ingestion in ingestions] == ["indexing failed", "indexing failed"]
+    assert all(batch.registry.get(WA_ID, url) is None for url in PAGES)
+    batch.vector_store.release.set()
+    deadline = time.monotonic() + 5
+    while any(batch.registry.get(WA_ID, url) is None for url in PAGES) and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert all(batch.registry.get(WA_ID, url) is not None for url in PAGES)
+    assert batch.vector_store.points
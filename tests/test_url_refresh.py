@@ -0,0 +1,148 @@
+"""Incremental URL refresh against a local HTTP server answering with ETag/Last-Modified and 304s."""
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from types import SimpleNamespace
+
+import pytest
+
+pytest.importorskip("llama_index")
+pytest.importorskip("trafilatura")
+pytest.importorskip("requests")
+
+from app.services import embedding_service, service_utilities
+from app.services.databases import qdrant_setup, sentence_store
+from app.services.databases.document_registry import DocumentRegistry
+from app.services.url_refresh import refresh_url
+
+WA_ID = "911234567890"
+
+def page(*paragraphs):
+    body = "".join(f"<p>{paragraph}</p>" for paragraph in paragraphs)
+    return f"<html><head><title>Listing</title></head><body><article>{body}</article></body></html>"
+
+FIRST_VERSION = page(
+    "The flat has three bedrooms and a large balcony facing the park. The kitchen was renovated last year.",
+    "It is close to the metro station and two schools. The price is negotiable for a quick sale."
+)
+SECOND_VERSION = page(
+    "The flat has three bedrooms and a large balcony facing the park. The kitchen was renovated last year.",
+    "It is close to the metro station and two schools. The owner has accepted an offer."
+)
+
+class Site:
+    """The page being refreshed, served with validators, and the conditional headers of every request."""
+    def __init__(self):
+        self.html = FIRST_VERSION
+        self.etag = '"v1"'
+        self.last_modified = "Mon, 05 Oct 2026 10:00:00 GMT"
+        self.requests = []
+
+@pytest.fixture
+def site():
+    site = Site()
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            site.requests.append({"If-None-Match": self.headers.get("If-None-Match"), "If-Modified-Since": self.headers.get("If-Modified-Since")})
+            if self.headers.get("If-None-Match") == site.etag or self.headers.get("If-Modified-Since") == site.last_modified:
+                self.send_response(304)
+                self.end_headers()
+                return
+            body = site.html.encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/html; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.send_header("ETag", site.etag)
+            self.send_header("Last-Modified", site.last_modified)
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    site.url = f"http://127.0.0.1:{server.server_address[1]}/listing"
+    yield site
+    server.shutdown()
+    server.server_close()
+
+class VectorStore:
+    """In-memory stand-in for the Qdrant vector store, checking the sentences are stored after their points."""
+    def __init__(self, sentences):
+        self.sentences = sentences
+        self.points = {}
+        self.collection_name = "test"
+        self.client = SimpleNamespace(delete=self._delete_points)
+        self.sentences_before_upsert = []
+
+    def add(self, nodes):
+        self.sentences_before_upsert.append(self.sentences.windows([(node.ref_doc_id, node.metadata["sentence_position"]) for node in nodes]))
+        for node in nodes:
+            self.points[node.node_id] = node.text
+
+    def delete(self, doc_id):
+        self.points = {}
+
+    def _delete_points(self, collection_name, points_selector):
+        for point_id in points_selector.points:
+            self.points.pop(point_id, None)
+
+@pytest.fixture
+def index(tmp_path, monkeypatch):
+    sentence_store.configure_sentence_store(str(tmp_path / "sentences.sqlite"))
+    vector_store = VectorStore(sentence_store.get_sentence_store())
+    sentence_index = SimpleNamespace(
+        vector_store=vector_store,
+        service_context=SimpleNamespace(embed_model=embedding_service.build_cached_embed_model(None, "fake"))
+    )
+    monkeypatch.setattr(qdrant_setup, "build_sentence_window_index", lambda *args: sentence_index)
+    summaries = []
+    monkeypatch.setattr(service_utilities, "generate_summary", lambda text, key: summaries.append(text) or f"summary {len(summaries)}")
+    yield SimpleNamespace(vector_store=vector_store, registry=DocumentRegistry(str(tmp_path / "registry.sqlite")), summaries=summaries)
+    sentence_store.configure_sentence_store(None)
+
+def refresh(site, index, caption=""):
+    return refresh_url(site.url, WA_ID, caption, "", "", "test", "", index.registry)
+
+def test_unchanged_pages_are_not_fetched_again(site, index):
+    first = refresh(site, index)
+    second = refresh(site, index)
+
+    assert (first.status, second.status) == ("indexed", "not_modified")
+    assert second.summary == first.summary == "summary 1"
+    assert site.requests[0] == {"If-None-Match": None, "If-Modified-Since": None}
+    assert site.requests[1] == {"If-None-Match": '"v1"', "If-Modified-Since": "Mon, 05 Oct 2026 10:00:00 GMT"}
+    assert first.upserted == len(index.vector_store.points) > 0
+
+def test_only_changed_sentences_are_upserted(site, index):
+    refresh(site, index)
+    points_before = dict(index.vector_store.points)
+    site.html, site.etag, site.last_modified = SECOND_VERSION, '"v2"', "Tue, 06 Oct 2026 10:00:00 GMT"
+    result = refresh(site, index)
+
+    assert (result.status, result.upserted, result.deleted) == ("updated", 1, 1)
+    assert "The owner has accepted an offer." in index.vector_store.points.values()
+    assert "The price is negotiable for a quick sale." not in index.vector_store.points.values()
+    assert len(set(points_before) & set(index.vector_store.points)) == len(points_before) - 1
+    # The whole page is shorter than the part summarised, so the edit changes its summary.
+    assert result.summary == "summary 2"
+
+def test_sentences_are_stored_after_their_points(site, index):
+    refresh(site, index)
+
+    doc_id = index.registry.get(WA_ID, site.url).doc_id
+    assert index.vector_store.sentences_before_upsert == [{}]
+    assert sentence_store.get_sentence_store().windows([(doc_id, 0)])
+
+def test_urls_without_a_record_are_fetched_in_full(site, index):
+    refresh(site, index)
+    # Eg. the first indexing stored its points and URL state but failed before recording the document.
+    index.registry.forget(WA_ID, site.url)
+    result = refresh(site, index)
+
+    assert site.requests[-1] == {"If-None-Match": None, "If-Modified-Since": None}
+    assert result.status == "updated"
+    assert result.summary == "summary 2"
+    assert index.registry.get(WA_ID, site.url).summary == "summary 2"